@@ -27,6 +27,7 @@ import c_interface_functions as CI
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import copy
 import sys
 import os
 import time
@@ -39,28 +40,39 @@ import data_structures as DS
 import io_functions as IO
 import image_functions as IM
 import photometry_functions as PH
+import lightcurve_store as LS
+import epoch_catalogue as EC
+import registration_functions as RF
+import task_scheduler as TS
+import run_manifest as RM
+import product_cache as PC
 
 import c_interface_functions as CIF
 
 
+def kernel_radius(ref, target, params):
+    #
+    # Set the kernel size based on the difference in seeing from the reference
+    #
+    # kernelRadius = min(params.kernel_maximum_radius,
+    #                   max(params.kernel_minimum_radius,
+    #                       np.abs(target.fw-ref.fw)*params.fwhm_mult))
+    return min(params.kernel_maximum_radius,
+               max(params.kernel_minimum_radius, np.sqrt(np.abs(
+                   target.fw ** 2 - ref.fw ** 2)) * params.fwhm_mult))
+
+
 def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
                      star_positions=None, star_group_boundaries=None,
                      detector_mean_positions_x=None,
-                     detector_mean_positions_y=None, star_sky=None):
+                     detector_mean_positions_y=None, star_sky=None,
+                     kernel_basis=None):
     from scipy.linalg import lu_solve, lu_factor, LinAlgError
 
     start = time.time()
     print('difference_image', ref.name, target.name)
 
-    #
-    # Set the kernel size based on the difference in seeing from the reference
-    #
-    # kernelRadius = min(params.kernel_maximum_radius,
-    #                   max(params.kernel_minimum_radius,
-    #                       np.abs(target.fw-ref.fw)*params.fwhm_mult))
-    kernelRadius = min(params.kernel_maximum_radius,
-                       max(params.kernel_minimum_radius, np.sqrt(np.abs(
-                           target.fw ** 2 - ref.fw ** 2)) * params.fwhm_mult))
+    kernelRadius = kernel_radius(ref, target, params)
 
     #
     # Mask saturated pixels
@@ -69,10 +81,18 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
     # smask = compute_saturated_pixel_mask(target.image,kernelRadius,params)
 
     #
-    # Define the kernel basis functions
+    # Define the kernel basis functions.  Given eigen-kernels, the kernel
+    # is solved in their basis and expanded over their kernel pixels
     #
     print('Defining kernel pixels', time.time() - start)
-    if params.use_fft_kernel_pixels:
+    Q = None
+    if kernel_basis is not None:
+        print('Computing eigen-kernel images', time.time() - start)
+        kernelIndex = kernel_basis.kernel_index
+        extendedBasis = kernel_basis.extended_basis
+        kernelRadius = kernel_basis.radius
+        Q = IM.eigen_kernel_images(ref.image, ref.blur, kernel_basis)
+    elif params.use_fft_kernel_pixels:
         kernelIndex, extendedBasis = IM.define_kernel_pixels_fft(ref, target,
                                                                  kernelRadius + 2,
                                                                  INNER_RADIUS=20,
@@ -88,6 +108,12 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
     bmask = np.ones(smask.shape, dtype=bool)
 
     g = DS.EmptyBase()
+    g.kernel_radius = kernelRadius
+
+    c_previous = None
+    chi2_previous = None
+    clipping = False
+    g.iterations = 0
 
     for iteration in range(params.iterations):
 
@@ -98,13 +124,18 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
         #
         # Compute the matrix and vector
         #
-        H, V, texref = CI.compute_matrix_and_vector_cuda(ref.image, ref.blur,
-                                                         target.image,
-                                                         target.inv_variance,
-                                                         tmask, kernelIndex,
-                                                         extendedBasis,
-                                                         kernelRadius, params,
-                                                         stamp_positions=stamp_positions)
+        if Q is None:
+            H, V, texref = CI.compute_matrix_and_vector_cuda(ref.image, ref.blur,
+                                                             target.image,
+                                                             target.inv_variance,
+                                                             tmask, kernelIndex,
+                                                             extendedBasis,
+                                                             kernelRadius, params,
+                                                             stamp_positions=stamp_positions)
+        else:
+            H, V = IM.compute_compact_matrix_and_vector(
+                ref.image, Q, target.image, target.inv_variance, tmask,
+                kernelRadius, params, stamp_positions=stamp_positions)
 
         #
         # Solve the matrix equation to find the kernel coefficients
@@ -127,8 +158,13 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
         # Compute the model image
         #
         print('Computing model', time.time() - start)
-        g.model = CI.compute_model_cuda(ref.image.shape, texref, c,
-                                        kernelIndex, extendedBasis, params)
+        if Q is None:
+            g.model = CI.compute_model_cuda(ref.image.shape, texref, c,
+                                            kernelIndex, extendedBasis,
+                                            params)
+        else:
+            g.model = IM.compute_compact_model(ref.image, Q, c, params)
+            c = IM.expand_compact_coefficients(c, kernel_basis, params)
 
         #
         # Compute the difference image
@@ -136,6 +172,28 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
         difference = (target.image - g.model)
         g.norm = difference * np.sqrt(target.inv_variance)
 
+        #
+        # An epoch that the eigen-kernels fit much worse than the epochs
+        # they were learned from is solved again in the full basis.  The
+        # fit is compared over the pixels it used, away from the edges
+        #
+        if iteration == 0:
+            r = int(kernelRadius)
+            fitted = tmask[r:-r, r:-r] != 0
+            g.chi2 = np.sum(g.norm[r:-r, r:-r][fitted] ** 2) / max(
+                1, np.sum(fitted))
+            if Q is not None and g.chi2 > params.kernel_basis_tolerance * \
+                    kernel_basis.chi2:
+                print('Eigen-kernel chi^2 per pixel ' + str(g.chi2) +
+                      ' for ' + target.name + ', using the full basis')
+                return difference_image(
+                    ref, target, params, stamp_positions=stamp_positions,
+                    psf_image=psf_image, star_positions=star_positions,
+                    star_group_boundaries=star_group_boundaries,
+                    detector_mean_positions_x=detector_mean_positions_x,
+                    detector_mean_positions_y=detector_mean_positions_y,
+                    star_sky=star_sky)
+
         #
         # Recompute the variance image from the model
         #
@@ -146,13 +204,29 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
             target.inv_variance[mp] = 1.e-12
 
         #
-        # Mask pixels that disagree with the model
+        # Mask pixels that disagree with the model.  This starts with the
+        # fourth iteration or, if a convergence tolerance is set, as soon
+        # as the kernel has converged, which then also requires the set
+        # of rejected pixels to be stable
         #
-        if iteration > 2:
-            bmask = IM.kappa_clip(smask, g.norm,
-                                  params.pixel_rejection_threshold)
+        chi2 = np.sum(g.norm[tmask != 0] ** 2)
+        converged = params.kernel_tolerance and IM.kernel_converged(
+            c, c_previous, chi2, chi2_previous, params.kernel_tolerance)
+        c_previous, chi2_previous = c, chi2
+        if iteration > 2 or converged:
+            clipping = True
+        mask_changed = False
+        if clipping:
+            clipped = IM.kappa_clip(smask, g.norm,
+                                    params.pixel_rejection_threshold)
+            mask_changed = np.any(clipped != bmask)
+            bmask = clipped
+        g.iterations = iteration + 1
 
         print('Iteration', iteration, 'completed', time.time() - start)
+        if converged and not mask_changed:
+            print('Kernel converged after', g.iterations, 'iterations')
+            break
 
     #
     # Delete the target image array to save memory
@@ -160,12 +234,14 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
     del target.image
 
     #
-    # Save the kernel coefficients to a file
+    # Save the kernel coefficients to a file, for the photometry and for
+    # learning eigen-kernels
     #
-    if params.do_photometry and psf_image:
+    if psf_image and (params.do_photometry or params.kernel_basis_size):
         kf = params.loc_output + os.path.sep + 'k_' + os.path.basename(
             target.name)
-        IO.write_kernel_table(kf, kernelIndex, extendedBasis, c, params)
+        IO.write_kernel_table(kf, kernelIndex, extendedBasis, c, params,
+                              chi2=g.chi2)
 
     g.norm = difference * np.sqrt(target.inv_variance)
     g.variance = 1.0 / target.inv_variance
@@ -218,23 +294,81 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
 
 
 def process_reference_image(f, args):
+    #
+    # Match one frame to the best-seeing reference frame, write its model
+    # and return only the statistics needed to select it for the reference
+    #
     best_seeing_ref, params, stamp_positions = args
     result = difference_image(f, best_seeing_ref, params,
                               stamp_positions=stamp_positions)
-    del f.image
-    del f.mask
-    del f.inv_variance
-    return result
+    f.release()
+    summary = DS.EmptyBase()
+    summary.ok = isinstance(result.diff, np.ndarray)
+    if summary.ok:
+        summary.diff_std = np.std(result.diff)
+        summary.model_median = np.median(result.model)
+        IO.write_image(result.model,
+                       params.loc_output + os.path.sep + 'mr_' + f.name)
+    return summary
+
+
+#
+# Arguments common to every task of a Pool, installed in each worker by an
+# initializer with their arrays in shared memory, so that tasks only carry
+# their own Observation.  Each task gets its own copy of the parameters,
+# so that tasks running as threads never share them, and retried tasks use
+# fallback parameters.
+#
+_worker_args = None
+
+
+def install_worker_args(args):
+    global _worker_args
+    _worker_args = DS.unshare(args)
 
 
-def process_reference_image_helper(args):
-    return process_reference_image(*args)
+def fallback_parameters(params):
+    """Simpler kernel configuration for retrying an epoch that failed."""
+    fallback = copy.copy(params)
+    fallback.sdeg = params.pdeg
+    fallback.use_fft_kernel_pixels = False
+    fallback.kernel_basis_size = None
+    return fallback
 
 
-def make_reference(files, params, reference_image='ref.fits'):
-    seeing = {}
-    sky = {}
+def worker_args(attempt):
+    args = list(_worker_args)
+    if attempt == 0:
+        args[1] = copy.copy(args[1])
+    else:
+        args[1] = fallback_parameters(args[1])
+    return tuple(args)
+
+
+def process_reference_image_shared(f, attempt=0):
+    return process_reference_image(f, worker_args(attempt))
+
+
+def process_image_shared(f, attempt=0):
+    return process_image(f, worker_args(attempt))
+
+
+def photometry_image_shared(f, attempt=0):
+    #
+    # The kernel was solved with the degrees recorded in its table, so
+    # retries use the same parameters
+    #
+    return photometry_image(f, worker_args(0))
+
+
+def select_reference_images(files, params):
+    #
+    # Choose the frames to combine into the reference, from the
+    # include file or by seeing, sky and signal, and the best-seeing
+    # one among them.  Only the metadata of the frames is used.
+    #
     ref_seeing = 1000
+    seeing_factor = params.reference_seeing_factor
 
     #
     # Have we specified the files to make the reference with?
@@ -290,10 +424,10 @@ def make_reference(files, params, reference_image='ref.fits'):
             ref_list = []
             print('Reference FWHM = ', ref_seeing)
             print('Cutoff FWHM for reference = ',
-                  params.reference_seeing_factor * ref_seeing)
+                  seeing_factor * ref_seeing)
             print('Combining for reference:')
             for f in files:
-                if (f.fw < params.reference_seeing_factor * ref_seeing) and (
+                if (f.fw < seeing_factor * ref_seeing) and (
                         f.roundness < params.reference_max_roundness) and (
                         f.sky < params.reference_sky_factor * ref_sky) and (
                         f.fw > params.reference_min_seeing) and (
@@ -301,7 +435,7 @@ def make_reference(files, params, reference_image='ref.fits'):
                         f.name in reference_exclude):
                     ref_list.append(f)
                     print(f.name, f.fw, f.sky, f.signal)
-            params.reference_seeing_factor *= 1.02
+            seeing_factor *= 1.02
 
         sig = []
         for f in ref_list:
@@ -319,6 +453,18 @@ def make_reference(files, params, reference_image='ref.fits'):
                 ref_roundness = f.roundness
                 best_seeing_ref = f
 
+    return ref_list, best_seeing_ref
+
+
+def make_reference(files, params, reference_image='ref.fits',
+                   selection=None):
+    #
+    # selection is the result of select_reference_images if already made
+    #
+    if selection is None:
+        selection = select_reference_images(files, params)
+    ref_list, best_seeing_ref = selection
+
     #
     # Which ref image has the worst seeing?
     #
@@ -355,29 +501,36 @@ def make_reference(files, params, reference_image='ref.fits'):
     good_ref_list = []
 
     for f in ref_list:
-        f.blur = IM.boxcar_blur(f.image)
         good_ref_list.append(f)
         print('difference_image:', f.name, best_seeing_ref.name)
 
+    #
+    # Match every frame to the best-seeing frame, worst seeing first.  In
+    # parallel, the arrays of the best-seeing frame that every worker needs
+    # are loaded first, so that they are shared rather than read by each
+    # worker
+    #
+    args = (best_seeing_ref, params, stamp_positions)
+    n_parallel = 1
     if not (params.use_GPU) and (params.n_parallel > 1):
-
-        #
-        # Use ParallelProcessing to process images in the reference list
-        #
-
-        pool = Pool(params.n_parallel)
-        results = pool.map(process_reference_image_helper,
-                           itertools.izip(ref_list, itertools.repeat(
-                               (best_seeing_ref, params, stamp_positions))))
-
-        for i, f in enumerate(ref_list):
-            f.result = results[i]
-
-    else:
-
-        for f in ref_list:
-            f.result = process_reference_image(f, (
-                best_seeing_ref, params, stamp_positions))
+        n_parallel = params.n_parallel
+        for attribute in ('image', 'mask', 'inv_variance'):
+            getattr(best_seeing_ref, attribute)
+        args = DS.share(args)
+    results = TS.run_tasks(process_reference_image_shared, ref_list,
+                           n_parallel=n_parallel,
+                           initializer=install_worker_args, initargs=(args,),
+                           cost=lambda f: f.fw, failed=lambda r: not r.ok,
+                           retries=params.task_retries,
+                           timeout=params.task_timeout,
+                           name='reference frames')
+    if n_parallel > 1:
+        best_seeing_ref.release()
+    for f, result in zip(ref_list, results):
+        if result is None:
+            result = DS.EmptyBase()
+            result.ok = False
+        f.result = result
 
     #
     # Remove bad reference models
@@ -385,7 +538,7 @@ def make_reference(files, params, reference_image='ref.fits'):
 
     rlist = [g for g in good_ref_list]
     for g in rlist:
-        if not (isinstance(g.result.diff, np.ndarray)):
+        if not g.result.ok:
             print('removing', g.name)
             good_ref_list.remove(g)
 
@@ -399,33 +552,36 @@ def make_reference(files, params, reference_image='ref.fits'):
             break
         sd = np.zeros(len(good_ref_list))
         for i, g in enumerate(good_ref_list):
-            print(g.name, g.result.diff)
-            sd[i] = np.std(g.result.diff)
+            print(g.name, g.result.diff_std)
+            sd[i] = g.result.diff_std
         sds = sd.std()
         sdm = sd.mean()
         rlist = [g for g in good_ref_list]
         for g in rlist:
-            if np.std(g.result.diff) > (sdm + 2.5 * sds):
+            if g.result.diff_std > (sdm + 2.5 * sds):
                 print('removing', g.name)
                 good_ref_list.remove(g)
 
     #
-    # Combine the good reference models
+    # Combine the good reference models, streaming them from their mr_
+    # files, and remove the models of the frames that were rejected
     #
-    g = good_ref_list[0]
-    gstack = np.zeros(
-        [len(good_ref_list), g.result.model.shape[0], g.result.model.shape[1]])
-    mask = np.ones_like(g.result.model)
+    mask = None
     print('final reference list')
-    for i, g in enumerate(good_ref_list):
-        if isinstance(g.result.model, np.ndarray):
-            print(g.name, np.std(g.result.diff), np.median(g.result.model))
-            IO.write_image(g.result.model,
-                           params.loc_output + os.path.sep + 'mr_' + g.name)
-            gstack[i, :, :] = g.result.model
-            mask *= g.mask
-    rr = np.median(gstack, axis=0)
+    for g in good_ref_list:
+        print(g.name, g.result.diff_std, g.result.model_median)
+        if mask is None:
+            mask = np.ones(g.mask.shape)
+        mask *= g.mask
+        g.release('mask')
+    rr = IO.median_combine_images(
+        [params.loc_output + os.path.sep + 'mr_' + g.name
+         for g in good_ref_list])
     IO.write_image(rr, params.loc_output + os.path.sep + reference_image)
+    for f in ref_list:
+        model_file = params.loc_output + os.path.sep + 'mr_' + f.name
+        if f not in good_ref_list and os.path.exists(model_file):
+            os.remove(model_file)
     IO.write_image(mask,
                    params.loc_output + os.path.sep + 'mask_' + reference_image)
 
@@ -436,54 +592,277 @@ def make_reference(files, params, reference_image='ref.fits'):
 
 
 def process_image(f, args):
-    ref, params, stamp_positions, star_positions, star_group_boundaries, star_unsort_index, detector_mean_positions_x, detector_mean_positions_y = args
-    dtarget = params.loc_output + os.path.sep + 'd_' + f.name
-    if not (os.path.exists(dtarget)):
+    ref, params, stamp_positions, star_positions, star_group_boundaries, star_unsort_index, detector_mean_positions_x, detector_mean_positions_y, kernel_basis = args
+    ok = True
+
+    #
+    # Compute difference image
+    #
+    result = difference_image(ref, f, params,
+                              stamp_positions=stamp_positions,
+                              psf_image=params.loc_output + os.path.sep + 'psf.fits',
+                              star_positions=star_positions,
+                              star_group_boundaries=star_group_boundaries,
+                              detector_mean_positions_x=detector_mean_positions_x,
+                              detector_mean_positions_y=detector_mean_positions_y,
+                              kernel_basis=kernel_basis if
+                              params.kernel_basis_size else None)
+    f.release()
+
+    #
+    # Save photometry to the light-curve store
+    #
+    if isinstance(result.flux, np.ndarray):
+        save_photometry(f, result.flux, result.dflux, params,
+                        star_unsort_index)
+
+    #
+    # Save output images to files
+    #
+    catalogue = EC.EpochCatalogue(params.loc_output)
+    if isinstance(result.diff, np.ndarray):
+        IO.write_image(result.diff,
+                       params.loc_output + os.path.sep + 'd_' + f.name)
+        IO.write_image(result.model,
+                       params.loc_output + os.path.sep + 'm_' + f.name)
+        IO.write_image(result.norm,
+                       params.loc_output + os.path.sep + 'n_' + f.name)
+        IO.write_image(result.mask,
+                       params.loc_output + os.path.sep + 'z_' + f.name)
+        catalogue.update(f.name, kernel_radius=float(result.kernel_radius),
+                         iterations=result.iterations,
+                         status='differenced')
+    else:
+        catalogue.update(f.name, status='failed')
+        ok = False
 
-        #
-        # Compute difference image
-        #
-        result = difference_image(ref, f, params,
-                                  stamp_positions=stamp_positions,
-                                  psf_image=params.loc_output + os.path.sep + 'psf.fits',
-                                  star_positions=star_positions,
-                                  star_group_boundaries=star_group_boundaries,
-                                  detector_mean_positions_x=detector_mean_positions_x,
-                                  detector_mean_positions_y=detector_mean_positions_y)
-        del f.image
-        del f.mask
-        del f.inv_variance
+    #
+    # An epoch whose photometry was requested but failed is not done, so
+    # that it is retried, and redone on a rerun
+    #
+    if params.do_photometry and not (isinstance(result.flux, np.ndarray)):
+        print('Photometry failed for ' + f.name)
+        ok = False
+    return ok
 
-        #
-        # Save photometry to a file
-        #
-        if isinstance(result.flux, np.ndarray):
-            if not (params.use_GPU):
-                print('ungrouping fluxes')
-                result.flux = result.flux[star_unsort_index].copy()
-                result.dflux = result.dflux[star_unsort_index].copy()
-            np.savetxt(params.loc_output + os.path.sep + f.name + '.flux',
-                       np.vstack((result.flux, result.dflux)).T)
-            f.flux = result.flux.copy()
-            f.dflux = result.dflux.copy()
 
-        #
-        # Save output images to files
-        #
-        if isinstance(result.diff, np.ndarray):
-            IO.write_image(result.diff,
-                           params.loc_output + os.path.sep + 'd_' + f.name)
-            IO.write_image(result.model,
-                           params.loc_output + os.path.sep + 'm_' + f.name)
-            IO.write_image(result.norm,
-                           params.loc_output + os.path.sep + 'n_' + f.name)
-            IO.write_image(result.mask,
-                           params.loc_output + os.path.sep + 'z_' + f.name)
-    return 0
+def kernel_basis_training_images(files, params):
+    """The params.kernel_basis_training epochs, evenly spaced in seeing,
+    whose kernels are solved in the full basis to learn eigen-kernels."""
+    ordered = sorted(files, key=lambda f: f.fw)
+    n = min(params.kernel_basis_training, len(ordered))
+    index = np.unique(np.round(np.linspace(0, len(ordered) - 1, n)))
+    return [ordered[int(i)] for i in index]
+
+
+def make_kernel_basis(files, params, basis_file):
+    """Learn eigen-kernels from the kernel tables of the training epochs
+    files, leaving out those solved with fallback degrees, and write them
+    to basis_file.  Returns the KernelBasis, or None if there are no
+    kernels to learn from."""
+    kernels = []
+    chi2 = []
+    for f in files:
+        kf = params.loc_output + os.path.sep + 'k_' + f.name
+        kernelIndex, extendedBasis, c, kernel_params = IO.read_kernel_table(
+            kf, copy.copy(params))
+        chi2_f = IO.read_kernel_chi2(kf)
+        if kernel_params.sdeg != params.sdeg or chi2_f is None:
+            continue
+        kernels.append((kernelIndex, extendedBasis, c, kernel_params))
+        chi2.append(chi2_f)
+    if not (kernels):
+        print('No kernels to learn eigen-kernels from')
+        return None
+    basis = IM.learn_kernel_basis(kernels, params.kernel_basis_size,
+                                  np.median(chi2))
+    IO.write_kernel_basis(basis_file, basis.kernel_index,
+                          basis.extended_basis, basis.components, basis.chi2)
+    return basis
+
+
+def save_photometry(f, flux, dflux, params, star_unsort_index):
+    if not (params.use_GPU):
+        print('ungrouping fluxes')
+        flux = flux[star_unsort_index].copy()
+        dflux = dflux[star_unsort_index].copy()
+    store = LS.LightcurveStore(
+        LS.lightcurve_store_path(params.loc_output), mode='r+')
+    store.write(f.name, flux, dflux)
+    f.flux = flux.copy()
+    f.dflux = dflux.copy()
+
+
+def photometry_image(f, args):
+    #
+    # Redo the photometry of an epoch from its difference image, model,
+    # pixel mask and kernel table in loc_output.  The inverse variance is
+    # recomputed from the model as in difference_image.
+    #
+    ref, params, stamp_positions, star_positions, star_group_boundaries, star_unsort_index, detector_mean_positions_x, detector_mean_positions_y, kernel_basis = args
+    print('photometry_image', f.name)
+    prefix = params.loc_output + os.path.sep
+    diff, _ = IO.read_fits_file(prefix + 'd_' + f.name)
+    model, _ = IO.read_fits_file(prefix + 'm_' + f.name)
+    mask, _ = IO.read_fits_file(prefix + 'z_' + f.name)
+    kernelIndex, extendedBasis, c, kernel_params = IO.read_kernel_table(
+        prefix + 'k_' + f.name, copy.copy(params))
+    inv_variance = 1.0 / (model / params.gain + (
+            params.readnoise / params.gain) ** 2)
+    inv_variance[mask == 0] = 1.e-12
+    difference = IM.undo_photometric_scale(diff, c, kernel_params.pdeg)
+    flux, dflux = CI.photom_all_stars(difference, inv_variance,
+                                      star_positions,
+                                      prefix + 'psf.fits', c, kernelIndex,
+                                      extendedBasis,
+                                      kernel_radius(ref, f, params),
+                                      kernel_params, star_group_boundaries,
+                                      detector_mean_positions_x,
+                                      detector_mean_positions_y)
+    if not (isinstance(flux, np.ndarray)):
+        return False
+    save_photometry(f, flux, dflux, params, star_unsort_index)
+    return True
+
+
+def register_image(f, reg, params):
+    #
+    # Register one epoch in a worker process, which writes its products
+    # whatever the storage policy since they cannot be returned cheaply.
+    #
+    f.register(reg, params)
+    f.persist()
+    f.release()
+    sys.stdout.flush()
+    return f.name
+
+
+def register_image_helper(args):
+    return register_image(*args)
+
+
+def register_all_images(files, reg, params, done=None):
+    #
+    # Register every epoch to reg.  In parallel, the registration template
+    # is transformed once and its spectrum shared with the workers through
+    # shared memory.  done(f) is called as each epoch's products are
+    # released.
+    #
+    targets = [f for f in files if f != reg]
+    if params.n_parallel > 1 and len(targets) > 1:
+        shared = RF.share_template(reg, params)
+        reg.release()
+        by_name = dict((f.name, f) for f in targets)
+        pool = Pool(params.n_parallel, RF.install_shared_template, shared)
+        for name in pool.imap_unordered(
+                register_image_helper,
+                itertools.izip(targets, itertools.repeat(reg),
+                               itertools.repeat(params))):
+            by_name[name].set_registered()
+            if done is not None:
+                done(by_name[name])
+        pool.close()
+        pool.join()
+    else:
+        for f in targets:
+            f.register(reg, params)
+            # delete image arrays to save memory
+            f.release()
+            if done is not None:
+                done(f)
+    if reg in files:
+        reg.image = reg.data
+    reg.release()
+    if reg in files and done is not None:
+        done(reg)
+
+
+def ingest_image(filename, params):
+    #
+    # Measure one image, or read its measurements from the epoch catalogue,
+    # and return its metadata without any pixel arrays.
+    #
+    g = DS.Observation(filename, params, lazy=True)
+    print(g.name)
+    sys.stdout.flush()
+    return g.record()
 
 
-def process_image_helper(args):
-    return process_image(*args)
+def ingest_image_helper(args):
+    return ingest_image(*args)
+
+
+def ingest_images(filenames, params):
+    #
+    # Build Observations for a list of files.  Images that have not been
+    # measured before are read and measured in parallel; the workers record
+    # the results in the epoch catalogue and only return compact metadata.
+    #
+    EC.EpochCatalogue(params.loc_output)
+    if params.n_parallel > 1:
+        pool = Pool(params.n_parallel)
+        records = pool.map(ingest_image_helper,
+                           itertools.izip(filenames, itertools.repeat(params)))
+        pool.close()
+        pool.join()
+    else:
+        records = [ingest_image(f, params) for f in filenames]
+    return [DS.Observation(f, params, record=r)
+            for f, r in zip(filenames, records)]
+
+
+def scan_images(params, manifest=None):
+    #
+    # Build the list of epochs from FITS headers and the epoch catalogue.
+    # Pixels are only read for images that have not been measured before,
+    # and are otherwise loaded when an epoch is actually processed.
+    #
+    all_files = os.listdir(params.loc_data)
+    all_files.sort()
+    filenames = [params.loc_data + os.path.sep + f for f in all_files if
+                 fnmatch.fnmatch(f, params.name_pattern)]
+    if manifest is None:
+        return [g for g in ingest_images(filenames, params) if g.fw > 0.0]
+
+    #
+    # Images that have changed, or were measured with other parameters,
+    # lose their catalogue measurements so that they are measured again
+    #
+    catalogue = EC.EpochCatalogue(params.loc_output)
+    works = [manifest.work('ingest', os.path.basename(f), params, inputs=[f])
+             for f in filenames]
+    for work in works:
+        if not (manifest.is_current(work, adopt=True)):
+            catalogue.update(work['key'], **dict.fromkeys(EC.IMAGE_COLUMNS))
+    files = [g for g in ingest_images(filenames, params) if g.fw > 0.0]
+    for work in works:
+        manifest.record(work)
+    manifest.save()
+    return files
+
+
+def load_reference(params, reference, reg):
+    #
+    # Read the reference image and its mask from loc_output, register it to
+    # reg, mask near-saturated (and optionally crowded) pixels and blur it
+    # for the kernel basis
+    #
+    ref = DS.Observation(params.loc_output + os.path.sep + reference, params)
+    mask_file = params.loc_output + os.path.sep + 'mask_' + reference
+    if os.path.exists(mask_file):
+        mask, _ = IO.read_fits_file(mask_file)
+    else:
+        mask = np.ones_like(ref.data)
+    ref.mask = mask
+    ref.register(reg, params)
+    pm = params.pixel_max
+    params.pixel_max *= 0.9
+    ref.mask *= IM.compute_saturated_pixel_mask(ref.image, 4, params)
+    params.pixel_max = pm
+    ref.blur = IM.boxcar_blur(ref.image)
+    if params.mask_cluster:
+        ref.mask *= IM.mask_cluster(ref.image, ref.mask, params)
+    return ref
 
 
 def imsub_all_fits(params, reference='ref.fits'):
@@ -507,25 +886,26 @@ def imsub_all_fits(params, reference='ref.fits'):
     print('Parameters:')
     for par in dir(params):
         print(par, getattr(params, par))
+    #
+    # Each stage below redoes only the work that the run manifest does not
+    # record as done with the same inputs and parameters
+    #
+    manifest = RM.RunManifest(params.loc_output,
+                              PC.open_product_cache(params))
+
     print('Determine ur list of images')
     #
-    all_files = os.listdir(params.loc_data)
-    all_files.sort()
-    files = []
-    for f in all_files:
-        if fnmatch.fnmatch(f, params.name_pattern):
-            g = DS.Observation(params.loc_data + os.path.sep + f, params)
-            del g.data
-            del g.mask
-            if g.fw > 0.0:
-                files.append(g)
-            print(g.name)
+    files = scan_images(params, manifest)
 
     if len(files) < 3:
         print('Only', len(files), 'files found matching', params.name_pattern)
         print('Exiting')
         sys.exit(0)
 
+    catalogue = EC.EpochCatalogue(params.loc_output)
+    catalogue.write_seeing_file(params.loc_output + os.path.sep + 'seeing',
+                                names=[f.name for f in files])
+
     #
     # Have we specified a registration template?
     #
@@ -543,102 +923,104 @@ def imsub_all_fits(params, reference='ref.fits'):
     #
     # Register images
     #
+    template = manifest.work('register', 'template', params,
+                             inputs=[reg.fullname],
+                             upstream=[w for w in
+                                       [manifest.get('ingest', reg.name)] if w])
+    registered = {}
+    stale = []
     for f in files:
         if f == reg:
-            f.image = f.data
-            rf = params.loc_output + os.path.sep + 'r_' + f.name
-            IO.write_image(f.image, rf)
+            #
+            # The template is its own registered image, which is cheap to
+            # remake
+            #
+            registered[f.name] = template
+            stale.append(f)
+            continue
+        registered[f.name] = manifest.work(
+            'register', f.name, params, inputs=[f.fullname],
+            upstream=[template, manifest.get('ingest', f.name)],
+            outputs=f.product_files())
+        if manifest.is_current(registered[f.name]):
+            f.set_registered()
         else:
-            f.register(reg, params)
-            # delete image arrays to save memory
-            del f.image
-            del f.mask
-            del f.inv_variance
-        del reg.data
-        del reg.image
-        del reg.mask
-        del reg.inv_variance
+            stale.append(f)
+    print(len(files) - len(stale), 'images already registered')
+    register_all_images(stale, reg, params,
+                        done=lambda f: manifest.record(registered[f.name]))
+    manifest.save()
 
     #
     # Write image names and dates to a file
     #
     if params.image_list_file:
-        try:
-            with open(params.loc_output + os.path.sep + params.image_list_file,
-                      'w') as fid:
-                for f in files:
-                    date = None
-                    if params.datekey:
-                        date = IO.get_date(
-                            params.loc_data + os.path.sep + f.name,
-                            key=params.datekey) - 2450000
-                    if date:
-                        fid.write(f.name + '   %10.5f\n' % date)
-                    else:
-                        fid.write(f.name)
-        except:
-            raise
-
-    #
-    # Make the photometric reference image if we don't have it.
+        if params.datekey:
+            for f in files:
+                catalogue.get_date(params.loc_data + os.path.sep + f.name,
+                                   key=params.datekey)
+        catalogue.write_image_list_file(
+            params.loc_output + os.path.sep + params.image_list_file,
+            names=[f.name for f in files])
+
+    #
+    # Make the photometric reference image if we don't have it, or if the
+    # frames selected for it have changed: epochs that have been added
+    # only matter if they are selected.
     # Find stamp positions if required.
     #
-    if not (os.path.exists(params.loc_output + os.path.sep + reference)):
+    stamp_file = params.loc_output + os.path.sep + 'stamp_positions'
+    selection = select_reference_images(files, params)
+    reference_work = manifest.work(
+        'reference', reference, params,
+        inputs=[params.ref_include_file, params.ref_exclude_file],
+        upstream=[template] + [registered[f.name] for f in selection[0]],
+        outputs=[params.loc_output + os.path.sep + reference,
+                 params.loc_output + os.path.sep + 'mask_' + reference])
+    if not (manifest.is_current(reference_work, adopt=True)):
         print('Reg = ', reg.name)
+        if os.path.exists(stamp_file):
+            os.remove(stamp_file)
         stamp_positions = make_reference(files, params,
-                                         reference_image=reference)
-        ref = DS.Observation(params.loc_output + os.path.sep + reference,
-                             params)
-        mask, _ = IO.read_fits_file(
-            params.loc_output + os.path.sep + 'mask_' + reference)
-        ref.mask = mask
-        ref.register(reg, params)
+                                         reference_image=reference,
+                                         selection=selection)
+        manifest.record(reference_work)
+        manifest.save()
+        ref = load_reference(params, reference, reg)
     else:
-        ref = DS.Observation(params.loc_output + os.path.sep + reference,
-                             params)
-        if os.path.exists(
-                params.loc_output + os.path.sep + 'mask_' + reference):
-            mask, _ = IO.read_fits_file(
-                params.loc_output + os.path.sep + 'mask_' + reference)
-        else:
-            mask = np.ones_like(ref.data)
-        ref.mask = mask
-        ref.register(reg, params)
+        ref = load_reference(params, reference, reg)
         stamp_positions = None
         if params.use_stamps:
-            stamp_file = params.loc_output + os.path.sep + 'stamp_positions'
             if os.path.exists(stamp_file):
                 stamp_positions = np.genfromtxt(stamp_file)
             else:
                 stars = PH.choose_stamps(ref, params)
                 stamp_positions = stars[:, 0:2]
-                np.savetxt(stamp_file, stamp_positions)
-
-    pm = params.pixel_max
-    params.pixel_max *= 0.9
-    ref.mask *= IM.compute_saturated_pixel_mask(ref.image, 4, params)
-    params.pixel_max = pm
-    ref.blur = IM.boxcar_blur(ref.image)
-    if params.mask_cluster:
-        ref.mask *= IM.mask_cluster(ref.image, ref.mask, params)
+                IO.write_table(stamp_file, stamp_positions)
 
     #
     # Detect stars and compute the PSF if we are doing photometry
     #
     star_positions = None
+    psf_work = None
     sky = 0.0
     if params.do_photometry:
         star_file = params.loc_output + os.path.sep + 'star_positions'
         psf_file = params.loc_output + os.path.sep + 'psf.fits'
-        if not (os.path.exists(psf_file)) or not (os.path.exists(star_file)):
+        psf_work = manifest.work(
+            'psf', reference, params,
+            inputs=[params.star_file, params.star_reference_image],
+            upstream=[reference_work], outputs=[psf_file, star_file])
+        if not (manifest.is_current(psf_work, adopt=True)):
             stars = PH.compute_psf_image(params, ref, psf_image=psf_file)
             star_positions = stars[:, 0:2]
             star_sky = stars[:, 4]
-        if os.path.exists(star_file):
-            star_positions = np.genfromtxt(star_file)
-            star_sky = star_positions[:, 0] * 0.0;
+            IO.write_table(star_file, star_positions)
+            manifest.record(psf_work)
+            manifest.save()
         else:
-            np.savetxt(star_file, star_positions)
+            star_positions = np.genfromtxt(star_file)
+            star_sky = star_positions[:, 0] * 0.0
 
     print('sky =', sky)
 
@@ -679,7 +1061,10 @@ def imsub_all_fits(params, reference='ref.fits'):
     #
     if params.do_photometry:
         ref_flux_file = params.loc_output + os.path.sep + 'ref.flux'
-        if not (os.path.exists(ref_flux_file)):
+        photometry_work = manifest.work('reference_photometry', reference,
+                                        params, upstream=[psf_work],
+                                        outputs=[ref_flux_file])
+        if not (manifest.is_current(photometry_work, adopt=True)):
             result = difference_image(ref, ref, params,
                                       stamp_positions=stamp_positions,
                                       psf_image=psf_file,
@@ -692,8 +1077,27 @@ def imsub_all_fits(params, reference='ref.fits'):
                 print('ungrouping fluxes')
                 result.flux = result.flux[star_unsort_index].copy()
                 result.dflux = result.dflux[star_unsort_index].copy()
-                np.savetxt(ref_flux_file,
-                           np.vstack((result.flux, result.dflux)).T)
+                IO.write_table(ref_flux_file,
+                               np.vstack((result.flux, result.dflux)).T)
+                manifest.record(photometry_work)
+                manifest.save()
+
+    #
+    # Allocate light-curve store rows for every epoch
+    #
+    if params.do_photometry and params.make_difference_images:
+        store = LS.open_lightcurve_store(params.loc_output,
+                                         star_positions.shape[0],
+                                         [f.name for f in files])
+        for f in files:
+            date = None
+            if params.datekey:
+                date = catalogue.get_date(
+                    params.loc_data + os.path.sep + f.name,
+                    key=params.datekey) - 2450000
+            store.set_metadata(f.name, date=date, fw=f.fw, sky=f.sky,
+                               signal=f.signal)
+        del store
 
     #
     # Process images
@@ -701,26 +1105,117 @@ def imsub_all_fits(params, reference='ref.fits'):
 
     if params.make_difference_images:
 
-        if not (params.use_GPU) and (params.n_parallel > 1):
-
-            pool = Pool(params.n_parallel)
-            pool.map(process_image_helper, itertools.izip(files,
-                                                          itertools.repeat((
-                                                              ref, params,
-                                                              stamp_positions,
-                                                              star_positions,
-                                                              star_group_boundaries,
-                                                              star_unsort_index,
-                                                              detector_mean_positions_x,
-                                                              detector_mean_positions_y))))
+        #
+        # An epoch is differenced again if its registration, the
+        # reference or the eigen-kernels it uses have changed, and its
+        # photometry is redone if, in addition, the PSF or the photometry
+        # parameters have changed.  Photometry alone is redone from the
+        # stored difference image.
+        #
+        differenced = {}
+        photometered = {}
+
+        def add_work(f, upstream):
+            outputs = [params.loc_output + os.path.sep + prefix + f.name
+                       for prefix in ('d_', 'm_', 'n_', 'z_')]
+            if params.do_photometry or params.kernel_basis_size:
+                outputs.append(params.loc_output + os.path.sep + 'k_' +
+                               f.name)
+            differenced[f.name] = manifest.work(
+                'difference', f.name, params, upstream=upstream,
+                outputs=outputs)
+            if params.do_photometry:
+                photometered[f.name] = manifest.work(
+                    'photometry', f.name, params,
+                    upstream=[differenced[f.name], psf_work],
+                    outputs=[os.path.join(
+                        LS.lightcurve_store_path(params.loc_output),
+                        'flux.npy')], cached=False)
 
-        else:
+        #
+        # With eigen-kernels, a few training epochs spanning the range of
+        # seeing are differenced first in the full basis, and the other
+        # epochs in the basis learned from their kernels
+        #
+        training = []
+        basis_work = None
+        basis_file = params.loc_output + os.path.sep + 'kernel_basis.fits'
+        if params.kernel_basis_size:
+            training = kernel_basis_training_images(files, params)
+            for f in training:
+                add_work(f, [registered[f.name], reference_work])
+            basis_work = manifest.work(
+                'kernel_basis', reference, params,
+                upstream=[differenced[f.name] for f in training],
+                outputs=[basis_file])
+        for f in files:
+            if f.name not in differenced:
+                add_work(f, [registered[f.name], reference_work] +
+                         [w for w in [basis_work] if w])
+        stale = [f for f in files if not
+                 (manifest.is_current(differenced[f.name]))]
+        stale_photometry = [f for f in files if f not in stale and
+                            f.name in photometered and not
+                            (manifest.is_current(photometered[f.name]))]
+        print(len(files) - len(stale), 'images already differenced,',
+              len(stale_photometry), 'of them need photometry')
+
+        def record(f, result):
+            manifest.record(differenced[f.name])
+            if f.name in photometered:
+                manifest.record(photometered[f.name])
 
-            for f in files:
-                process_image(f, (ref, params, stamp_positions, star_positions,
-                                  star_group_boundaries, star_unsort_index,
-                                  detector_mean_positions_x,
-                                  detector_mean_positions_y))
+        #
+        # Process the epochs worst seeing first, any training epochs for
+        # the eigen-kernels before the others.  Worker processes get the
+        # reference and star arrays in shared memory; worker threads use
+        # them directly
+        #
+        args = (ref, params, stamp_positions, star_positions,
+                star_group_boundaries, star_unsort_index,
+                detector_mean_positions_x, detector_mean_positions_y, None)
+        n_parallel = 1
+        threads = params.parallel_mode == 'thread'
+        if not (params.use_GPU) and (params.n_parallel > 1):
+            n_parallel = params.n_parallel
+            if not threads:
+                if params.storage_policy != 'memory':
+                    ref.persist()
+                args = DS.share(args)
+        TS.run_tasks(photometry_image_shared, stale_photometry,
+                     n_parallel=n_parallel,
+                     initializer=install_worker_args, initargs=(args,),
+                     cost=lambda f: f.fw, failed=lambda r: not r,
+                     retries=params.task_retries, timeout=params.task_timeout,
+                     name='photometry', threads=threads,
+                     done=lambda f, r: manifest.record(photometered[f.name]))
+
+        def difference_images(stale, args):
+            TS.run_tasks(process_image_shared, stale, n_parallel=n_parallel,
+                         initializer=install_worker_args, initargs=(args,),
+                         cost=lambda f: f.fw, failed=lambda r: not r,
+                         retries=params.task_retries,
+                         timeout=params.task_timeout,
+                         name='difference images', threads=threads,
+                         done=record)
+
+        if basis_work:
+            difference_images([f for f in stale if f in training], args)
+            stale = [f for f in stale if f not in training]
+            if manifest.is_current(basis_work):
+                kernel_basis = IM.KernelBasis(
+                    *IO.read_kernel_basis(basis_file))
+            else:
+                kernel_basis = make_kernel_basis(
+                    [f for f in training if
+                     manifest.is_current(differenced[f.name])], params,
+                    basis_file)
+                if kernel_basis is not None:
+                    manifest.record(basis_work)
+            manifest.save()
+            args = args[:-1] + (kernel_basis,)
+        difference_images(stale, args)
+        manifest.save()
 
     return files
 
@@ -731,14 +1226,7 @@ def do_photometry(params, extname='newflux', star_file='star_positions',
     #
     # Determine our list of files
     #
-    all_files = os.listdir(params.loc_data)
-    all_files.sort()
-    files = []
-    for f in all_files:
-        if fnmatch.fnmatch(f, params.name_pattern):
-            g = DS.Observation(params.loc_data + os.path.sep + f, params)
-            if g.fw > 0.0:
-                files.append(g)
+    files = scan_images(params)
 
     ref = DS.Observation(params.loc_output + os.path.sep + reference_image,
                          params)
@@ -26,18 +26,23 @@ import cuda_interface_functions as CI
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import copy
 import sys
 import os
 import time
-import fnmatch
 import itertools
-from multiprocessing import Pool
 
 import numpy as np
 import data_structures as DS
 import io_functions as IO
 import image_functions as IM
 import photometry_functions as PH
+import lightcurve_store as LS
+import epoch_catalogue as EC
+import task_scheduler as TS
+import run_manifest as RM
+import product_cache as PC
+import DIA_CPU
 
 import c_interface_functions as CIF
 
@@ -45,7 +50,8 @@ import c_interface_functions as CIF
 def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
                      star_positions=None, star_group_boundaries=None,
                      detector_mean_positions_x=None,
-                     detector_mean_positions_y=None, star_sky=None):
+                     detector_mean_positions_y=None, star_sky=None,
+                     kernel_basis=None):
     from scipy.linalg import lu_solve, lu_factor, LinAlgError
 
     start = time.time()
@@ -69,11 +75,19 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
     # smask = compute_saturated_pixel_mask(target.image,kernelRadius,params)
 
     #
-    # Define the kernel basis functions
+    # Define the kernel basis functions.  Given eigen-kernels, the kernel
+    # is solved in their basis and expanded over their kernel pixels
     #
     print
     'Defining kernel pixels', time.time() - start
-    if params.use_fft_kernel_pixels:
+    Q = None
+    if kernel_basis is not None:
+        print('Computing eigen-kernel images ' + str(time.time() - start))
+        kernelIndex = kernel_basis.kernel_index
+        extendedBasis = kernel_basis.extended_basis
+        kernelRadius = kernel_basis.radius
+        Q = IM.eigen_kernel_images(ref.image, ref.blur, kernel_basis)
+    elif params.use_fft_kernel_pixels:
         kernelIndex, extendedBasis = IM.define_kernel_pixels_fft(ref, target,
                                                                  kernelRadius + 2,
                                                                  INNER_RADIUS=20,
@@ -89,6 +103,12 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
     bmask = np.ones(smask.shape, dtype=bool)
 
     g = DS.EmptyBase()
+    g.kernel_radius = kernelRadius
+
+    c_previous = None
+    chi2_previous = None
+    clipping = False
+    g.iterations = 0
 
     for iteration in range(params.iterations):
 
@@ -100,13 +120,18 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
         #
         # Compute the matrix and vector
         #
-        H, V, texref = CI.compute_matrix_and_vector_cuda(ref.image, ref.blur,
-                                                         target.image,
-                                                         target.inv_variance,
-                                                         tmask, kernelIndex,
-                                                         extendedBasis,
-                                                         kernelRadius, params,
-                                                         stamp_positions=stamp_positions)
+        if Q is None:
+            H, V, texref = CI.compute_matrix_and_vector_cuda(ref.image, ref.blur,
+                                                             target.image,
+                                                             target.inv_variance,
+                                                             tmask, kernelIndex,
+                                                             extendedBasis,
+                                                             kernelRadius, params,
+                                                             stamp_positions=stamp_positions)
+        else:
+            H, V = IM.compute_compact_matrix_and_vector(
+                ref.image, Q, target.image, target.inv_variance, tmask,
+                kernelRadius, params, stamp_positions=stamp_positions)
 
         #
         # Solve the matrix equation to find the kernel coefficients
@@ -134,8 +159,13 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
         #
         print
         'Computing model', time.time() - start
-        g.model = CI.compute_model_cuda(ref.image.shape, texref, c,
-                                        kernelIndex, extendedBasis, params)
+        if Q is None:
+            g.model = CI.compute_model_cuda(ref.image.shape, texref, c,
+                                            kernelIndex, extendedBasis,
+                                            params)
+        else:
+            g.model = IM.compute_compact_model(ref.image, Q, c, params)
+            c = IM.expand_compact_coefficients(c, kernel_basis, params)
 
         #
         # Compute the difference image
@@ -143,6 +173,28 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
         difference = (target.image - g.model)
         g.norm = difference * np.sqrt(target.inv_variance)
 
+        #
+        # An epoch that the eigen-kernels fit much worse than the epochs
+        # they were learned from is solved again in the full basis.  The
+        # fit is compared over the pixels it used, away from the edges
+        #
+        if iteration == 0:
+            r = int(kernelRadius)
+            fitted = tmask[r:-r, r:-r] != 0
+            g.chi2 = np.sum(g.norm[r:-r, r:-r][fitted] ** 2) / max(
+                1, np.sum(fitted))
+            if Q is not None and g.chi2 > params.kernel_basis_tolerance * \
+                    kernel_basis.chi2:
+                print('Eigen-kernel chi^2 per pixel ' + str(g.chi2) +
+                      ' for ' + target.name + ', using the full basis')
+                return difference_image(
+                    ref, target, params, stamp_positions=stamp_positions,
+                    psf_image=psf_image, star_positions=star_positions,
+                    star_group_boundaries=star_group_boundaries,
+                    detector_mean_positions_x=detector_mean_positions_x,
+                    detector_mean_positions_y=detector_mean_positions_y,
+                    star_sky=star_sky)
+
         #
         # Recompute the variance image from the model
         #
@@ -153,14 +205,31 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
             target.inv_variance[mp] = 1.e-12
 
         #
-        # Mask pixels that disagree with the model
+        # Mask pixels that disagree with the model.  This starts with the
+        # fourth iteration or, if a convergence tolerance is set, as soon
+        # as the kernel has converged, which then also requires the set
+        # of rejected pixels to be stable
         #
-        if iteration > 2:
-            bmask = IM.kappa_clip(smask, g.norm,
-                                  params.pixel_rejection_threshold)
+        chi2 = np.sum(g.norm[tmask != 0] ** 2)
+        converged = params.kernel_tolerance and IM.kernel_converged(
+            c, c_previous, chi2, chi2_previous, params.kernel_tolerance)
+        c_previous, chi2_previous = c, chi2
+        if iteration > 2 or converged:
+            clipping = True
+        mask_changed = False
+        if clipping:
+            clipped = IM.kappa_clip(smask, g.norm,
+                                    params.pixel_rejection_threshold)
+            mask_changed = np.any(clipped != bmask)
+            bmask = clipped
+        g.iterations = iteration + 1
 
         print
         'Iteration', iteration, 'completed', time.time() - start
+        if converged and not mask_changed:
+            print('Kernel converged after ' + str(g.iterations) +
+                  ' iterations')
+            break
 
     #
     # Delete the target image array to save memory
@@ -168,12 +237,14 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
     del target.image
 
     #
-    # Save the kernel coefficients to a file
+    # Save the kernel coefficients to a file, for the photometry and for
+    # learning eigen-kernels
     #
-    if params.do_photometry and psf_image:
+    if psf_image and (params.do_photometry or params.kernel_basis_size):
         kf = params.loc_output + os.path.sep + 'k_' + os.path.basename(
             target.name)
-        IO.write_kernel_table(kf, kernelIndex, extendedBasis, c, params)
+        IO.write_kernel_table(kf, kernelIndex, extendedBasis, c, params,
+                              chi2=g.chi2)
 
     g.norm = difference * np.sqrt(target.inv_variance)
     g.variance = 1.0 / target.inv_variance
@@ -229,110 +300,70 @@ def difference_image(ref, target, params, stamp_positions=None, psf_image=None,
 
 
 def process_reference_image(f, args):
+    #
+    # Match one frame to the best-seeing reference frame, write its model
+    # and return only the statistics needed to select it for the reference
+    #
     best_seeing_ref, params, stamp_positions = args
     result = difference_image(f, best_seeing_ref, params,
                               stamp_positions=stamp_positions)
-    del f.image
-    del f.mask
-    del f.inv_variance
-    return result
+    f.release()
+    summary = DS.EmptyBase()
+    summary.ok = isinstance(result.diff, np.ndarray)
+    if summary.ok:
+        summary.diff_std = np.std(result.diff)
+        summary.model_median = np.median(result.model)
+        IO.write_image(result.model,
+                       params.loc_output + os.path.sep + 'mr_' + f.name)
+    return summary
+
 
+#
+# Arguments common to every task of a Pool, installed in each worker by an
+# initializer with their arrays in shared memory, so that tasks only carry
+# their own Observation.  Each task gets its own copy of the parameters,
+# so that tasks running as threads never share them, and retried tasks use
+# fallback parameters.
+#
+_worker_args = None
 
-def process_reference_image_helper(args):
-    return process_reference_image(*args)
 
+def install_worker_args(args):
+    global _worker_args
+    _worker_args = DS.unshare(args)
 
-def make_reference(files, params, reference_image='ref.fits'):
-    seeing = {}
-    sky = {}
-    ref_seeing = 1000
 
-    #
-    # Have we specified the files to make the reference with?
-    #
-    if params.ref_include_file:
+def fallback_parameters(params):
+    """Simpler kernel configuration for retrying an epoch that failed."""
+    fallback = copy.copy(params)
+    fallback.sdeg = params.pdeg
+    fallback.use_fft_kernel_pixels = False
+    fallback.kernel_basis_size = None
+    return fallback
 
-        ref_list = []
-        for line in open(params.ref_include_file, 'r'):
-            for f in files:
-                if f.name == line.split()[0]:
-                    ref_list.append(f)
-                    print
-                    f.name, f.fw, f.signal
-                    if f.fw < ref_seeing:
-                        ref_sky = f.sky
-                        ref_seeing = f.fw
-                        best_seeing_ref = f
 
+def worker_args(attempt):
+    args = list(_worker_args)
+    if attempt == 0:
+        args[1] = copy.copy(args[1])
     else:
+        args[1] = fallback_parameters(args[1])
+    return tuple(args)
 
-        #
-        # We try to choose the best images
-        #
-        reference_exclude = []
-        if params.ref_exclude_file:
-            for line in open(params.ref_exclude_file, 'r'):
-                reference_exclude.append(line.split()[0])
 
-        sig = []
-        for f in files:
-            sig.append(f.signal)
+def process_reference_image_shared(f, attempt=0):
+    return process_reference_image(f, worker_args(attempt))
 
-        sig = np.asarray(sig)
-        sigcut = np.mean(sig) - 2.0 * np.std(sig)
-        print
-        'signal: mean, std, cut = ', np.mean(sig), np.std(sig), sigcut
 
-        print
-        'Searching for best-seeing image'
-        for f in files:
-            print
-            f.name, f.fw, f.sky, f.signal
-            if (f.fw < ref_seeing) and (
-                    f.fw > params.reference_min_seeing) and (
-                    f.roundness < params.reference_max_roundness) and (
-                    f.signal > sigcut) and not (f.name in reference_exclude):
-                ref_sky = f.sky
-                ref_seeing = f.fw
-                best_seeing_ref = f
-
-        ref_list = []
-        while len(ref_list) < params.min_ref_images:
-            ref_list = []
-            print
-            'Reference FWHM = ', ref_seeing
-            print
-            'Cutoff FWHM for reference = ', params.reference_seeing_factor * ref_seeing
-            print
-            'Combining for reference:'
-            for f in files:
-                if (f.fw < params.reference_seeing_factor * ref_seeing) and (
-                        f.roundness < params.reference_max_roundness) and (
-                        f.sky < params.reference_sky_factor * ref_sky) and (
-                        f.fw > params.reference_min_seeing) and (
-                        f.signal > sigcut) and not (
-                        f.name in reference_exclude):
-                    ref_list.append(f)
-                    print
-                    f.name, f.fw, f.sky, f.signal
-            params.reference_seeing_factor *= 1.02
-
-        sig = []
-        for f in ref_list:
-            sig.append(f.signal)
-        sig = np.asarray(sig)
-        sigcut = np.mean(sig) - 2 * np.std(sig)
-        print
-        'signal: mean, std, cut = ', np.mean(sig), np.std(sig), sigcut
+def process_image_shared(f, attempt=0):
+    return process_image(f, worker_args(attempt))
+
 
-        ref_seeing = 1000
-        ref_roundness = 2.0
-        for f in ref_list:
-            if (f.fw < ref_seeing) and (f.signal > sigcut):
-                ref_sky = f.sky
-                ref_seeing = f.fw
-                ref_roundness = f.roundness
-                best_seeing_ref = f
+def make_reference(files, params, reference_image='ref.fits',
+                   selection=None):
+    if selection is None:
+        selection = DIA_CPU.select_reference_images(files, params)
+    ref_list, best_seeing_ref = selection
 
     #
     # Which ref image has the worst seeing?
@@ -370,30 +401,37 @@ def make_reference(files, params, reference_image='ref.fits'):
     good_ref_list = []
 
     for f in ref_list:
-        f.blur = IM.boxcar_blur(f.image)
         good_ref_list.append(f)
         print
         'difference_image:', f.name, best_seeing_ref.name
 
+    #
+    # Match every frame to the best-seeing frame, worst seeing first.  In
+    # parallel, the arrays of the best-seeing frame that every worker needs
+    # are loaded first, so that they are shared rather than read by each
+    # worker
+    #
+    args = (best_seeing_ref, params, stamp_positions)
+    n_parallel = 1
     if not (params.use_GPU) and (params.n_parallel > 1):
-
-        #
-        # Use ParallelProcessing to process images in the reference list
-        #
-
-        pool = Pool(params.n_parallel)
-        results = pool.map(process_reference_image_helper,
-                           itertools.izip(ref_list, itertools.repeat(
-                               (best_seeing_ref, params, stamp_positions))))
-
-        for i, f in enumerate(ref_list):
-            f.result = results[i]
-
-    else:
-
-        for f in ref_list:
-            f.result = process_reference_image(f, (
-            best_seeing_ref, params, stamp_positions))
+        n_parallel = params.n_parallel
+        for attribute in ('image', 'mask', 'inv_variance'):
+            getattr(best_seeing_ref, attribute)
+        args = DS.share(args)
+    results = TS.run_tasks(process_reference_image_shared, ref_list,
+                           n_parallel=n_parallel,
+                           initializer=install_worker_args, initargs=(args,),
+                           cost=lambda f: f.fw, failed=lambda r: not r.ok,
+                           retries=params.task_retries,
+                           timeout=params.task_timeout,
+                           name='reference frames')
+    if n_parallel > 1:
+        best_seeing_ref.release()
+    for f, result in zip(ref_list, results):
+        if result is None:
+            result = DS.EmptyBase()
+            result.ok = False
+        f.result = result
 
     #
     # Remove bad reference models
@@ -401,7 +439,7 @@ def make_reference(files, params, reference_image='ref.fits'):
 
     rlist = [g for g in good_ref_list]
     for g in rlist:
-        if not (isinstance(g.result.diff, np.ndarray)):
+        if not g.result.ok:
             print
             'removing', g.name
             good_ref_list.remove(g)
@@ -420,36 +458,39 @@ def make_reference(files, params, reference_image='ref.fits'):
         sd = np.zeros(len(good_ref_list))
         for i, g in enumerate(good_ref_list):
             print
-            g.name, g.result.diff
-            sd[i] = np.std(g.result.diff)
+            g.name, g.result.diff_std
+            sd[i] = g.result.diff_std
         sds = sd.std()
         sdm = sd.mean()
         rlist = [g for g in good_ref_list]
         for g in rlist:
-            if np.std(g.result.diff) > (sdm + 2.5 * sds):
+            if g.result.diff_std > (sdm + 2.5 * sds):
                 print
                 'removing', g.name
                 good_ref_list.remove(g)
 
     #
-    # Combine the good reference models
+    # Combine the good reference models, streaming them from their mr_
+    # files, and remove the models of the frames that were rejected
     #
-    g = good_ref_list[0]
-    gstack = np.zeros(
-        [len(good_ref_list), g.result.model.shape[0], g.result.model.shape[1]])
-    mask = np.ones_like(g.result.model)
+    mask = None
     print
     'final reference list'
-    for i, g in enumerate(good_ref_list):
-        if isinstance(g.result.model, np.ndarray):
-            print
-            g.name, np.std(g.result.diff), np.median(g.result.model)
-            IO.write_image(g.result.model,
-                           params.loc_output + os.path.sep + 'mr_' + g.name)
-            gstack[i, :, :] = g.result.model
-            mask *= g.mask
-    rr = np.median(gstack, axis=0)
+    for g in good_ref_list:
+        print
+        g.name, g.result.diff_std, g.result.model_median
+        if mask is None:
+            mask = np.ones(g.mask.shape)
+        mask *= g.mask
+        g.release('mask')
+    rr = IO.median_combine_images(
+        [params.loc_output + os.path.sep + 'mr_' + g.name
+         for g in good_ref_list])
     IO.write_image(rr, params.loc_output + os.path.sep + reference_image)
+    for f in ref_list:
+        model_file = params.loc_output + os.path.sep + 'mr_' + f.name
+        if f not in good_ref_list and os.path.exists(model_file):
+            os.remove(model_file)
     IO.write_image(mask,
                    params.loc_output + os.path.sep + 'mask_' + reference_image)
 
@@ -460,55 +501,66 @@ def make_reference(files, params, reference_image='ref.fits'):
 
 
 def process_image(f, args):
-    ref, params, stamp_positions, star_positions, star_group_boundaries, star_unsort_index, detector_mean_positions_x, detector_mean_positions_y = args
-    dtarget = params.loc_output + os.path.sep + 'd_' + f.name
-    if not (os.path.exists(dtarget)):
-
-        #
-        # Compute difference image
-        #
-        result = difference_image(ref, f, params,
-                                  stamp_positions=stamp_positions,
-                                  psf_image=params.loc_output + os.path.sep + 'psf.fits',
-                                  star_positions=star_positions,
-                                  star_group_boundaries=star_group_boundaries,
-                                  detector_mean_positions_x=detector_mean_positions_x,
-                                  detector_mean_positions_y=detector_mean_positions_y)
-        del f.image
-        del f.mask
-        del f.inv_variance
-
-        #
-        # Save photometry to a file
-        #
-        if isinstance(result.flux, np.ndarray):
-            if not (params.use_GPU):
-                print
-                'ungrouping fluxes'
-                result.flux = result.flux[star_unsort_index].copy()
-                result.dflux = result.dflux[star_unsort_index].copy()
-            np.savetxt(params.loc_output + os.path.sep + f.name + '.flux',
-                       np.vstack((result.flux, result.dflux)).T)
-            f.flux = result.flux.copy()
-            f.dflux = result.dflux.copy()
+    ref, params, stamp_positions, star_positions, star_group_boundaries, star_unsort_index, detector_mean_positions_x, detector_mean_positions_y, kernel_basis = args
+    ok = True
 
-        #
-        # Save output images to files
-        #
-        if isinstance(result.diff, np.ndarray):
-            IO.write_image(result.diff,
-                           params.loc_output + os.path.sep + 'd_' + f.name)
-            IO.write_image(result.model,
-                           params.loc_output + os.path.sep + 'm_' + f.name)
-            IO.write_image(result.norm,
-                           params.loc_output + os.path.sep + 'n_' + f.name)
-            IO.write_image(result.mask,
-                           params.loc_output + os.path.sep + 'z_' + f.name)
-    return 0
+    #
+    # Compute difference image
+    #
+    result = difference_image(ref, f, params,
+                              stamp_positions=stamp_positions,
+                              psf_image=params.loc_output + os.path.sep + 'psf.fits',
+                              star_positions=star_positions,
+                              star_group_boundaries=star_group_boundaries,
+                              detector_mean_positions_x=detector_mean_positions_x,
+                              detector_mean_positions_y=detector_mean_positions_y,
+                              kernel_basis=kernel_basis if
+                              params.kernel_basis_size else None)
+    f.release()
 
+    #
+    # Save photometry to the light-curve store
+    #
+    if isinstance(result.flux, np.ndarray):
+        if not (params.use_GPU):
+            print
+            'ungrouping fluxes'
+            result.flux = result.flux[star_unsort_index].copy()
+            result.dflux = result.dflux[star_unsort_index].copy()
+        store = LS.LightcurveStore(
+            LS.lightcurve_store_path(params.loc_output), mode='r+')
+        store.write(f.name, result.flux, result.dflux)
+        f.flux = result.flux.copy()
+        f.dflux = result.dflux.copy()
+
+    #
+    # Save output images to files
+    #
+    catalogue = EC.EpochCatalogue(params.loc_output)
+    if isinstance(result.diff, np.ndarray):
+        IO.write_image(result.diff,
+                       params.loc_output + os.path.sep + 'd_' + f.name)
+        IO.write_image(result.model,
+                       params.loc_output + os.path.sep + 'm_' + f.name)
+        IO.write_image(result.norm,
+                       params.loc_output + os.path.sep + 'n_' + f.name)
+        IO.write_image(result.mask,
+                       params.loc_output + os.path.sep + 'z_' + f.name)
+        catalogue.update(f.name, kernel_radius=float(result.kernel_radius),
+                         iterations=result.iterations,
+                         status='differenced')
+    else:
+        catalogue.update(f.name, status='failed')
+        ok = False
 
-def process_image_helper(args):
-    return process_image(*args)
+    #
+    # An epoch whose photometry was requested but failed is not done, so
+    # that it is retried, and redone on a rerun
+    #
+    if params.do_photometry and not (isinstance(result.flux, np.ndarray)):
+        print('Photometry failed for ' + f.name)
+        ok = False
+    return ok
 
 
 def imsub_all_fits(params, reference='ref.fits'):
@@ -537,21 +589,17 @@ def imsub_all_fits(params, reference='ref.fits'):
         par, getattr(params, par)
     print
 
+    #
+    # Each stage below redoes only the work that the run manifest does not
+    # record as done with the same inputs and parameters
+    #
+    manifest = RM.RunManifest(params.loc_output,
+                              PC.open_product_cache(params))
+
     #
     # Determine our list of images
     #
-    all_files = os.listdir(params.loc_data)
-    all_files.sort()
-    files = []
-    for f in all_files:
-        if fnmatch.fnmatch(f, params.name_pattern):
-            g = DS.Observation(params.loc_data + os.path.sep + f, params)
-            del g.data
-            del g.mask
-            if g.fw > 0.0:
-                files.append(g)
-            print
-            g.name
+    files = DIA_CPU.scan_images(params, manifest)
 
     if len(files) < 3:
         print
@@ -560,6 +608,10 @@ def imsub_all_fits(params, reference='ref.fits'):
         'Exiting'
         sys.exit(0)
 
+    catalogue = EC.EpochCatalogue(params.loc_output)
+    catalogue.write_seeing_file(params.loc_output + os.path.sep + 'seeing',
+                                names=[f.name for f in files])
+
     #
     # Have we specified a registration template?
     #
@@ -578,51 +630,70 @@ def imsub_all_fits(params, reference='ref.fits'):
     #
     # Register images
     #
+    template = manifest.work('register', 'template', params,
+                             inputs=[reg.fullname],
+                             upstream=[w for w in
+                                       [manifest.get('ingest', reg.name)] if w])
+    registered = {}
+    stale = []
     for f in files:
         if f == reg:
-            f.image = f.data
-            rf = params.loc_output + os.path.sep + 'r_' + f.name
-            IO.write_image(f.image, rf)
+            #
+            # The template is its own registered image, which is cheap to
+            # remake
+            #
+            registered[f.name] = template
+            stale.append(f)
+            continue
+        registered[f.name] = manifest.work(
+            'register', f.name, params, inputs=[f.fullname],
+            upstream=[template, manifest.get('ingest', f.name)],
+            outputs=f.product_files())
+        if manifest.is_current(registered[f.name]):
+            f.set_registered()
         else:
-            f.register(reg, params)
-            # delete image arrays to save memory
-            del f.image
-            del f.mask
-            del f.inv_variance
-        del reg.data
-        del reg.image
-        del reg.mask
-        del reg.inv_variance
+            stale.append(f)
+    print(str(len(files) - len(stale)) + ' images already registered')
+    DIA_CPU.register_all_images(
+        stale, reg, params,
+        done=lambda f: manifest.record(registered[f.name]))
+    manifest.save()
 
     #
     # Write image names and dates to a file
     #
     if params.image_list_file:
-        try:
-            with open(params.loc_output + os.path.sep + params.image_list_file,
-                      'w') as fid:
-                for f in files:
-                    date = None
-                    if params.datekey:
-                        date = IO.get_date(
-                            params.loc_data + os.path.sep + f.name,
-                            key=params.datekey) - 2450000
-                    if date:
-                        fid.write(f.name + '   %10.5f\n' % date)
-                    else:
-                        fid.write(f.name)
-        except:
-            raise
-
-    #
-    # Make the photometric reference image if we don't have it.
+        if params.datekey:
+            for f in files:
+                catalogue.get_date(params.loc_data + os.path.sep + f.name,
+                                   key=params.datekey)
+        catalogue.write_image_list_file(
+            params.loc_output + os.path.sep + params.image_list_file,
+            names=[f.name for f in files])
+
+    #
+    # Make the photometric reference image if we don't have it, or if the
+    # frames selected for it have changed: epochs that have been added
+    # only matter if they are selected.
     # Find stamp positions if required.
     #
-    if not (os.path.exists(params.loc_output + os.path.sep + reference)):
-        print
-        'Reg = ', reg.name
+    stamp_file = params.loc_output + os.path.sep + 'stamp_positions'
+    selection = DIA_CPU.select_reference_images(files, params)
+    reference_work = manifest.work(
+        'reference', reference, params,
+        inputs=[params.ref_include_file, params.ref_exclude_file],
+        upstream=[template] + [registered[f.name] for f in selection[0]],
+        outputs=[params.loc_output + os.path.sep + reference,
+                 params.loc_output + os.path.sep + 'mask_' + reference])
+    if not (manifest.is_current(reference_work, adopt=True)):
+        print('Reg = ' + reg.name)
+        if os.path.exists(stamp_file):
+            os.remove(stamp_file)
         stamp_positions = make_reference(files, params,
-                                         reference_image=reference)
+                                         reference_image=reference,
+                                         selection=selection)
+        manifest.record(reference_work)
+        manifest.save()
         ref = DS.Observation(params.loc_output + os.path.sep + reference,
                              params)
         mask, _ = IO.read_fits_file(
@@ -642,13 +713,12 @@ def imsub_all_fits(params, reference='ref.fits'):
         ref.register(reg, params)
         stamp_positions = None
         if params.use_stamps:
-            stamp_file = params.loc_output + os.path.sep + 'stamp_positions'
             if os.path.exists(stamp_file):
                 stamp_positions = np.genfromtxt(stamp_file)
             else:
                 stars = PF.choose_stamps(ref, params)
                 stamp_positions = stars[:, 0:2]
-                np.savetxt(stamp_file, stamp_positions)
+                IO.write_table(stamp_file, stamp_positions)
 
     pm = params.pixel_max
     params.pixel_max *= 0.9
@@ -662,19 +732,25 @@ def imsub_all_fits(params, reference='ref.fits'):
     # Detect stars and compute the PSF if we are doing photometry
     #
     star_positions = None
+    psf_work = None
     sky = 0.0
     if params.do_photometry:
         star_file = params.loc_output + os.path.sep + 'star_positions'
         psf_file = params.loc_output + os.path.sep + 'psf.fits'
-        if not (os.path.exists(psf_file)) or not (os.path.exists(star_file)):
+        psf_work = manifest.work(
+            'psf', reference, params,
+            inputs=[params.star_file, params.star_reference_image],
+            upstream=[reference_work], outputs=[psf_file, star_file])
+        if not (manifest.is_current(psf_work, adopt=True)):
             stars = PH.compute_psf_image(params, ref, psf_image=psf_file)
             star_positions = stars[:, 0:2]
             star_sky = stars[:, 4]
-        if os.path.exists(star_file):
-            star_positions = np.genfromtxt(star_file)
-            star_sky = star_positions[:, 0] * 0.0;
+            IO.write_table(star_file, star_positions)
+            manifest.record(psf_work)
+            manifest.save()
         else:
-            np.savetxt(star_file, star_positions)
+            star_positions = np.genfromtxt(star_file)
+            star_sky = star_positions[:, 0] * 0.0
 
     print
     'sky =', sky
@@ -719,7 +795,10 @@ def imsub_all_fits(params, reference='ref.fits'):
     #
     if params.do_photometry:
         ref_flux_file = params.loc_output + os.path.sep + 'ref.flux'
-        if not (os.path.exists(ref_flux_file)):
+        photometry_work = manifest.work('reference_photometry', reference,
+                                        params, upstream=[psf_work],
+                                        outputs=[ref_flux_file])
+        if not (manifest.is_current(photometry_work, adopt=True)):
             result = difference_image(ref, ref, params,
                                       stamp_positions=stamp_positions,
                                       psf_image=psf_file,
@@ -733,8 +812,27 @@ def imsub_all_fits(params, reference='ref.fits'):
                 'ungrouping fluxes'
                 result.flux = result.flux[star_unsort_index].copy()
                 result.dflux = result.dflux[star_unsort_index].copy()
-                np.savetxt(ref_flux_file,
-                           np.vstack((result.flux, result.dflux)).T)
+                IO.write_table(ref_flux_file,
+                               np.vstack((result.flux, result.dflux)).T)
+                manifest.record(photometry_work)
+                manifest.save()
+
+    #
+    # Allocate light-curve store rows for every epoch
+    #
+    if params.do_photometry and params.make_difference_images:
+        store = LS.open_lightcurve_store(params.loc_output,
+                                         star_positions.shape[0],
+                                         [f.name for f in files])
+        for f in files:
+            date = None
+            if params.datekey:
+                date = catalogue.get_date(
+                    params.loc_data + os.path.sep + f.name,
+                    key=params.datekey) - 2450000
+            store.set_metadata(f.name, date=date, fw=f.fw, sky=f.sky,
+                               signal=f.signal)
+        del store
 
     #
     # Process images
@@ -742,26 +840,106 @@ def imsub_all_fits(params, reference='ref.fits'):
 
     if params.make_difference_images:
 
-        if not (params.use_GPU) and (params.n_parallel > 1):
-
-            pool = Pool(params.n_parallel)
-            pool.map(process_image_helper, itertools.izip(files,
-                                                          itertools.repeat((
-                                                          ref, params,
-                                                          stamp_positions,
-                                                          star_positions,
-                                                          star_group_boundaries,
-                                                          star_unsort_index,
-                                                          detector_mean_positions_x,
-                                                          detector_mean_positions_y))))
+        #
+        # An epoch is redone if its registration, the reference or the
+        # eigen-kernels it uses have changed, or, for its photometry, the
+        # PSF or the photometry parameters
+        #
+        differenced = {}
+        photometered = {}
+
+        def add_work(f, upstream):
+            outputs = [params.loc_output + os.path.sep + prefix + f.name
+                       for prefix in ('d_', 'm_', 'n_', 'z_')]
+            if params.do_photometry or params.kernel_basis_size:
+                outputs.append(params.loc_output + os.path.sep + 'k_' +
+                               f.name)
+            differenced[f.name] = manifest.work(
+                'difference', f.name, params, upstream=upstream,
+                outputs=outputs)
+            if params.do_photometry:
+                photometered[f.name] = manifest.work(
+                    'photometry', f.name, params,
+                    upstream=[differenced[f.name], psf_work],
+                    outputs=[os.path.join(
+                        LS.lightcurve_store_path(params.loc_output),
+                        'flux.npy')], cached=False)
 
-        else:
+        #
+        # With eigen-kernels, a few training epochs spanning the range of
+        # seeing are differenced first in the full basis, and the other
+        # epochs in the basis learned from their kernels
+        #
+        training = []
+        basis_work = None
+        basis_file = params.loc_output + os.path.sep + 'kernel_basis.fits'
+        if params.kernel_basis_size:
+            training = DIA_CPU.kernel_basis_training_images(files, params)
+            for f in training:
+                add_work(f, [registered[f.name], reference_work])
+            basis_work = manifest.work(
+                'kernel_basis', reference, params,
+                upstream=[differenced[f.name] for f in training],
+                outputs=[basis_file])
+        for f in files:
+            if f.name not in differenced:
+                add_work(f, [registered[f.name], reference_work] +
+                         [w for w in [basis_work] if w])
+        stale = [f for f in files if not
+                 (manifest.is_current(differenced[f.name])) or
+                 (f.name in photometered and not
+                  (manifest.is_current(photometered[f.name])))]
+        print(str(len(files) - len(stale)) + ' images already differenced')
+
+        def record(f, result):
+            manifest.record(differenced[f.name])
+            if f.name in photometered:
+                manifest.record(photometered[f.name])
 
-            for f in files:
-                process_image(f, (ref, params, stamp_positions, star_positions,
-                                  star_group_boundaries, star_unsort_index,
-                                  detector_mean_positions_x,
-                                  detector_mean_positions_y))
+        #
+        # Process the epochs worst seeing first, any training epochs for
+        # the eigen-kernels before the others.  Worker processes get the
+        # reference and star arrays in shared memory; worker threads use
+        # them directly
+        #
+        args = (ref, params, stamp_positions, star_positions,
+                star_group_boundaries, star_unsort_index,
+                detector_mean_positions_x, detector_mean_positions_y, None)
+        n_parallel = 1
+        threads = params.parallel_mode == 'thread'
+        if not (params.use_GPU) and (params.n_parallel > 1):
+            n_parallel = params.n_parallel
+            if not threads:
+                if params.storage_policy != 'memory':
+                    ref.persist()
+                args = DS.share(args)
+
+        def difference_images(stale, args):
+            TS.run_tasks(process_image_shared, stale, n_parallel=n_parallel,
+                         initializer=install_worker_args, initargs=(args,),
+                         cost=lambda f: f.fw, failed=lambda r: not r,
+                         retries=params.task_retries,
+                         timeout=params.task_timeout,
+                         name='difference images', threads=threads,
+                         done=record)
+
+        if basis_work:
+            difference_images([f for f in stale if f in training], args)
+            stale = [f for f in stale if f not in training]
+            if manifest.is_current(basis_work):
+                kernel_basis = IM.KernelBasis(
+                    *IO.read_kernel_basis(basis_file))
+            else:
+                kernel_basis = DIA_CPU.make_kernel_basis(
+                    [f for f in training if
+                     manifest.is_current(differenced[f.name])], params,
+                    basis_file)
+                if kernel_basis is not None:
+                    manifest.record(basis_work)
+            manifest.save()
+            args = args[:-1] + (kernel_basis,)
+        difference_images(stale, args)
+        manifest.save()
 
     return files
 
@@ -772,14 +950,7 @@ def do_photometry(params, extname='newflux', star_file='star_positions',
     #
     # Determine our list of files
     #
-    all_files = os.listdir(params.loc_data)
-    all_files.sort()
-    files = []
-    for f in all_files:
-        if fnmatch.fnmatch(f, params.name_pattern):
-            g = DS.Observation(params.loc_data + os.path.sep + f, params)
-            if g.fw > 0.0:
-                files.append(g)
+    files = DIA_CPU.scan_images(params)
 
     ref = DS.Observation(params.loc_output + os.path.sep + reference_image,
                          params)
@@ -4,5 +4,9 @@ __all__ = ["run_pydia", "DIA_CPU", "DIA_GPU", "KMT", "photometry_functions",
            "image_functions", "analysis_functions", 'c_interface_functions',
            'calibration_functions', 'conftest', 'cuda_functions_dp',
            'cuda_functions_sp', 'cuda_interface_functions', 'data_structures',
-           'detect', 'io_functions', 'c_functions_dp']
+           'detect', 'io_functions', 'c_functions_dp', 'lightcurve_store',
+           'epoch_catalogue', 'memory_manager',
+           'registration_functions', 'background_functions',
+           'polynomial_basis', 'task_scheduler', 'run_manifest',
+           'product_cache', 'difference_session']
 import run_pydia
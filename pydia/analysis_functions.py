@@ -12,6 +12,9 @@ from scipy.signal import spectral
 from scipy import sparse
 
 from data_structures import Observation
+from lightcurve_store import LightcurveStore, lightcurve_store_path, \
+    have_lightcurve_store
+from epoch_catalogue import EpochCatalogue, CATALOGUE_FILE
 from io_functions import *
 from photometry_functions import *
 from astropy.stats import mad_std
@@ -25,7 +28,45 @@ def find_star_at(xpos, ypos, folder):
     return np.where(dist2 == np.min(dist2))[0][0]
 
 
+def flux_to_mag(ref_flux, flux, eflux, ZP=25.0):
+    mag = ZP - 2.5 * np.log10(ref_flux + flux)
+    emag = mag - ZP + 2.5 * np.log10(ref_flux + flux + eflux)
+    return mag, emag
+
+
+def written_epochs(store):
+    """Rows of the light-curve store whose photometry has been written, in
+    date order."""
+    epochs = store.epochs
+    rows = np.where(epochs['written'] == 1)[0]
+    return rows[np.argsort(epochs['date'][rows], kind='mergesort')]
+
+
+def read_star_lightcurve(folder, star, ZP=25.0):
+    """Returns dates, flux, eflux, mag, emag for a single star from the
+    light-curve store, reading only that star's column."""
+    store = LightcurveStore(lightcurve_store_path(folder))
+    rf = np.loadtxt(os.path.join(folder, 'ref.flux.calibrated'))
+    rows = written_epochs(store)
+    flux, eflux = store.star(star)
+    flux = flux[rows]
+    eflux = eflux[rows]
+    mag, emag = flux_to_mag(rf[star, 0], flux, eflux, ZP=ZP)
+    return np.array(store.epochs['date'][rows]), flux, eflux, mag, emag
+
+
 def readflux(folder, images_file='images', seeing_file='seeing', ZP=25.0):
+    if have_lightcurve_store(folder):
+        store = LightcurveStore(lightcurve_store_path(folder))
+        rf = np.loadtxt(os.path.join(folder, 'ref.flux.calibrated'))
+        rows = written_epochs(store)
+        epochs = store.epochs[rows]
+        flux = np.array(store.flux[rows])
+        eflux = np.array(store.dflux[rows])
+        mag, emag = flux_to_mag(rf[:, 0], flux, eflux, ZP=ZP)
+        return np.array(epochs['date']), flux, eflux, mag, emag, np.array(
+            epochs['fw']), np.array(epochs['sky']), np.array(epochs['signal'])
+
     fnames = []
     datelist = []
     fwhmlist = []
@@ -44,19 +85,29 @@ def readflux(folder, images_file='images', seeing_file='seeing', ZP=25.0):
                     f, d = line.split()
                     fnames.append(f)
                     datelist.append(d)
-        with open(os.path.join(folder, seeing_file), 'r') as fid:
-            file = fid.read()
-            for i, line in enumerate(file.split('\n')):
-                if len(line) > 0 and i < len(fnames):
-                    n, f, b, s = line.split()
-                    if n == fnames[i]:
-                        fwhmlist.append(f)
-                        bgndlist.append(b)
-                        siglist.append(s)
-                    else:
-                        print
-                        'Mismatch between images and seeing files.'
-                        sys.exit(0)
+        if os.path.exists(os.path.join(folder, CATALOGUE_FILE)):
+            records = EpochCatalogue(folder).records(fnames)
+            if len(records) != len(fnames):
+                print('Images missing from the epoch catalogue.')
+                sys.exit(0)
+            for r in records:
+                fwhmlist.append(r['fw'])
+                bgndlist.append(r['sky'])
+                siglist.append(r['signal'])
+        else:
+            with open(os.path.join(folder, seeing_file), 'r') as fid:
+                file = fid.read()
+                for i, line in enumerate(file.split('\n')):
+                    if len(line) > 0 and i < len(fnames):
+                        n, f, r, b, s = line.split()
+                        if n == fnames[i]:
+                            fwhmlist.append(f)
+                            bgndlist.append(b)
+                            siglist.append(s)
+                        else:
+                            print
+                            'Mismatch between images and seeing files.'
+                            sys.exit(0)
         dates = np.asarray(datelist, dtype=np.float64)
         fwhm = np.asarray(fwhmlist, dtype=np.float64)
         bgnd = np.asarray(bgndlist, dtype=np.float64)
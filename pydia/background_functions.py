@@ -0,0 +1,105 @@
+from __future__ import print_function
+import numpy as np
+
+import polynomial_basis as PB
+
+#
+# Sky background estimation.
+#
+# Statistics are computed from strided subsamples of bounded size, so the
+# cost per frame is roughly independent of the detector size.  The sky
+# model is a polynomial in x (rows) and y (columns) with terms x**i * y**j
+# for i + j <= degree, evaluated with polynomial_basis.
+#
+
+MAX_SAMPLES = 2 ** 20
+MAX_CELL_SAMPLES = 2 ** 14
+
+
+def subsample(image, max_samples):
+    """Strided view of image with at most about max_samples pixels."""
+    step = int(np.ceil(np.sqrt(image.size / float(max_samples))))
+    return image[::step, ::step]
+
+
+def sigma_clipped_median(values, nsigma=3.0, iterations=5):
+    """Median of values after iterative rejection of points more than nsigma
+    robust standard deviations from it."""
+    values = values.ravel()
+    median = np.median(values)
+    for i in range(iterations):
+        sigma = 1.4826 * np.median(np.abs(values - median))
+        if sigma == 0.0:
+            break
+        keep = np.abs(values - median) < nsigma * sigma
+        if np.all(keep):
+            break
+        values = values[keep]
+        median = np.median(values)
+    return median
+
+
+def mesh_background(image, mesh, pixel_min):
+    """Sigma-clipped median sky of a mesh x mesh grid of cells, with the
+    normalised coordinates of the cell centres."""
+    ni, mi = image.shape
+    edges_i = np.linspace(0, ni, mesh + 1).astype(int)
+    edges_j = np.linspace(0, mi, mesh + 1).astype(int)
+    x = []
+    y = []
+    z = []
+    for i in range(mesh):
+        for j in range(mesh):
+            cell = subsample(image[edges_i[i]:edges_i[i + 1],
+                                   edges_j[j]:edges_j[j + 1]],
+                             MAX_CELL_SAMPLES)
+            cell = cell[cell > pixel_min]
+            if cell.size == 0:
+                continue
+            z.append(sigma_clipped_median(cell))
+            x.append((0.5 * (edges_i[i] + edges_i[i + 1]) -
+                      0.5 * (ni - 1)) / (ni - 1))
+            y.append((0.5 * (edges_j[j] + edges_j[j + 1]) -
+                      0.5 * (mi - 1)) / (mi - 1))
+    return np.array(x), np.array(y), np.array(z)
+
+
+def fit_surface(x, y, z, degree):
+    """Least-squares coefficients C[i, j] of sum C[i, j] * x**i * y**j."""
+    terms = [(i, j) for i in range(degree + 1) for j in range(degree + 1 - i)]
+    A = np.column_stack([x ** i * y ** j for i, j in terms])
+    c = np.linalg.lstsq(A, z, rcond=-1)[0]
+    C = np.zeros((degree + 1, degree + 1))
+    for (i, j), value in zip(terms, c):
+        C[i, j] = value
+    return C
+
+
+def subtract_sky(image, params, out=None):
+    """Subtract the sky from image, writing the result to out (which may
+    be image itself) if given."""
+    if out is None:
+        out = image.copy()
+    elif out is not image:
+        out[...] = image
+    if params.sky_subtract_mode == 'percent':
+        sample = subsample(image, MAX_SAMPLES)
+        if params.pixel_min > 0.1:
+            sample = sample[sample > params.pixel_min]
+        const = np.percentile(sample, params.sky_subtract_percent)
+        out -= const
+        print('subtracting sky, constant =', const)
+        return out
+    x, y, z = mesh_background(image, params.sky_mesh, params.pixel_min)
+    degree = params.sky_degree
+    while degree > 0 and (degree + 1) * (degree + 2) // 2 > z.size:
+        degree -= 1
+    if z.size == 0:
+        print('No sky pixels found in subtract_sky')
+        return out
+    C = fit_surface(x, y, z, degree)
+    print('sky coeffs = ', C)
+    sky = PB.surface(C, image.shape)
+    np.maximum(sky, 0.0, out=sky)
+    out -= sky
+    return out
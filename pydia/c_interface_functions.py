@@ -2,6 +2,7 @@ import numpy as np
 import fnmatch
 import io_functions as IO
 import image_functions as IM
+import epoch_catalogue as EC
 
 from scipy.sparse import csr_matrix, csc_matrix
 from scipy.sparse import linalg as sp_linalg
@@ -694,6 +695,7 @@ def photom_variable_star(x0, y0, params, patch_half_width=15, converge=True,
     coeffs = np.arange(0, dtype=np.float64)
 
     filenames.sort()
+    catalogue = EC.EpochCatalogue(params.loc_output)
 
     if not converge:
         locate_iterations = 1
@@ -727,8 +729,9 @@ def photom_variable_star(x0, y0, params, patch_half_width=15, converge=True,
             kindex_ext = np.hstack((kindex_ext, extendedBasis))
             n_kernel[i] = kernelIndex.shape[0]
             n_coeffs[i] = c.shape[0]
-            dates[i] = IO.get_date(params.loc_data + os.path.sep + basename,
-                                   key=params.datekey) - 2450000
+            dates[i] = catalogue.get_date(
+                params.loc_data + os.path.sep + basename,
+                key=params.datekey) - 2450000
             seeing[i], roundness[i], bgnd[i], signal[i] = IM.compute_fwhm(f,
                                                                           params,
                                                                           width=20,
@@ -1,8 +1,13 @@
 from __future__ import print_function
+import copy
+import functools
 import os
+import threading
 import numpy as np
 import image_functions as IM
 import io_functions as IO
+import epoch_catalogue as EC
+import memory_manager as MM
 
 
 #
@@ -12,9 +17,34 @@ import io_functions as IO
 class EmptyBase(object): pass
 
 
+PRODUCT_PREFIX = {'image': 'r_', 'mask': 'sm_', 'inv_variance': 'iv_'}
+
+STORAGE_POLICIES = ('memory', 'spill', 'persist')
+
+ARRAY_ATTRIBUTES = ('data', 'image', 'mask', 'inv_variance', 'blur')
+
+RECORD_ATTRIBUTES = ('shape', 'date', 'exptime', 'filter', 'data_median',
+                     'fw', 'roundness', 'sky', 'signal')
+
+
+def _locked(method):
+    #
+    # Run an Observation method holding its lock, so that threads sharing
+    # the observation, and the array cache evicting on their behalf, see
+    # its arrays loaded, held and released as a whole
+    #
+    @functools.wraps(method)
+    def locked(self, *args):
+        with self._lock:
+            return method(self, *args)
+
+    return locked
+
+
 class Observation(object):
     """Container for all observation attributes"""
 
+    @_locked
     def get_data(self):
         if not (isinstance(self._data, np.ndarray)):
             self._data, _ = IO.read_fits_file(self.fullname)
@@ -23,105 +53,365 @@ class Observation(object):
                                                self._preconvolve_FWHM)
             self.data_median = np.median(self._data)
             self.shape = self._data.shape
+        self._hold('data')
         return self._data
 
+    @_locked
     def set_data(self, value):
         self._data = value
+        self._shared.discard('data')
+        self._data_modified = True
+        self._hold('data')
 
+    @_locked
     def del_data(self):
-        self._data = None
+        self._drop('data')
+        self._data_modified = False
 
     data = property(get_data, set_data, del_data)
 
+    #
+    # Intermediate products (registered image, mask and inverse variance)
+    # are written to loc_output according to params.storage_policy:
+    #   'persist'  write every time the product is assigned
+    #   'spill'    write a modified product only when it is released
+    #   'memory'   never write; released products that are not on disk
+    #              are kept in memory
+    #
+
+    def _product_file(self, product):
+        return os.path.join(self.output_dir, PRODUCT_PREFIX[product] +
+                            self.name)
+
+    def _load_product(self, product):
+        data, _ = IO.read_fits_file(self._product_file(product))
+        return data
+
+    def _store_product(self, product, value):
+        setattr(self, '_' + product, value)
+        self._shared.discard(product)
+        self._dirty.add(product)
+        self._hold(product)
+        if self._storage_policy == 'persist':
+            self.persist(product)
+
+    def _release_product(self, product):
+        if product in self._dirty:
+            if self._storage_policy == 'memory':
+                return
+            self.persist(product)
+        self._drop(product)
+
+    #
+    # Arrays are accounted for in the memory-budgeted cache of this
+    # process, which calls evict() to free the least recently used ones.
+    # Views of arrays in shared memory, installed by unshare(), cost the
+    # worker nothing and are never evicted.
+    #
+
+    def _hold(self, attribute):
+        if attribute in self._shared:
+            return
+        MM.get_cache(self._params).touch(self, attribute)
+
+    def _drop(self, attribute):
+        MM.get_cache(self._params).forget(self, attribute)
+        MM.remove_spill(getattr(self, '_' + attribute))
+        setattr(self, '_' + attribute, None)
+        self._shared.discard(attribute)
+
+    def evict(self, attribute):
+        """Free one array at the request of the array cache. Returns False
+        if it has to stay in memory, or is in use by another thread."""
+        if not (self._lock.acquire(False)):
+            return False
+        try:
+            return self._evict(attribute)
+        finally:
+            self._lock.release()
+
+    def _evict(self, attribute):
+        value = getattr(self, '_' + attribute)
+        if not (isinstance(value, np.ndarray)):
+            return True
+        if self._params.scratch_dir:
+            setattr(self, '_' + attribute,
+                    MM.spill(value, self._params.scratch_dir,
+                             attribute + '_' + self.name))
+            return True
+        if attribute in self._dirty:
+            if self._storage_policy == 'memory':
+                return False
+            self.persist(attribute)
+        elif attribute == 'data' and self._data_modified:
+            return False
+        self._drop(attribute)
+        return True
+
+    @_locked
+    def release(self, *attributes):
+        """Release image arrays (all of them if none are named), writing
+        modified products according to the storage policy."""
+        for attribute in attributes or ARRAY_ATTRIBUTES:
+            delattr(self, attribute)
+
+    @_locked
+    def persist(self, *products):
+        """Write modified products (all of them if none are named) to
+        loc_output, whatever the storage policy."""
+        for product in products or tuple(self._dirty):
+            value = getattr(self, '_' + product)
+            if product in self._dirty and isinstance(value, np.ndarray):
+                IO.write_image(value, self._product_file(product))
+                self._dirty.discard(product)
+                self._saved.add(product)
+
+    def product_files(self):
+        """Files in loc_output that hold the registered products."""
+        return [self._product_file(p) for p in sorted(PRODUCT_PREFIX)]
+
+    @_locked
     def get_image(self):
         if not (isinstance(self._image, np.ndarray)):
-            image_name = os.path.join(self.output_dir, 'r_' + self.name)
-            self._image, _ = IO.read_fits_file(image_name)
+            self._image = self._load_product('image')
+        self._hold('image')
         return self._image
 
+    @_locked
     def set_image(self, value):
-        self._image = value
-        image_name = os.path.join(self.output_dir, 'r_' + self.name)
-        IO.write_image(self._image, image_name)
+        self._store_product('image', value)
 
+    @_locked
     def del_image(self):
-        self._image = None
+        self._release_product('image')
 
     image = property(get_image, set_image, del_image)
 
+    @_locked
     def get_mask(self):
         if not (isinstance(self._mask, np.ndarray)):
-            mask_name = os.path.join(self.output_dir, 'sm_' + self.name)
-            self._mask, _ = IO.read_fits_file(mask_name)
+            if self._registered or 'mask' in self._saved:
+                self._mask = self._load_product('mask')
+            else:
+                self._mask = self.compute_mask()
+        self._hold('mask')
         return self._mask
 
+    @_locked
     def set_mask(self, value):
-        self._mask = value
-        mask_name = os.path.join(self.output_dir, 'sm_' + self.name)
-        IO.write_image(self._mask, mask_name)
+        self._store_product('mask', value)
 
+    @_locked
     def del_mask(self):
-        self._mask = None
+        self._release_product('mask')
 
     mask = property(get_mask, set_mask, del_mask)
 
+    @_locked
     def get_inv_variance(self):
         if not (isinstance(self._inv_variance, np.ndarray)):
-            inv_variance_name = os.path.join(self.output_dir,
-                                             'sm_' + self.name)
-            self._inv_variance, _ = IO.read_fits_file(inv_variance_name)
+            if self._registered or 'inv_variance' in self._saved:
+                self._inv_variance = self._load_product('inv_variance')
+            else:
+                self._inv_variance = self.compute_inv_variance()
+        self._hold('inv_variance')
         return self._inv_variance
 
+    @_locked
     def set_inv_variance(self, value):
-        self._inv_variance = value
-        inv_variance_name = os.path.join(self.output_dir, 'iv_' + self.name)
-        IO.write_image(self._inv_variance, inv_variance_name)
+        self._store_product('inv_variance', value)
 
+    @_locked
     def del_inv_variance(self):
-        self._inv_variance = None
+        self._release_product('inv_variance')
 
     inv_variance = property(get_inv_variance, set_inv_variance,
                             del_inv_variance)
 
-    def __init__(self, filename, params):
+    @_locked
+    def get_blur(self):
+        if not (isinstance(self._blur, np.ndarray)):
+            self._blur = IM.boxcar_blur(self.image)
+        self._hold('blur')
+        return self._blur
+
+    @_locked
+    def set_blur(self, value):
+        self._blur = value
+        self._shared.discard('blur')
+        self._hold('blur')
+
+    @_locked
+    def del_blur(self):
+        self._drop('blur')
+
+    blur = property(get_blur, set_blur, del_blur)
+
+    def compute_mask(self):
+        return IM.compute_saturated_pixel_mask(self.data, 5,
+                                               self._params) * IM.compute_bleed_mask(
+            self.data, 3, self._params)
+
+    def compute_inv_variance(self):
+        return 1.0 / (self.data / self._params.gain + (
+                self._params.readnoise / self._params.gain) ** 2) + self.mask
+
+    def __init__(self, filename, params, lazy=False, record=None):
         self.fullname = filename
         self.name = os.path.basename(filename)
         self.output_dir = params.loc_output
+        self._params = params
+        self._lock = threading.RLock()
         self._data = None
         self._image = None
         self._mask = None
+        self._inv_variance = None
+        self._blur = None
+        self._data_modified = False
+        self._registered = False
+        self._dirty = set()
+        self._saved = set()
+        self._shared = set()
+        if params.storage_policy not in STORAGE_POLICIES:
+            raise ValueError('Unknown storage policy ' +
+                             str(params.storage_policy))
+        self._storage_policy = params.storage_policy
         self._preconvolve_images = False
         if params.preconvolve_images:
             self._preconvolve_images = True
             self._preconvolve_FWHM = params.preconvolve_FWHM
-        self.mask = IM.compute_saturated_pixel_mask(self.data, 5,
-                                                    params) * IM.compute_bleed_mask(
-            self.data, 3, params)
-        self.inv_variance = 1.0 / (self.data / params.gain + (
-                    params.readnoise / params.gain) ** 2) + self.mask
+        if record is not None:
+            self.__dict__.update(record)
+            return
+        if lazy and self.scan_header(params):
+            return
+        self._mask = self.compute_mask()
+        EC.EpochCatalogue(self.output_dir).update(self.name,
+                                                  median=float(
+                                                      self.data_median))
         if params.subtract_sky:
-            self.data = IM.subtract_sky(self.data, params)
+            self.data = IM.subtract_sky(self.data, params, out=self.data)
         self.fw, self.roundness, self.sky, self.signal = -1.0, -1.0, -1.0, -1.0
         if params.pixel_min < self.data_median < 0.5 * params.pixel_max:
             self.fw, self.roundness, self.sky, self.signal = IM.compute_fwhm(
                 self, params,
                 seeing_file=params.loc_output + os.path.sep + 'seeing')
-        del self.mask
-        del self.inv_variance
+        self._drop('mask')
+
+    def scan_header(self, params):
+        """Set up the observation from its FITS header and the epoch
+        catalogue without reading any pixels. Returns False if the
+        catalogue has no seeing measurement for this image, in which case
+        the full pixel-based initialisation is needed."""
+        header = IO.read_fits_header(self.fullname)
+        self.shape = (header['NAXIS2'], header['NAXIS1'])
+        catalogue = EC.EpochCatalogue(self.output_dir)
+        record = catalogue.get(self.name)
+        if record is None or record['date'] is None:
+            fields = {}
+            for column, key in (('date', params.datekey),
+                                ('exptime', params.exptimekey),
+                                ('filter', params.filterkey)):
+                if key and key in header:
+                    fields[column] = header[key]
+            catalogue.update(self.name, **fields)
+            record = catalogue.get(self.name)
+        self.date = record['date']
+        self.exptime = record['exptime']
+        self.filter = record['filter']
+        if record['median'] is None:
+            return False
+        self.data_median = record['median']
+        self.fw, self.roundness, self.sky, self.signal = -1.0, -1.0, -1.0, -1.0
+        if params.pixel_min < self.data_median < 0.5 * params.pixel_max:
+            if record['fw'] is None:
+                return False
+            self.fw = record['fw']
+            self.roundness = record['roundness']
+            self.sky = record['sky']
+            self.signal = record['signal']
+        return True
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def record(self):
+        """Metadata of the observation, without any pixel arrays, from
+        which an equivalent Observation can be constructed."""
+        return dict((a, getattr(self, a, None)) for a in RECORD_ATTRIBUTES)
+
+    def share(self):
+        """Copy of the observation with its loaded arrays in shared memory,
+        for passing to Pool workers through an initializer.  Workers call
+        unshare() on it."""
+        shared = copy.copy(self)
+        shared._dirty = set(self._dirty)
+        shared._saved = set(self._saved)
+        shared._shared = set()
+        for attribute in ARRAY_ATTRIBUTES:
+            value = getattr(self, '_' + attribute)
+            if isinstance(value, np.ndarray):
+                setattr(shared, '_' + attribute, MM.SharedArray(value))
+        return shared
+
+    def unshare(self):
+        """Replace shared arrays by read-only views of them."""
+        for attribute in ARRAY_ATTRIBUTES:
+            value = getattr(self, '_' + attribute)
+            if isinstance(value, MM.SharedArray):
+                setattr(self, '_' + attribute, value.view())
+                self._shared.add(attribute)
+        return self
+
+    def set_registered(self):
+        """Mark the observation as registered by another process that has
+        written its products to loc_output."""
+        self._registered = True
+        self._saved.update(PRODUCT_PREFIX)
+        self.release()
 
     def register(self, reg, params):
         print(self.name)
-        self._image, self._mask, self._inv_variance = IM.register(reg, self,
-                                                                  params)
-        rf = os.path.join(self.output_dir, 'r_' + self.name)
-        IO.write_image(self._image, rf)
-        rf = os.path.join(self.output_dir, 'sm_' + self.name)
-        IO.write_image(self._mask, rf)
-        rf = os.path.join(self.output_dir, 'iv_' + self.name)
-        IO.write_image(self._inv_variance, rf)
-        del self.mask
-        del self.data
-        del self.inv_variance
+        image, mask, inv_variance, shift = IM.register(reg, self, params,
+                                                       return_shift=True)
+        self._registered = True
+        self.image = image
+        self.mask = mask
+        self.inv_variance = inv_variance
+        EC.EpochCatalogue(self.output_dir).update(self.name,
+                                                  xshift=float(shift[0]),
+                                                  yshift=float(shift[1]),
+                                                  status='registered')
+        self.release('mask', 'data', 'inv_variance')
+
+
+def share(value):
+    """value, or the items of a tuple or list value, with arrays and the
+    arrays of Observations copied into shared memory."""
+    if isinstance(value, (tuple, list)):
+        return type(value)(share(v) for v in value)
+    if isinstance(value, np.ndarray):
+        return MM.SharedArray(value)
+    if isinstance(value, Observation):
+        return value.share()
+    return value
+
+
+def unshare(value):
+    """Inverse of share(), giving read-only views of the shared arrays."""
+    if isinstance(value, (tuple, list)):
+        return type(value)(unshare(v) for v in value)
+    if isinstance(value, MM.SharedArray):
+        return value.view()
+    if isinstance(value, Observation):
+        return value.unshare()
+    return value
 
 
 class Parameters:
@@ -135,28 +425,40 @@ class Parameters:
         self.detect_threshold = 4.0
         self.diff_std_threshold = 10.0
         self.do_photometry = True
+        self.exptimekey = 'EXPTIME'
         self.fft_kernel_threshold = 3.0
+        self.fwhm_method = 'tiles'
         self.fwhm_mult = 6.5
+        self.filterkey = 'FILTER'
         self.fwhm_section = None
+        self.fwhm_tiles = 16
         self.gain = 1.0
         self.image_list_file = 'images'
         self.iterations = 1
+        self.kernel_basis_size = None
+        self.kernel_basis_tolerance = 1.2
+        self.kernel_basis_training = 16
         self.kernel_maximum_radius = 20.0
         self.kernel_minimum_radius = 5.0
+        self.kernel_tolerance = None
         self.loc_data = '.'
         self.loc_output = '.'
         self.make_difference_images = True
         self.mask_cluster = False
+        self.memory_budget = None
         self.min_ref_images = 3
         self.n_parallel = 1
         self.name_pattern = '*.fits'
         self.nstamps = 200
+        self.parallel_mode = 'process'
         self.pdeg = 0
         self.pixel_max = 50000
         self.pixel_min = 0.0
         self.pixel_rejection_threshold = 3.0
         self.preconvolve_images = False
         self.preconvolve_FWHM = 1.5
+        self.product_cache = None
+        self.product_cache_size = 10000
         self.psf_fit_radius = 3.0
         self.psf_profile_type = 'gaussian'
         self.readnoise = 1.0
@@ -167,13 +469,21 @@ class Parameters:
         self.reference_max_roundness = 1.3
         self.reference_seeing_factor = 1.01
         self.reference_sky_factor = 1.3
+        self.registration_bin = 1
+        self.registration_degree = 1
         self.registration_image = None
+        self.registration_mode = 'fft'
+        self.registration_section = None
+        self.registration_stars = 300
+        self.scratch_dir = None
         self.sdeg = 0
         self.sky_degree = 0
+        self.sky_mesh = 5
         self.sky_subtract_mode = 'percent'
         self.sky_subtract_percent = 0.01
         self.stamp_edge_distance = 40
         self.stamp_half_width = 20
+        self.storage_policy = 'spill'
         self.star_detect_sigma = 12
         self.star_file = None
         self.star_file_has_magnitudes = False
@@ -182,6 +492,8 @@ class Parameters:
         self.star_file_transform_degree = 2
         self.star_reference_image = None
         self.subtract_sky = False
+        self.task_retries = 1
+        self.task_timeout = None
         self.use_fft_kernel_pixels = False
         self.use_GPU = True
         self.use_stamps = False
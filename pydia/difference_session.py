@@ -0,0 +1,145 @@
+from __future__ import print_function
+import copy
+import os
+import numpy as np
+
+import data_structures as DS
+import io_functions as IO
+import photometry_functions as PH
+import lightcurve_store as LS
+import epoch_catalogue as EC
+import registration_functions as RF
+import DIA_CPU as DIA
+
+#
+# Long-lived difference imaging of incoming frames.
+#
+# imsub_all_fits prepares a field: the reference image and its mask, the
+# PSF and the star list in loc_output.  A DifferenceSession loads these
+# once, together with everything derived from them (the masked and blurred
+# reference, its registration template, the stamp positions and the
+# grouping of the stars), and then differences one frame at a time in
+# memory, which is what a monitoring program needs to keep up with
+# incoming data:
+#
+#     session = DifferenceSession(params)
+#     result = session.process('frame.fits')
+#     result.diff, result.flux
+#
+# The caches built on the first frame (the spectrum of the reference for
+# FFT kernel pixels, the polynomial bases) are kept for the later ones.
+# Frames are held in memory whatever params.storage_policy; the difference
+# products and photometry are written to loc_output only if persist.
+#
+
+
+class DifferenceSession(object):
+    """Difference imaging of single frames against a prepared reference"""
+
+    def __init__(self, params, reference='ref.fits', persist=False):
+        self.params = copy.copy(params)
+        self.params.storage_policy = 'memory'
+        if self.params.sdeg < self.params.pdeg:
+            self.params.sdeg = self.params.pdeg
+        self.persist = persist
+        self.reference = reference
+        params = self.params
+        prefix = params.loc_output + os.path.sep
+
+        #
+        # Frames are registered to the registration image if one is
+        # given, and otherwise directly to the reference, which is already
+        # on the grid of the template it was made with
+        #
+        if params.registration_image:
+            self.template = DS.Observation(params.registration_image, params)
+        else:
+            self.template = DS.Observation(prefix + reference, params)
+        self.ref = DIA.load_reference(params, reference, self.template)
+        RF.get_template(self.template, params)
+        self.template.release()
+
+        self.stamp_positions = None
+        if params.use_stamps:
+            stamp_file = prefix + 'stamp_positions'
+            if os.path.exists(stamp_file):
+                self.stamp_positions = np.genfromtxt(stamp_file)
+            else:
+                self.stamp_positions = PH.choose_stamps(self.ref, params)[:,
+                                                                         0:2]
+
+        self.psf_file = None
+        self.star_positions = None
+        self.star_group_boundaries = None
+        self.detector_mean_positions_x = None
+        self.detector_mean_positions_y = None
+        self.star_unsort_index = None
+        if params.do_photometry:
+            self.psf_file = prefix + 'psf.fits'
+            star_file = prefix + 'star_positions'
+            for file in (self.psf_file, star_file):
+                if not (os.path.exists(file)):
+                    raise IOError('DifferenceSession needs ' + file +
+                                  ', made by imsub_all_fits')
+            star_positions = np.genfromtxt(star_file)
+            star_sort_index, self.star_group_boundaries, self.detector_mean_positions_x, self.detector_mean_positions_y = PH.group_stars_ccd(
+                params, star_positions, prefix + reference)
+            self.star_positions = star_positions[star_sort_index]
+            self.star_unsort_index = np.argsort(star_sort_index)
+
+    def process(self, frame, persist=None):
+        """Difference a frame, given as a file name or an Observation, with
+        the reference.  Returns the result of DIA_CPU.difference_image, with
+        the fluxes in the order of the star list, or None if the frame has
+        no usable seeing measurement.  The products and photometry are also
+        written to loc_output if persist (by default the session's)."""
+        params = self.params
+        if persist is None:
+            persist = self.persist
+        f = frame
+        if not (isinstance(frame, DS.Observation)):
+            f = DS.Observation(frame, params, lazy=True)
+        if f.fw <= 0.0:
+            print('No seeing measurement for', f.name, '- not processed')
+            return None
+        f.register(self.template, params)
+        result = DIA.difference_image(
+            self.ref, f, params, stamp_positions=self.stamp_positions,
+            psf_image=self.psf_file, star_positions=self.star_positions,
+            star_group_boundaries=self.star_group_boundaries,
+            detector_mean_positions_x=self.detector_mean_positions_x,
+            detector_mean_positions_y=self.detector_mean_positions_y)
+        f.release()
+        result.name = f.name
+        if isinstance(result.flux, np.ndarray):
+            result.flux = result.flux[self.star_unsort_index].copy()
+            result.dflux = result.dflux[self.star_unsort_index].copy()
+        if persist:
+            self.save(f, result)
+        return result
+
+    def save(self, f, result):
+        """Write the products and photometry of a processed frame to
+        loc_output, as imsub_all_fits does."""
+        params = self.params
+        prefix = params.loc_output + os.path.sep
+        catalogue = EC.EpochCatalogue(params.loc_output)
+        if not (isinstance(result.diff, np.ndarray)):
+            catalogue.update(f.name, status='failed')
+            return
+        IO.write_image(result.diff, prefix + 'd_' + f.name)
+        IO.write_image(result.model, prefix + 'm_' + f.name)
+        IO.write_image(result.norm, prefix + 'n_' + f.name)
+        IO.write_image(result.mask, prefix + 'z_' + f.name)
+        catalogue.update(f.name, kernel_radius=float(result.kernel_radius),
+                         iterations=result.iterations, status='differenced')
+        if isinstance(result.flux, np.ndarray):
+            store = LS.open_lightcurve_store(params.loc_output,
+                                             result.flux.shape[0], [f.name])
+            date = None
+            if params.datekey:
+                date = catalogue.get_date(f.fullname,
+                                          key=params.datekey) - 2450000
+            store.set_metadata(f.name, date=date, fw=f.fw, sky=f.sky,
+                               signal=f.signal)
+            store.write(f.name, result.flux, result.dflux)
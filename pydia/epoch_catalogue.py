@@ -0,0 +1,163 @@
+from __future__ import print_function
+import os
+import sqlite3
+
+#
+# Indexed per-field catalogue of epoch metadata.
+#
+# One SQLite database in loc_output holds a row per image with its date,
+# seeing statistics, registration shift, kernel size and product status.
+# Every call opens its own short-lived connection, so the catalogue can be
+# used from Pool workers after a fork; SQLite's locking (with a generous
+# busy timeout and a write-ahead log) serialises concurrent writers.  The
+# legacy 'seeing' and 'images' text files are generated from it.
+#
+
+CATALOGUE_FILE = 'epochs.db'
+
+COLUMNS = (('name', 'TEXT PRIMARY KEY'),
+           ('date', 'REAL'),
+           ('fw', 'REAL'),
+           ('roundness', 'REAL'),
+           ('sky', 'REAL'),
+           ('signal', 'REAL'),
+           ('xshift', 'REAL'),
+           ('yshift', 'REAL'),
+           ('kernel_radius', 'REAL'),
+           ('iterations', 'INTEGER'),
+           ('status', 'TEXT'),
+           ('exptime', 'REAL'),
+           ('filter', 'TEXT'),
+           ('median', 'REAL'))
+
+COLUMN_NAMES = tuple(c[0] for c in COLUMNS)
+
+#
+# Columns filled in from the image itself when it is ingested
+#
+IMAGE_COLUMNS = ('date', 'exptime', 'filter', 'median', 'fw', 'roundness',
+                 'sky', 'signal')
+
+
+class EpochCatalogue(object):
+    """SQLite catalogue of per-epoch metadata for one output directory"""
+
+    def __init__(self, folder, timeout=60.0):
+        self.folder = folder
+        self.file = os.path.join(folder, CATALOGUE_FILE)
+        self.timeout = timeout
+        new = not (os.path.exists(self.file))
+        if not (os.path.exists(folder)):
+            os.makedirs(folder)
+        db = self._connect()
+        try:
+            if new:
+                db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS epochs (' + ', '.join(
+                    n + ' ' + t for n, t in COLUMNS) + ')')
+                #
+                # Add any columns missing from a catalogue made by an
+                # earlier version
+                #
+                have = [row[1] for row in
+                        db.execute('PRAGMA table_info(epochs)').fetchall()]
+                for n, t in COLUMNS:
+                    if n not in have:
+                        db.execute('ALTER TABLE epochs ADD COLUMN ' + n + ' ' +
+                                   t)
+        finally:
+            db.close()
+        if new:
+            self.import_seeing_file(os.path.join(folder, 'seeing'))
+
+    def _connect(self):
+        return sqlite3.connect(self.file, timeout=self.timeout)
+
+    def get(self, name):
+        db = self._connect()
+        try:
+            row = db.execute('SELECT ' + ', '.join(COLUMN_NAMES) +
+                             ' FROM epochs WHERE name = ?',
+                             (name,)).fetchone()
+        finally:
+            db.close()
+        if row is None:
+            return None
+        return dict(zip(COLUMN_NAMES, row))
+
+    def update(self, name, **fields):
+        for key in fields:
+            if key not in COLUMN_NAMES:
+                raise KeyError('Unknown epoch catalogue column ' + key)
+        db = self._connect()
+        try:
+            with db:
+                db.execute('INSERT OR IGNORE INTO epochs (name) VALUES (?)',
+                           (name,))
+                if fields:
+                    keys = sorted(fields)
+                    db.execute('UPDATE epochs SET ' + ', '.join(
+                        k + ' = ?' for k in keys) + ' WHERE name = ?',
+                               [fields[k] for k in keys] + [name])
+        finally:
+            db.close()
+
+    def records(self, names=None):
+        db = self._connect()
+        try:
+            rows = db.execute('SELECT ' + ', '.join(COLUMN_NAMES) +
+                              ' FROM epochs ORDER BY name').fetchall()
+        finally:
+            db.close()
+        records = [dict(zip(COLUMN_NAMES, row)) for row in rows]
+        if names is not None:
+            by_name = dict((r['name'], r) for r in records)
+            records = [by_name[n] for n in names if n in by_name]
+        return records
+
+    def get_date(self, file, key='JD'):
+        """Date of an image, read from its header only the first time."""
+        import io_functions as IO
+        name = os.path.basename(file)
+        record = self.get(name)
+        if record is not None and record['date'] is not None:
+            return record['date']
+        date = IO.get_date(file, key=key)
+        self.update(name, date=date)
+        return date
+
+    def import_seeing_file(self, file):
+        if not (os.path.exists(file)):
+            return
+        db = self._connect()
+        try:
+            with db:
+                for line in open(file, 'r'):
+                    sline = line.split()
+                    if len(sline) < 5:
+                        continue
+                    db.execute('INSERT OR IGNORE INTO epochs (name) '
+                               'VALUES (?)', (sline[0],))
+                    db.execute('UPDATE epochs SET fw = ?, roundness = ?, '
+                               'sky = ?, signal = ? WHERE name = ?',
+                               [float(v) for v in sline[1:5]] + [sline[0]])
+        finally:
+            db.close()
+
+    def write_seeing_file(self, file, names=None):
+        with open(file, 'w') as fid:
+            for r in self.records(names):
+                if r['fw'] is not None:
+                    fid.write(r['name'] + '  ' + str(r['fw']) + '  ' + str(
+                        r['roundness']) + '  ' + str(r['sky']) + '  ' + str(
+                        r['signal']) + '\n')
+
+    def write_image_list_file(self, file, names=None):
+        with open(file, 'w') as fid:
+            for r in self.records(names):
+                if r['date'] is not None:
+                    fid.write(r['name'] + '   %10.5f\n' % (
+                            r['date'] - 2450000))
+                else:
+                    fid.write(r['name'] + '\n')
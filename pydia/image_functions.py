@@ -1,7 +1,31 @@
 import os
 import numpy as np
 from scipy import ndimage
-from scipy.signal import fftconvolve, convolve2d
+from scipy.signal import fftconvolve
+
+import background_functions as BF
+import epoch_catalogue as EC
+import polynomial_basis as PB
+import registration_functions as RF
+
+#
+# Work limits for the sampled seeing estimator
+#
+FWHM_TILE_SIZE = 256
+FWHM_MAX_SAMPLES = 2 ** 20
+
+#
+# Largest central section and minimum zero padding used when selecting
+# kernel pixels from the deconvolved kernel
+#
+FFT_KERNEL_SECTION = 1024
+FFT_KERNEL_PAD = 32
+
+#
+# (key, spectrum) of the last reference, replaced as a whole so that
+# threads never see the key of one reference with the spectrum of another
+#
+_kernel_spectrum = None
 
 
 def positional_shift(R, T):
@@ -21,34 +45,41 @@ def positional_shift(R, T):
     return dx, dy
 
 
-def register(R, T, params):
-    # Tc = T.data*T.mask
-    # Rc = R.data*R.mask
+def register(R, T, params, return_shift=False):
+    #
+    # Find the shift of T relative to R by phase correlation against the
+    # cached spectrum of R, then place T on the pixel grid of R
+    #
+    template = RF.get_template(R, params)
+    if template.stars is not None:
+        #
+        # Star-matching registration resamples T with a polynomial
+        # transform rather than shifting it by whole pixels
+        #
+        coeffs = template.stars.transform(T.data, params)
+        if coeffs is not None:
+            RT, RM, inv_variance, shift = template.stars.resample(T, coeffs,
+                                                                  params)
+            if return_shift:
+                return RT, RM, inv_variance, tuple(shift)
+            return RT, RM, inv_variance
+        print('Star matching failed for ' + T.name +
+              ' - using phase correlation')
     if isinstance(params.fwhm_section, np.ndarray):
         w = params.fwhm_section
-        Tc = T.data[w[2]:w[3], w[0]:w[1]].copy()
-        Rc = R.data[w[2]:w[3], w[0]:w[1]].copy()
+        Tc = T.data[w[2]:w[3], w[0]:w[1]]
     else:
+        w = None
         Tc = T.data
+    if template.stars is not None:
         Rc = R.data
-    nx, ny = R.shape
-    # z = np.arange(-3,4)
-    # saturated_pixels = np.where(R.mask==0)
-    # for k in range(saturated_pixels[0].size):
-    #    p = np.array([z+saturated_pixels[0][k],z+saturated_pixels[1][k]])
-    #    px, py = np.meshgrid(p[0],p[1])
-    #    q = np.where((px>=0) & (px<R.data.shape[0]) & (py>=0) & (py<R.data.shape[1]))
-    #    Rc[saturated_pixels[0][k],saturated_pixels[1][k]]= np.median(R.data[px[q],py[q]])
-    # saturated_pixels = np.where(T.mask==0)
-    # for k in range(saturated_pixels[0].size):
-    #    p = np.array([z+saturated_pixels[0][k],z+saturated_pixels[1][k]])
-    #    px, py = np.meshgrid(p[0],p[1])
-    #    q = np.where((px>=0) & (px<R.data.shape[0]) & (py>=0) & (py<R.data.shape[1]))
-    #    Tc[saturated_pixels[0][k],saturated_pixels[1][k]]= np.median(T.data[px[q],py[q]])
-    c = fftconvolve(Rc, Tc[::-1, ::-1])
-    cind = np.where(c == np.max(c))
-    xshift = cind[0][0] - Rc.shape[0] + 1
-    yshift = cind[1][0] - Rc.shape[1] + 1
+        if w is not None:
+            Rc = Rc[w[2]:w[3], w[0]:w[1]]
+        shift = RF.PhaseCorrelator(Rc).shift(Tc)
+    else:
+        shift = template.shift(Tc)
+    xshift = int(round(shift[0]))
+    yshift = int(round(shift[1]))
     imint = max(0, -xshift)
     imaxt = min(R.shape[0], R.shape[0] - xshift)
     jmint = max(0, -yshift)
@@ -65,88 +96,77 @@ def register(R, T, params):
                 params.readnoise / params.gain) ** 2) + mask * 1.0
     RM = np.zeros(R.shape, dtype=bool)
     RM[iminr:imaxr, jminr:jmaxr] = T.mask[imint:imaxt, jmint:jmaxt]
+    if return_shift:
+        return RT, RM, inv_variance, (xshift, yshift)
     return RT, RM, inv_variance
 
 
+def disk_dilation(bad, radius):
+    """Pixels within radius of a bad pixel, i.e. the union over bad pixels
+    of the offsets (x, y) with x*x + y*y < radius*radius.  A few bad
+    pixels are scattered directly; otherwise the disk is built from one
+    horizontal running maximum per row offset, so that neither the time
+    nor the memory grows with the number of bad pixels."""
+    rad = int(np.ceil(radius))
+    rad2 = radius * radius
+    z = np.arange(2 * rad + 1) - rad
+    disk = np.where(z[:, np.newaxis] ** 2 + z[np.newaxis, :] ** 2 < rad2)
+    bad_pixels = np.nonzero(bad)
+    dilated = np.zeros(bad.shape, dtype=bool)
+    if bad_pixels[0].size * disk[0].size < bad.size // 8:
+        q0 = (bad_pixels[0][:, np.newaxis] + z[disk[0]]).ravel()
+        q1 = (bad_pixels[1][:, np.newaxis] + z[disk[1]]).ravel()
+        s = (q0 >= 0) & (q0 < bad.shape[0]) & (q1 >= 0) & (q1 < bad.shape[1])
+        dilated[q0[s], q1[s]] = True
+        return dilated
+    bad = bad.astype(np.uint8)
+    rows = {}
+    n = bad.shape[0]
+    for dy in range(-rad, rad + 1):
+        if dy * dy >= rad2:
+            continue
+        w = int(np.sqrt(rad2 - dy * dy))
+        while w * w + dy * dy >= rad2:
+            w -= 1
+        while (w + 1) * (w + 1) + dy * dy < rad2:
+            w += 1
+        if w not in rows:
+            rows[w] = ndimage.maximum_filter1d(bad, 2 * w + 1, axis=1,
+                                               mode='constant', cval=0) > 0
+        if abs(dy) >= n:
+            continue
+        if dy >= 0:
+            dilated[dy:] |= rows[w][:n - dy]
+        else:
+            dilated[:dy] |= rows[w][-dy:]
+    return dilated
+
+
 def compute_bleed_mask(d, radius, params):
     print
     'Computing bleed mask'
-    kernel = np.array([[-1, -1, -1, -1, -1, -1, -1, -1, -1, -1],
-                       [2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                       [-1, -1, -1, -1, -1, -1, -1, -1, -1, -1]])
-    rad2 = radius * radius
-    mask = np.ones_like(d, dtype=bool)
-    dc = convolve2d(d, kernel.T, mode='same')
-    rad = int(np.ceil(radius))
-    z = np.arange(2 * rad + 1) - rad
-    x, y = np.meshgrid(z, z)
-    p = np.array(np.where(x ** 2 + y ** 2 < rad2))
-    bad_pixels = np.where(np.abs(dc) > 1.1 * params.pixel_max)
-    zp0 = z[p[0]]
-    zp1 = z[p[1]]
-    sp0 = bad_pixels[0][:, np.newaxis]
-    sp1 = bad_pixels[1][:, np.newaxis]
-    q0 = zp0 + sp0
-    q1 = zp1 + sp1
-    q0 = q0.flatten()
-    q1 = q1.flatten()
-    s = np.asarray(np.where(
-        (q0 >= 0) & (q0 < d.shape[0]) & (q1 >= 0) & (q1 < d.shape[1])))[0]
-    mask[q0[s], q1[s]] = 0
-    for i in range(mask.shape[1]):
-        if np.sum(mask[:, i]) < 0.85 * mask.shape[0]:
-            mask[:, i] = 0
+    #
+    # Separable form of convolve2d(d, kernel.T, mode='same') with kernel
+    # [[-1]*10, [2]*10, [-1]*10]
+    #
+    dc = ndimage.convolve1d(d, np.ones(10), axis=0, mode='constant',
+                            origin=-1)
+    dc = ndimage.convolve1d(dc, np.array([-1.0, 2.0, -1.0]), axis=1,
+                            mode='constant')
+    mask = ~disk_dilation(np.abs(dc) > 1.1 * params.pixel_max, radius)
+    mask[:, np.sum(mask, axis=0) < 0.85 * mask.shape[0]] = 0
     return mask
 
 
 def compute_saturated_pixel_mask(im, radius, params):
-    rad2 = radius * radius
-    rad = int(np.ceil(radius))
-    z = np.arange(2 * rad + 1) - rad
-    x, y = np.meshgrid(z, z)
-    p = np.array(np.where(x ** 2 + y ** 2 < rad2))
-    mask = np.ones(im.shape, dtype=bool)
-    saturated_pixels = np.where(
-        (im > params.pixel_max) | (im <= params.pixel_min))
-    zp0 = z[p[0]]
-    zp1 = z[p[1]]
-    sp0 = saturated_pixels[0][:, np.newaxis]
-    sp1 = saturated_pixels[1][:, np.newaxis]
-    q0 = zp0 + sp0
-    q1 = zp1 + sp1
-    q0 = q0.flatten()
-    q1 = q1.flatten()
-    #    q = np.array([[],[]])
-    #    for k in range(saturated_pixels[0].size):
-    #        q = np.column_stack([q,np.array([zp0+saturated_pixels[0][k],
-    #                                         zp1+saturated_pixels[1][k]])])
-    #        q1.append([r for r in zp0+saturated_pixels[0][k]])
-    #        q2.append([r for r in zp1+saturated_pixels[1][k]])
-    #    q = np.array([np.array(q1).flatten(),np.array(q2).flatten()])
-    s = np.asarray(np.where(
-        (q0 >= 0) & (q0 < im.shape[0]) & (q1 >= 0) & (q1 < im.shape[1])))[0]
-    mask[q0[s], q1[s]] = 0
-    return mask
+    return ~disk_dilation((im > params.pixel_max) | (im <= params.pixel_min),
+                          radius)
 
 
 def compute_saturated_pixel_mask_2(im1, im2, radius, params):
-    rad2 = radius * radius
-    rad = int(np.ceil(radius))
-    z = np.arange(2 * rad + 1) - rad
-    x, y = np.meshgrid(z, z)
-    p = np.array(np.where(x ** 2 + y ** 2 < rad2))
-    mask = np.ones(im1.shape, dtype=bool)
-    saturated_pixels = np.where(
+    return ~disk_dilation(
         (im1 > params.pixel_max) | (im1 <= params.pixel_min) | (
-                    im2 > params.pixel_max) | (im2 <= params.pixel_min))
-    for k in range(saturated_pixels[0].size):
-        q = np.array([z[p[0]] + saturated_pixels[0][k],
-                      z[p[1]] + saturated_pixels[1][k]])
-        s = np.asarray(np.where(
-            (q[0] >= 0) & (q[0] < im1.shape[0]) & (q[1] >= 0) & (
-                        q[1] < im1.shape[1])))[0]
-        mask[q[0, s], q[1, s]] = 0
-    return mask
+                im2 > params.pixel_max) | (im2 <= params.pixel_min), radius)
 
 
 def cosmic_ray_clean(data, params):
@@ -158,6 +178,19 @@ def cosmic_ray_clean(data, params):
     return c.cleanarray
 
 
+def kernel_converged(c, c_previous, chi2, chi2_previous, tolerance):
+    """Whether successive kernel solutions agree to within a relative
+    tolerance in both their coefficients and chi^2."""
+    if c_previous is None or c.shape != c_previous.shape:
+        return False
+    dc = np.linalg.norm(c - c_previous) / max(np.linalg.norm(c_previous),
+                                              1.e-30)
+    dchi2 = abs(chi2_previous - chi2) / max(chi2, 1.e-30)
+    print('relative change in coefficients ' + str(dc) + ', chi2 ' +
+          str(dchi2))
+    return dc < tolerance and dchi2 < tolerance
+
+
 def kappa_clip(mask, norm, threshold):
     not_finished = True
     bmask = np.ones(norm.shape, dtype=bool)
@@ -177,75 +210,87 @@ def kappa_clip(mask, norm, threshold):
     return bmask
 
 
-def boxcar_blur(im):
-    d = np.zeros(im.shape)
+def boxcar_blur(im, out=None):
+    """3x3 boxcar mean of im, with a zero border, computed as two separable
+    3-point sums.  The result is written to out if given."""
     m1 = im.shape[0] - 2
     m2 = im.shape[1] - 2
-    for i in range(3):
-        for j in range(3):
-            d[1:m1 + 1, 1:m2 + 1] += im[i:i + m1, j:j + m2]
+    if out is None:
+        out = np.zeros(im.shape)
+    else:
+        out[0, :] = 0.0
+        out[-1, :] = 0.0
+        out[:, 0] = 0.0
+        out[:, -1] = 0.0
+    rows = im[0:m1] + im[1:m1 + 1]
+    rows += im[2:m1 + 2]
+    d = out[1:m1 + 1, 1:m2 + 1]
+    np.add(rows[:, 0:m2], rows[:, 1:m2 + 1], out=d)
+    d += rows[:, 2:m2 + 2]
     d /= 9.0
-    return d
+    return out
 
 
-def convolve_undersample(im):
-    from scipy.ndimage.filters import convolve
-    x = np.arange(3) - 1
-    xx, yy = np.meshgrid(x, x)
-    kernel = 0.25 * (np.ones([3, 3]) - abs(xx * 0.5)) * (
-                np.ones([3, 3]) - abs(yy * 0.5))
-    c = convolve(im, kernel)
-    return c
+def convolve_undersample(im, out=None):
+    #
+    # The kernel 0.25*(1-|x|/2)*(1-|y|/2) on a 3x3 grid is the outer
+    # product of [0.25, 0.5, 0.25] with itself
+    #
+    w = np.array([0.25, 0.5, 0.25])
+    c = ndimage.correlate1d(im, w, axis=0)
+    return ndimage.correlate1d(c, w, axis=1, output=out)
 
 
-def convolve_gauss(im, fwhm):
-    from scipy.ndimage.filters import convolve
+def gauss_kernel_1d(fwhm):
     sigma = fwhm / (2 * np.sqrt(2 * np.log(2.0)))
     nk = 1 + 2 * int(4 * sigma)
-    x = np.arange(nk) - nk / 2
-    xx, yy = np.meshgrid(x, x)
-    kernel = np.exp(-(xx ** 2 + yy ** 2) / (2 * sigma ** 2))
-    kernel /= np.sum(kernel)
-    c = convolve(im, kernel)
-    return c
+    x = np.arange(nk) - nk // 2
+    kernel = np.exp(-x ** 2 / (2 * sigma ** 2))
+    return kernel / np.sum(kernel)
+
+
+def convolve_gauss(im, fwhm, out=None):
+    #
+    # The normalised 2-D Gaussian kernel is the outer product of two
+    # normalised 1-D kernels, so convolve with each in turn
+    #
+    kernel = gauss_kernel_1d(fwhm)
+    c = ndimage.correlate1d(im, kernel, axis=0)
+    return ndimage.correlate1d(c, kernel, axis=1, output=out)
 
 
 def apply_photometric_scale(d, c, pdeg):
-    p = np.zeros(d.shape)
-    (m, n) = d.shape
-    eta = (range(n) - 0.5 * (n - 1) * np.ones(n)) / (n - 1)
-    xi = (range(m) - 0.5 * (m - 1) * np.ones(m)) / (m - 1)
-    x, y = np.meshgrid(eta, xi)
-    i = 0
-    for l in range(pdeg + 1):
-        for m in range(pdeg - l + 1):
-            t = (x ** l) * (y ** m)
-            p += c[i] * t
-            i += 1
-    q = d / p
-    return q
+    return d / PB.surface(PB.scale_matrix(c, pdeg), d.shape)
 
 
 def undo_photometric_scale(d, c, pdeg, size=None, position=(0, 0)):
-    md, nd = d.shape
-    if size:
-        (m, n) = size
-    else:
-        (m, n) = d.shape
-    p = np.zeros([md, nd])
-    eta = (range(n) - 0.5 * (n - 1) * np.ones(n)) / (n - 1)
-    xi = (range(m) - 0.5 * (m - 1) * np.ones(m)) / (m - 1)
-    x0, y0 = np.meshgrid(eta, xi)
-    x = x0[position[0]:position[0] + md, position[1]:position[1] + nd]
-    y = y0[position[0]:position[0] + md, position[1]:position[1] + nd]
-    i = 0
-    for l in range(pdeg + 1):
-        for m in range(pdeg - l + 1):
-            t = (x ** l) * (y ** m)
-            p += c[i] * t
-            i += 1
-    q = d * p
-    return q
+    if not size:
+        size = d.shape
+    window = (position[0], position[1], d.shape[0], d.shape[1])
+    return d * PB.surface(PB.scale_matrix(c, pdeg), size, window)
+
+
+def sampled_autocorrelation(image, ntiles, tile_size=FWHM_TILE_SIZE,
+                            max_lag=20):
+    """Autocorrelation of image for lags -max_lag to max_lag-1, summed over
+    up to ntiles tiles on a regular grid, from the power spectra of the
+    zero-padded tiles.  For an image no larger than one tile this equals
+    the central part of the full autocorrelation."""
+    from scipy.fftpack import next_fast_len
+    n0 = min(tile_size, image.shape[0])
+    n1 = min(tile_size, image.shape[1])
+    nt = max(1, int(np.sqrt(ntiles)))
+    i0 = np.unique(np.linspace(0, image.shape[0] - n0, nt).astype(int))
+    j0 = np.unique(np.linspace(0, image.shape[1] - n1, nt).astype(int))
+    fft_shape = (next_fast_len(n0 + max_lag), next_fast_len(n1 + max_lag))
+    power = np.zeros((fft_shape[0], fft_shape[1] // 2 + 1))
+    for i in i0:
+        for j in j0:
+            t = np.fft.rfft2(image[i:i + n0, j:j + n1], fft_shape)
+            power += t.real ** 2 + t.imag ** 2
+    c = np.fft.irfft2(power, fft_shape)
+    c = np.roll(np.roll(c, max_lag, axis=0), max_lag, axis=1)
+    return c[:2 * max_lag, :2 * max_lag]
 
 
 def compute_fwhm(f, params, width=20, seeing_file='seeing', image_name=False):
@@ -256,19 +301,20 @@ def compute_fwhm(f, params, width=20, seeing_file='seeing', image_name=False):
     g_width = None
 
     if image_name:
-        fname = f
+        fname = os.path.basename(f)
     else:
         fname = f.name
 
-    if os.path.exists(params.loc_output + os.path.sep + seeing_file):
-        for line in open(params.loc_output + os.path.sep + seeing_file, 'r'):
-            sline = line.split()
-            if sline[0] == fname:
-                g_width = float(sline[1])
-                g_roundness = float(sline[2])
-                bgnd = float(sline[3])
-                signal = float(sline[4])
-                break
+    #
+    # Look up previously measured values in the epoch catalogue
+    #
+    catalogue = EC.EpochCatalogue(params.loc_output)
+    record = catalogue.get(fname)
+    if record is not None and record['fw'] is not None:
+        g_width = record['fw']
+        g_roundness = record['roundness']
+        bgnd = record['sky']
+        signal = record['signal']
 
     if g_width is None:
         if isinstance(params.fwhm_section, np.ndarray):
@@ -282,14 +328,25 @@ def compute_fwhm(f, params, width=20, seeing_file='seeing', image_name=False):
         image.shape
         print
         mask.shape
-        bgnd = np.percentile(image[mask == 1], 30)
+        if params.fwhm_method == 'full':
+            bgnd = np.percentile(image[mask == 1], 30)
+        else:
+            #
+            # Background from a bounded subsample of the pixels
+            #
+            step = int(np.ceil(np.sqrt(image.size / float(FWHM_MAX_SAMPLES))))
+            sample = image[::step, ::step][mask[::step, ::step] == 1]
+            bgnd = np.percentile(sample, 30)
         image[mask == 0] = bgnd
         image -= bgnd
         signal = image.sum() / image.size
-        c = fftconvolve(image, image[::-1, ::-1])
-        xcen = c.shape[0] / 2
-        ycen = c.shape[1] / 2
-        c_small = c[xcen - 20:xcen + 20, ycen - 20:ycen + 20]
+        if params.fwhm_method == 'full':
+            c = fftconvolve(image, image[::-1, ::-1])
+            xcen = c.shape[0] / 2
+            ycen = c.shape[1] / 2
+            c_small = c[xcen - 20:xcen + 20, ycen - 20:ycen + 20]
+        else:
+            c_small = sampled_autocorrelation(image, params.fwhm_tiles)
         c_small -= np.min(c_small)
         xsize, ysize = c_small.shape
         xcen = c_small.shape[0] / 2
@@ -317,157 +374,246 @@ def compute_fwhm(f, params, width=20, seeing_file='seeing', image_name=False):
         #        break
         # if not(fw):
         #    fw = 6.0
-        p = open(seeing_file, 'a')
-        p.write(f.name + '  ' + str(g_width) + '  ' + str(
-            g_roundness) + '  ' + str(bgnd) + '  ' + str(signal) + '\n')
-        p.close()
+        catalogue.update(fname, fw=g_width, roundness=g_roundness, sky=bgnd,
+                         signal=signal)
 
     return g_width, g_roundness, bgnd, signal
 
 
-def subtract_sky(image, params):
-    from scipy.linalg import lu_solve, lu_factor, LinAlgError
-    print
-    'subtracting sky'
-    if params.sky_subtract_mode == 'percent':
-        image2 = image.copy()
-        if params.pixel_min > 0.1:
-            p = np.where(image2 > params.pixel_min)
-            const = np.percentile(image2[p], params.sky_subtract_percent)
-        else:
-            const = np.percentile(image2, params.sky_subtract_percent)
-        image2 -= const
-        print
-        'subtracting sky, constant =', const
-        return image2
-    else:
-        degree = params.sky_degree
-        (ni, mi) = image.shape
-        sxlen = image.shape[0] / 5.0
-        sylen = image.shape[1] / 5.0
-        x = np.zeros(25)
-        y = np.zeros(25)
-        z = np.zeros(25)
-        k = 0
-        for i in range(5):
-            for j in range(5):
-                section = image[int(i * sxlen):int((i + 1) * sxlen),
-                          int(j * sylen):int((j + 1) * sylen)].ravel()
-                z[k] = np.min(section[section > params.pixel_min])
-                x[k] = ((i + 0.5) * sxlen - 0.5 * (ni - 1)) / (ni - 1)
-                y[k] = ((j + 0.5) * sylen - 0.5 * (mi - 1)) / (mi - 1)
-                print
-                x[k], y[k], z[k]
-                k += 1
-        ncoeffs = (degree + 1) * (degree + 2) / 2
-        bf = np.zeros([ncoeffs, k])
-        m = 0
-        for i in range(degree + 1):
-            for j in range(degree + 1 - i):
-                bf[m, :] = (x[:k] ** i) * (y[:k] ** j)
-                m += 1
-        alpha = np.zeros([ncoeffs, ncoeffs])
-        beta = np.zeros(ncoeffs)
-        for i in range(ncoeffs):
-            for j in range(ncoeffs):
-                alpha[i, j] = np.sum(bf[i, :] * bf[j, :])
-            beta[i] = np.sum(z[:k] * bf[i, :])
-        try:
-            lu, piv = lu_factor(alpha)
-        except LinAlgError:
-            print
-            'LU decomposition failed in subtract_sky'
-            return image
-        c = lu_solve((lu, piv), beta).astype(np.float32).copy()
-        x = (range(ni) - 0.5 * (ni - 1) * np.ones(ni)) / (ni - 1)
-        y = (range(mi) - 0.5 * (mi - 1) * np.ones(mi)) / (mi - 1)
-        xx, yy = np.meshgrid(y, x)
-        m = 0
-        sky_image = np.zeros_like(image)
-        print
-        'coeffs = ', c
-        print
-        'range x y:', np.min(x), np.max(x), np.min(y), np.max(y)
-        for i in range(degree + 1):
-            for j in range(degree + 1 - i):
-                sky_image += c[m] * (xx ** i) * (yy ** j)
-                m += 1
-        sky_image[sky_image < 0.0] = 0.0
-        image2 = image - sky_image
-        return image2
+def subtract_sky(image, params, out=None):
+    return BF.subtract_sky(image, params, out=out)
 
 
 def mask_cluster(im, mask, params):
     cim = convolve_gauss(im, 20)
-    p = np.where(cim == np.max(cim))
-    xmax = p[0][0]
-    ymax = p[1][0]
-    x = np.arange(im.shape[0])
-    y = np.arange(im.shape[1])
-    xx, yy = np.meshgrid(x, y)
-    rad2 = params.cluster_mask_radius ** 2
-    q = np.where((xx - xmax) ** 2 + (yy - ymax) ** 2 < rad2)
-    mask[q] = 0
+    xmax, ymax = np.unravel_index(np.argmax(cim), cim.shape)
+    rad = params.cluster_mask_radius
+    r = int(np.ceil(rad))
+    i0, i1 = max(0, xmax - r), min(im.shape[0], xmax + r + 1)
+    j0, j1 = max(0, ymax - r), min(im.shape[1], ymax + r + 1)
+    x = np.arange(i0, i1)[:, np.newaxis] - xmax
+    y = np.arange(j0, j1)[np.newaxis, :] - ymax
+    mask[i0:i1, j0:j1][x ** 2 + y ** 2 < rad ** 2] = 0
     return mask
 
 
 def define_kernel_pixels_fft(ref, target, rad, INNER_RADIUS=7, threshold=3.0):
-    from numpy.fft import fft2, ifft2
+    """Kernel pixels within rad where the kernel deconvolved from central
+    sections of the target and reference exceeds threshold times its
+    robust noise.  The reference spectrum is computed once per process
+    for each state of the reference file."""
     from astropy.stats import mad_std
-    nx, ny = ref.image.shape
-    x = np.concatenate((np.arange(nx / 2), np.arange(-nx / 2, 0)))
-    y = np.concatenate((np.arange(ny / 2), np.arange(-ny / 2, 0)))
-    fr = fft2(ref.image)
-    ft = fft2(target.image)
-    fk = ft / fr
-    k = ifft2(fk)
+    from scipy.fftpack import next_fast_len
+    global _kernel_spectrum
+    print('kernel radius ' + str(rad))
+    crad = int(np.ceil(rad))
+    pad = max(FFT_KERNEL_PAD, crad)
+    n0, n1 = [2 * (min(FFT_KERNEL_SECTION, n) // 2) for n in ref.image.shape]
+    fft_shape = (next_fast_len(n0 + 2 * pad), next_fast_len(n1 + 2 * pad))
+    #
+    # The file state is part of the key, so that a reference rebuilt under
+    # the same name in a long-lived process is transformed again
+    #
+    state = None
+    if os.path.exists(ref.fullname):
+        st = os.stat(ref.fullname)
+        state = (st.st_size, st.st_mtime)
+    key = (ref.fullname, state, ref.image.shape, fft_shape)
+    cached = _kernel_spectrum
+    if cached is None or cached[0] != key:
+        cached = (key, np.fft.rfft2(
+            RF.central_section(ref.image, FFT_KERNEL_SECTION), fft_shape))
+        _kernel_spectrum = cached
+    ft = np.fft.rfft2(RF.central_section(target.image, FFT_KERNEL_SECTION),
+                      fft_shape)
+    k = np.fft.irfft2(ft / cached[1], fft_shape)
     nk = k / k.max()
     std_nk = mad_std(nk)
-    kp = np.where(np.abs(nk) > threshold)
-    print
-    'kernel radius', rad
-    crad = int(np.ceil(rad))
-    rad2 = rad * rad
-    inner_rad2 = INNER_RADIUS * INNER_RADIUS
-    kCount = 1
-    for p in range(kp[0].shape[0]):
-        i = x[kp[0][p]]
-        j = y[kp[1][p]]
-        r2 = i * i + j * j
-        if (r2 < rad2) and ((i, j) != (0, 0)):
-            if (r2 < inner_rad2):
-                kCount += 1
-            else:
-                if (i / 3 == i / 3.0) and (j / 3 == j / 3.0):
-                    kCount += 1
-    kInd = np.zeros([kCount, 2], dtype=np.int32)
-    kExtended = np.zeros(kCount, dtype=np.int32)
-    kInd[0] = [0, 0]
-    k = 1
-    for p in range(kp[0].shape[0]):
-        i = x[kp[0][p]]
-        j = y[kp[1][p]]
-        r2 = i * i + j * j
-        if (r2 < rad2) and ((i, j) != (0, 0)):
-            if (r2 < inner_rad2):
-                kInd[k] = [i, j]
-                k += 1
-            else:
-                if (i / 3 == i / 3.0) and (j / 3 == j / 3.0):
-                    kInd[k] = [i, j]
-                    kExtended[k] = 1
-                    k += 1
+    offsets = np.arange(-crad, crad + 1)
+    i, j = np.meshgrid(offsets, offsets, indexing='ij')
+    r2 = i * i + j * j
+    central = nk[(offsets % fft_shape[0])[:, np.newaxis],
+                 (offsets % fft_shape[1])[np.newaxis, :]]
+    select = (np.abs(central) > threshold * std_nk) & (r2 < rad * rad) & \
+             ((i != 0) | (j != 0))
+    select &= (r2 < INNER_RADIUS * INNER_RADIUS) | \
+              ((i % 3 == 0) & (j % 3 == 0))
+    i, j, r2 = i[select], j[select], r2[select]
+    #
+    # Keep the order in which the pixels appear in the FFT array
+    #
+    order = np.lexsort((j, j < 0, i, i < 0))
+    kInd = np.zeros([order.size + 1, 2], dtype=np.int32)
+    kExtended = np.zeros(order.size + 1, dtype=np.int32)
+    kInd[1:, 0] = i[order]
+    kInd[1:, 1] = j[order]
+    kExtended[1:] = r2[order] >= INNER_RADIUS * INNER_RADIUS
     n_extend = np.sum(kExtended)
-    print
-    kCount - n_extend, 'modified delta basis functions'
-    print
-    n_extend, 'extended basis functions'
-    for k in range(kCount):
-        print
-        kInd[k]
+    print(str(kInd.shape[0] - n_extend) + ' modified delta basis functions')
+    print(str(n_extend) + ' extended basis functions')
     return kInd, kExtended
 
 
+def kernel_coefficient_sizes(params):
+    """Numbers of photometric scale terms, of spatial terms of each other
+    kernel pixel and of background terms in a kernel solution."""
+    return [(d + 1) * (d + 2) // 2
+            for d in (params.pdeg, params.sdeg, params.bdeg)]
+
+
+def _monomials(x, y, degree):
+    # The terms x**l * y**m of a kernel coefficient block at a point, in
+    # the order of the coefficients
+    return np.array([x ** l * y ** m for l in range(degree + 1)
+                     for m in range(degree - l + 1)])
+
+
+def _polynomial_terms(shape, degree, window):
+    # The terms x**l * y**m of a kernel coefficient block over the window
+    # (row, col, nrows, ncols) of an image, with x along the columns
+    i0, j0, ni, nj = window
+    y = PB.powers(shape[0], degree, i0, ni)
+    x = PB.powers(shape[1], degree, j0, nj)
+    return [np.outer(y[:, m], x[:, l]) for l in range(degree + 1)
+            for m in range(degree - l + 1)]
+
+
+class KernelBasis(object):
+    """Eigen-kernels over a set of kernel pixels.  components[e, k] is the
+    coefficient in eigen-kernel e of the basis function of kernel pixel
+    k + 1 of kernel_index (pixel 0 is the photometric scale).  chi2 is the
+    median first chi^2 per pixel of the kernels it was learned from."""
+
+    def __init__(self, kernel_index, extended_basis, components, chi2):
+        self.kernel_index = kernel_index
+        self.extended_basis = extended_basis
+        self.components = components
+        self.chi2 = chi2
+        self.radius = int(np.max(np.abs(kernel_index)))
+
+
+def learn_kernel_basis(kernels, size, chi2):
+    """KernelBasis of at most size eigen-kernels for the kernel solutions,
+    a list of (kernelIndex, extendedBasis, c, kernel_params).  Each
+    solution is sampled at the centre of the image and, if it varies, at
+    its corners and edge midpoints, normalised by its photometric scale
+    there.  The eigen-kernels are the leading right singular vectors of
+    the samples over the union of their kernel pixels."""
+    pixels = {}
+    for kernelIndex, extendedBasis, c, kernel_params in kernels:
+        for (kx, ky), ext in zip(kernelIndex[1:], extendedBasis[1:]):
+            pixels.setdefault((int(kx), int(ky), int(ext != 0)), len(pixels))
+    samples = []
+    for kernelIndex, extendedBasis, c, kernel_params in kernels:
+        dp, ds, db = kernel_coefficient_sizes(kernel_params)
+        nk = kernelIndex.shape[0]
+        column = [pixels[(int(kx), int(ky), int(ext != 0))] for (kx, ky), ext
+                  in zip(kernelIndex[1:], extendedBasis[1:])]
+        blocks = np.asarray(c[dp:dp + (nk - 1) * ds],
+                            dtype=np.float64).reshape(nk - 1, ds)
+        points = [(0.0, 0.0)]
+        if kernel_params.sdeg > 0:
+            points = [(x, y) for x in (-0.5, 0.0, 0.5)
+                      for y in (-0.5, 0.0, 0.5)]
+        for x, y in points:
+            sample = np.zeros(len(pixels))
+            sample[column] = blocks.dot(_monomials(x, y, kernel_params.sdeg)) / \
+                             np.dot(c[:dp], _monomials(x, y, kernel_params.pdeg))
+            samples.append(sample)
+    _, s, vt = np.linalg.svd(np.array(samples), full_matrices=False)
+    n = min(size, np.sum(s > 1.e-8 * s[0]))
+    order = sorted(pixels, key=pixels.get)
+    kernel_index = np.zeros([len(order) + 1, 2], dtype=np.int32)
+    extended_basis = np.zeros(len(order) + 1, dtype=np.int32)
+    kernel_index[1:] = [p[:2] for p in order]
+    extended_basis[1:] = [p[2] for p in order]
+    print('Kernel basis of ' + str(n) + ' eigen-kernels over ' +
+          str(len(order)) + ' kernel pixels')
+    return KernelBasis(kernel_index, extended_basis, vt[:n], chi2)
+
+
+def eigen_kernel_images(R, RB, basis):
+    """The basis images of the eigen-kernels of basis for the reference R
+    and its blurred version RB: the sum over kernel pixels of the
+    component times the shifted R or RB, less R."""
+    r = basis.radius
+    kx = r + basis.kernel_index[1:, 0]
+    ky = r + basis.kernel_index[1:, 1]
+    ext = basis.extended_basis[1:] != 0
+    images = []
+    for a in basis.components:
+        k = np.zeros((2, 2 * r + 1, 2 * r + 1))
+        np.add.at(k, (ext.astype(int), ky, kx), a)
+        q = fftconvolve(R, k[0, ::-1, ::-1], mode='same') - np.sum(a) * R
+        if np.any(ext):
+            q += fftconvolve(RB, k[1, ::-1, ::-1], mode='same')
+        images.append(q.astype(np.float32))
+    return images
+
+
+def compute_compact_matrix_and_vector(R, Q, T, inv_variance, mask, border,
+                                      params, stamp_positions=None,
+                                      block_rows=64):
+    """Normal equations of the kernel solution in the eigen-kernel basis
+    images Q, with the photometric scale and background terms of the full
+    basis, over the same pixels and with the same weights."""
+    dp, ds, db = kernel_coefficient_sizes(params)
+    ny, nx = R.shape
+    n = dp + len(Q) * ds + db
+    H = np.zeros([n, n])
+    V = np.zeros(n)
+    inner = (slice(border, ny - border), slice(border, nx - border))
+    weight = np.zeros(R.shape)
+    weight[inner] = inv_variance[inner] * mask[inner]
+    if params.use_stamps:
+        stamps = np.zeros(R.shape, dtype=bool)
+        hw = params.stamp_half_width
+        for x, y in stamp_positions[:params.nstamps, :2] - 1.0:
+            stamps[max(0, int(y) - hw):min(ny, int(y) + hw),
+                   max(0, int(x) - hw):min(nx, int(x) + hw)] = True
+        weight *= stamps
+    for i0 in range(border, ny - border, block_rows):
+        i1 = min(i0 + block_rows, ny - border)
+        section = (slice(i0, i1), slice(border, nx - border))
+        w = weight[section].ravel()
+        if not (np.any(w)):
+            continue
+        window = (i0, border, i1 - i0, nx - 2 * border)
+        terms = [R[section] * p for p in
+                 _polynomial_terms(R.shape, params.pdeg, window)]
+        spatial = _polynomial_terms(R.shape, params.sdeg, window)
+        terms += [q[section] * p for q in Q for p in spatial]
+        terms += _polynomial_terms(R.shape, params.bdeg, window)
+        B = np.array([t.ravel() for t in terms])
+        wB = B * w
+        H += wB.dot(B.T)
+        V += wB.dot(T[section].ravel())
+    return H, V
+
+
+def compute_compact_model(R, Q, d, params):
+    """Model image for the solution d of the normal equations of
+    compute_compact_matrix_and_vector."""
+    dp, ds, db = kernel_coefficient_sizes(params)
+    M = R * PB.surface(PB.scale_matrix(d[:dp], params.pdeg), R.shape)
+    for e, q in enumerate(Q):
+        M += q * PB.surface(PB.scale_matrix(d[dp + e * ds:dp + (e + 1) * ds],
+                                            params.sdeg), R.shape)
+    M += PB.surface(PB.scale_matrix(d[len(d) - db:], params.bdeg),
+                    R.shape)
+    return M
+
+
+def expand_compact_coefficients(d, basis, params):
+    """Coefficients over the kernel pixels of basis of the kernel whose
+    eigen-kernel coefficients are d."""
+    dp, ds, db = kernel_coefficient_sizes(params)
+    ne = basis.components.shape[0]
+    spatial = basis.components.T.dot(d[dp:dp + ne * ds].reshape(ne, ds))
+    return np.concatenate((d[:dp], spatial.ravel(),
+                           d[dp + ne * ds:])).astype(np.float32)
+
+
 def define_kernel_pixels(rad, INNER_RADIUS=7):
     print
     'kernel radius', rad
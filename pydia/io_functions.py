@@ -2,6 +2,11 @@ import os
 from astropy.io import fits
 import numpy as np
 
+#
+# Image data held at once by median_combine_images
+#
+MEDIAN_BLOCK_BYTES = 2 ** 28
+
 
 def get_date(file, key='JD'):
     target = file
@@ -15,6 +20,10 @@ def get_date(file, key='JD'):
     return date
 
 
+def read_fits_header(file):
+    return fits.getheader(file)
+
+
 def read_fits_file(file, slice=None):
     if slice:
         f = fits.open(file, memmap=True)
@@ -25,19 +34,57 @@ def read_fits_file(file, slice=None):
     return np.float64(data), hdr
 
 
+def _temporary_name(file):
+    return file + '.tmp' + str(os.getpid())
+
+
 def write_image(image, file, header=None):
+    #
+    # Written to a temporary file and renamed, so that a crash never leaves
+    # a partly written image behind
+    #
     hdu = fits.PrimaryHDU(image.astype(np.float32), header=header)
+    tmp = _temporary_name(file)
     try:
-        hdu.writeto(file, overwrite=True)
-    except IOError:
+        hdu.writeto(tmp, overwrite=True)
+        os.rename(tmp, file)
+    except (IOError, OSError):
         print
         'Warning - io_functions.write_image: could not write file', file
         pass
 
 
-def write_kernel_table(file, kernel_index, extended_basis, coeffs, params):
-    if os.path.exists(file):
-        os.remove(file)
+def write_table(file, table):
+    """np.savetxt the array table to file, atomically."""
+    tmp = _temporary_name(file)
+    np.savetxt(tmp, table)
+    os.rename(tmp, file)
+
+
+def median_combine_images(files, max_block_bytes=MEDIAN_BLOCK_BYTES):
+    """Pixelwise median of the images in files, read from memory-mapped
+    files in blocks of rows so that about max_block_bytes of image data are
+    held at once."""
+    hdulists = [fits.open(f, memmap=True) for f in files]
+    try:
+        ny, nx = hdulists[0][0].shape
+        rows = max(1, int(max_block_bytes // (len(files) * nx * 4)))
+        median = np.zeros((ny, nx), dtype=np.float32)
+        block = np.empty((len(files), rows, nx), dtype=np.float32)
+        for i0 in range(0, ny, rows):
+            i1 = min(ny, i0 + rows)
+            for k, hdulist in enumerate(hdulists):
+                block[k, :i1 - i0] = hdulist[0].section[i0:i1, :]
+            median[i0:i1] = np.median(block[:, :i1 - i0], axis=0,
+                                      overwrite_input=True)
+    finally:
+        for hdulist in hdulists:
+            hdulist.close()
+    return median
+
+
+def write_kernel_table(file, kernel_index, extended_basis, coeffs, params,
+                       chi2=None):
     table1 = fits.TableHDU.from_columns(
         [fits.Column(name='x', format='I', array=kernel_index[:, 0]), \
             fits.Column(name='y', format='I', array=kernel_index[:, 1]), \
@@ -50,8 +97,40 @@ def write_kernel_table(file, kernel_index, extended_basis, coeffs, params):
     table3 = fits.TableHDU.from_columns( \
         [fits.Column(name='Coefficients', format='E', array=coeffs)])
     hdu = fits.PrimaryHDU()
+    if chi2 is not None:
+        hdu.header['CHI2'] = (float(chi2), 'First chi^2 per pixel')
     hdulist = fits.HDUList([hdu, table1, table2, table3])
-    hdulist.writeto(file)
+    tmp = _temporary_name(file)
+    hdulist.writeto(tmp, overwrite=True)
+    os.rename(tmp, file)
+
+
+def read_kernel_chi2(file):
+    """The first chi^2 per pixel recorded in a kernel table, or None."""
+    return fits.getheader(file).get('CHI2')
+
+
+def write_kernel_basis(file, kernel_index, extended_basis, components, chi2):
+    hdu = fits.PrimaryHDU(np.asarray(components, dtype=np.float64))
+    hdu.header['CHI2'] = (float(chi2), 'Median first chi^2 per pixel')
+    table = fits.TableHDU.from_columns(
+        [fits.Column(name='x', format='I', array=kernel_index[:, 0]),
+         fits.Column(name='y', format='I', array=kernel_index[:, 1]),
+         fits.Column(name='extended', format='I5', array=extended_basis)])
+    tmp = _temporary_name(file)
+    fits.HDUList([hdu, table]).writeto(tmp, overwrite=True)
+    os.rename(tmp, file)
+
+
+def read_kernel_basis(file):
+    hdulist = fits.open(file)
+    components = hdulist[0].data.astype(np.float64)
+    chi2 = hdulist[0].header['CHI2']
+    t = hdulist[1].data
+    kernel_index = np.array([t.field('x'), t.field('y')]).T.astype(np.int32)
+    extended_basis = t.field('extended').astype(np.int32)
+    hdulist.close()
+    return kernel_index, extended_basis, components, chi2
 
 
 def read_kernel_table(file, params):
@@ -8,8 +8,6 @@ import datetime
 import time
 from astropy.io import fits
 from astropy.wcs import WCS
-from reproject import reproject_interp
-from astropy.nddata.utils import Cutout2D
 import glob
 import data_structures as DS
 import io_functions as IO
@@ -20,6 +18,7 @@ import numpy as np
 # TODO : let user define CPU vs GPU
 import DIA_CPU as DIA
 # import DIA_GPU as DIA
+from run_pydia import spin_and_trim
 
 
 def set_default_parameters():
@@ -70,56 +69,6 @@ def copy_wcs(wcs_source_file, wcs_target_file):
     return
 
 
-def spin_and_trim(imlist, wcsrefimname, trimfrac=0.4, trimdir='DIA_TRIM',
-                  verbose=False):
-    """ Rotate images to match the WCS of the WCS reference image (spin) and
-    then cut off a fraction of the outer region of the image (trim).
-    Returns a list of the trimmed images.
-    """
-    if verbose:
-        print('Spinning Input Images: ' + str(imlist))
-        print("to match WCS Ref image: " + wcsrefimname)
-        print("and trimming by : %i pct"%(trimfrac*100))
-
-    if not os.path.exists(trimdir):
-        os.makedirs(trimdir)
-    trimmed_image_list = []
-    hdr_imref = fits.getheader(wcsrefimname)
-    wcs_imref = WCS(hdr_imref)
-    for imname in list(imlist) + [wcsrefimname]:
-        imname_trimmed = os.path.join(
-            trimdir, os.path.basename(imname).replace('.fits', '_trim.fits'))
-        if os.path.isfile(imname_trimmed):
-            print("%s exists.  Skipping trimming."%imname_trimmed, file=sys.stderr)
-            continue
-        if verbose:
-            print("Reprojecting %s to x,y frame of %s " % (
-                imname, wcsrefimname), file=sys.stderr)
-        im = fits.open(imname)
-        if imname != wcsrefimname:
-            array, footprint = reproject_interp(im[0], hdr_imref)
-        else:
-            # WCS Ref image does not need reprojection
-            array = im[0].data
-
-        # Trim off the outer trimfrac to reduce chances of NaN errors due to
-        # empty array segments after rotation (also speeds up DIA processing)
-        arraysize = array.shape
-        cutout = Cutout2D(array, position=[arraysize[1]/2., arraysize[0]/2.],
-                          size=[round(arraysize[1]*(1-trimfrac)),
-                                round(arraysize[0]*(1-trimfrac))],
-                          wcs=wcs_imref)
-
-        # save reprojected-and-trimmed image:
-        im[0].data = cutout.data
-        im[0].header.update(cutout.wcs.to_header())
-        im.writeto(imname_trimmed, output_verify='fix+warn')
-        im.close()
-
-        trimmed_image_list.append(imname_trimmed)
-    return(trimmed_image_list)
-
-
 def get_observation_list(filenamelist, params):
     """ From a given list of filenames, make a list of images as
     pyDIA Observation objects.
@@ -128,7 +77,7 @@ def get_observation_list(filenamelist, params):
     file exists as a trimmed  version, and use that.  If not, fall
     back is to use the original untrimmed image.
     """
-    observationslist = []
+    filenames = []
     for filename in filenamelist:
         if filename.endswith('_trim.fits'):
             ftrimname = os.path.basename(filename)
@@ -138,9 +87,9 @@ def get_observation_list(filenamelist, params):
         imfile = os.path.join(params.loc_data, os.path.basename(filename))
         for f in [filename, trimfile, imfile]:
             if os.path.exists(f):
-                g = DS.Observation(f, params)
-                observationslist.append(g)
+                filenames.append(f)
                 break
+    observationslist = DIA.ingest_images(filenames, params)
     return(observationslist)
 
 
@@ -160,21 +109,7 @@ def register_images(files, params):
     print('Registration image:', reg.name)
 
     # Register images
-    for f in files:
-        if f == reg:
-            f.image = f.data
-            rf = params.loc_output + os.path.sep + 'r_' + f.name
-            IO.write_image(f.image, rf)
-        else:
-            f.register(reg, params)
-            # delete image arrays to save memory
-            del f.image
-            del f.mask
-            del f.inv_variance
-        del reg.data
-        del reg.image
-        del reg.mask
-        del reg.inv_variance
+    DIA.register_all_images(files, reg, params)
     return(files)
 
 
@@ -270,9 +205,7 @@ def make_diff_images(filenamelist, refim, params):
             star_group_boundaries=star_group_boundaries,
             detector_mean_positions_x=detector_mean_positions_x,
             detector_mean_positions_y=detector_mean_positions_y)
-        del im.image
-        del im.mask
-        del im.inv_variance
+        im.release()
 
         hdr = fits.getheader(im.fullname)
         #  TODO : use astropy fits to propagate header with WCS from parent image
@@ -324,7 +257,9 @@ def do_everything(params=None):
                 params.wcs_ref_image = refimpath
         if not params.wcs_ref_image:
             params.wcs_ref_image = input_file_paths[0]
-        spin_and_trim(input_file_paths, params.wcs_ref_image, params.trimfrac)
+        spin_and_trim(input_file_paths, params.wcs_ref_image, params.trimfrac,
+                      trimdir=params.loc_trim, verbose=params.verbose,
+                      n_parallel=params.n_parallel)
 
     if params.dorefim:
         print("Making reference image")
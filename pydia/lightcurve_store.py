@@ -0,0 +1,190 @@
+from __future__ import print_function
+import os
+import numpy as np
+
+#
+# Columnar light-curve store.
+#
+# Fluxes are kept as (nepochs x nstars) arrays in .npy files inside a
+# directory in loc_output, so that they can be opened as memory maps rather
+# than parsed.  Rows are allocated by epoch name in the parent process before
+# any worker writes, so concurrent writers from a Pool always touch
+# different rows.  Spare rows are allocated geometrically so that appending
+# a few new epochs does not rewrite the whole season.
+#
+
+NAME_LENGTH = 256
+
+EPOCH_DTYPE = np.dtype([('date', np.float64), ('fw', np.float64),
+                        ('sky', np.float64), ('signal', np.float64),
+                        ('written', np.int8)])
+
+STORE_FILES = ('names.npy', 'epochs.npy', 'flux.npy', 'dflux.npy')
+
+
+def _open_array(file, mode, dtype=None, shape=None):
+    if dtype is None:
+        return np.load(file, mmap_mode=mode)
+    return np.lib.format.open_memmap(file, mode='w+', dtype=dtype,
+                                     shape=shape)
+
+
+class LightcurveStore(object):
+    """Memory-mapped (nepochs x nstars) store of fluxes and epoch metadata"""
+
+    def __init__(self, directory, mode='r'):
+        self.directory = directory
+        self.mode = mode
+        self._names = _open_array(os.path.join(directory, 'names.npy'), mode)
+        self._epochs = _open_array(os.path.join(directory, 'epochs.npy'),
+                                   mode)
+        self._flux = _open_array(os.path.join(directory, 'flux.npy'), mode)
+        self._dflux = _open_array(os.path.join(directory, 'dflux.npy'), mode)
+        self.nstars = self._flux.shape[1]
+        self._index_names()
+
+    def _index_names(self):
+        used = np.where(self._names != b'')[0]
+        self.nepochs = used.shape[0]
+        self.index = dict((n.decode() if isinstance(n, bytes) else n, i)
+                          for i, n in zip(used, self._names[used]))
+
+    @classmethod
+    def create(cls, directory, nstars, names=(), capacity=None):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if capacity is None:
+            capacity = max(16, len(names))
+        _open_array(os.path.join(directory, 'names.npy'), 'w+',
+                    dtype='S%d' % NAME_LENGTH, shape=(capacity,))
+        epochs = _open_array(os.path.join(directory, 'epochs.npy'), 'w+',
+                             dtype=EPOCH_DTYPE, shape=(capacity,))
+        epochs['date'] = np.nan
+        epochs['fw'] = np.nan
+        epochs['sky'] = np.nan
+        epochs['signal'] = np.nan
+        epochs.flush()
+        for name in ('flux.npy', 'dflux.npy'):
+            a = _open_array(os.path.join(directory, name), 'w+',
+                            dtype=np.float64, shape=(capacity, nstars))
+            a[:] = np.nan
+            a.flush()
+        store = cls(directory, mode='r+')
+        store.add_epochs(names)
+        return store
+
+    @property
+    def capacity(self):
+        return self._names.shape[0]
+
+    @property
+    def names(self):
+        return [n.decode() if isinstance(n, bytes) else n
+                for n in self._names[:self.nepochs]]
+
+    @property
+    def flux(self):
+        return self._flux[:self.nepochs]
+
+    @property
+    def dflux(self):
+        return self._dflux[:self.nepochs]
+
+    @property
+    def epochs(self):
+        return self._epochs[:self.nepochs]
+
+    def _grow(self, capacity):
+        #
+        # Copy the used rows into larger arrays and swap them in.
+        #
+        for name in STORE_FILES:
+            file = os.path.join(self.directory, name)
+            old = np.load(file, mmap_mode='r')
+            tmp = file + '.tmp.npy'
+            new = np.lib.format.open_memmap(tmp, mode='w+', dtype=old.dtype,
+                                            shape=(capacity,) + old.shape[1:])
+            if name == 'epochs.npy':
+                for field in ('date', 'fw', 'sky', 'signal'):
+                    new[field] = np.nan
+            elif name != 'names.npy':
+                new[:] = np.nan
+            new[:old.shape[0]] = old
+            new.flush()
+            del new, old
+            os.rename(tmp, file)
+        self.__init__(self.directory, mode='r+')
+
+    def add_epochs(self, names):
+        """Allocate rows for any epoch names not already in the store.
+        Returns the row index of each name."""
+        new = [n for n in names if n not in self.index]
+        if len(set(new)) != len(new):
+            raise ValueError('Duplicate epoch names')
+        if self.nepochs + len(new) > self.capacity:
+            self._grow(max(2 * self.capacity, self.nepochs + len(new)))
+        for n in new:
+            if len(n) > NAME_LENGTH:
+                raise ValueError('Epoch name too long for store: ' + n)
+            self._names[self.nepochs] = n.encode() if not isinstance(
+                n, bytes) else n
+            self.index[n] = self.nepochs
+            self.nepochs += 1
+        self._names.flush()
+        return [self.index[n] for n in names]
+
+    def row(self, name):
+        return self.index[name]
+
+    def set_metadata(self, name, date=None, fw=None, sky=None, signal=None):
+        i = self.index[name]
+        for field, value in (('date', date), ('fw', fw), ('sky', sky),
+                             ('signal', signal)):
+            if value is not None:
+                self._epochs[field][i] = value
+        self._epochs.flush()
+
+    def write(self, name, flux, dflux):
+        if flux.shape[0] != self.nstars:
+            raise ValueError('Flux vector for ' + name + ' has ' +
+                             str(flux.shape[0]) + ' stars, store has ' +
+                             str(self.nstars))
+        i = self.index[name]
+        self._flux[i, :] = flux
+        self._dflux[i, :] = dflux
+        self._epochs['written'][i] = 1
+        self._flux.flush()
+        self._dflux.flush()
+        self._epochs.flush()
+
+    def read(self, name):
+        i = self.index[name]
+        return np.array(self._flux[i]), np.array(self._dflux[i])
+
+    def star(self, star):
+        """Return the flux and flux error series of one star without
+        loading the whole matrix."""
+        return (np.array(self._flux[:self.nepochs, star]),
+                np.array(self._dflux[:self.nepochs, star]))
+
+
+def lightcurve_store_path(folder):
+    return os.path.join(folder, 'lightcurves')
+
+
+def have_lightcurve_store(folder):
+    return os.path.exists(
+        os.path.join(lightcurve_store_path(folder), 'flux.npy'))
+
+
+def open_lightcurve_store(folder, nstars, names):
+    """Open the store in folder for writing, creating it (or recreating it if
+    the number of stars has changed) and allocating rows for names."""
+    path = lightcurve_store_path(folder)
+    if have_lightcurve_store(folder):
+        store = LightcurveStore(path, mode='r+')
+        if store.nstars == nstars:
+            store.add_epochs(names)
+            return store
+        print('Star list has changed: recreating light-curve store', path)
+    return LightcurveStore.create(path, nstars, names)
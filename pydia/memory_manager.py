@@ -0,0 +1,141 @@
+from __future__ import print_function
+import os
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
+#
+# Memory-budgeted cache of the image arrays held by Observations.
+#
+# Observation properties report every array they load, compute or are
+# assigned to the cache.  When the arrays held in memory exceed
+# params.memory_budget (megabytes), the least recently used ones are
+# evicted: their owner either spills them to a memory-mapped file in
+# params.scratch_dir, writes them out according to its storage policy, or
+# simply drops them if they can be read or computed again.  Each process has
+# its own cache, so Pool workers account for the arrays they hold; threads
+# of one process share it, and an owner refuses to evict an array while
+# another thread is loading or using it through the owner's properties.
+#
+# Arrays needed by every Pool worker can instead be copied once into shared
+# memory as SharedArrays and installed in the workers by an initializer.
+#
+
+
+class ArrayCache(object):
+    """Least-recently-used accounting of arrays owned by Observations"""
+
+    def __init__(self, budget=None, scratch_dir=None):
+        self.budget = budget
+        self.scratch_dir = scratch_dir
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def touch(self, owner, attribute):
+        """Record that owner's array attribute has just been used, evicting
+        other arrays if this takes the cache over budget."""
+        key = (id(owner), attribute)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            array = getattr(owner, '_' + attribute)
+            if not (isinstance(array, np.ndarray)) or isinstance(array,
+                                                                np.memmap):
+                return
+            self._entries[key] = (weakref.ref(owner, self._collected(key)),
+                                  array.nbytes)
+            self.nbytes += array.nbytes
+            if self.budget is not None and self.nbytes > self.budget:
+                self._evict(keep=key)
+
+    def forget(self, owner, attribute):
+        self._forget_key((id(owner), attribute))
+
+    def _forget_key(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.nbytes -= entry[1]
+
+    def _collected(self, key):
+        #
+        # Callback dropping the entry when its owner is garbage collected
+        #
+        return lambda ref: self._forget_key(key)
+
+    def _evict(self, keep):
+        for key in list(self._entries):
+            if self.nbytes <= self.budget:
+                break
+            if key == keep:
+                continue
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            ref, nbytes = entry
+            owner = ref()
+            if owner is None or owner.evict(key[1]):
+                #
+                # The owner may already have forgotten the entry while
+                # releasing the array
+                #
+                if self._entries.pop(key, None) is not None:
+                    self.nbytes -= nbytes
+
+
+_cache = None
+
+
+def get_cache(params):
+    """The array cache of this process, configured from params."""
+    global _cache
+    budget = None
+    if params.memory_budget:
+        budget = int(params.memory_budget * 1024 ** 2)
+    if _cache is None or _cache.budget != budget or \
+            _cache.scratch_dir != params.scratch_dir:
+        _cache = ArrayCache(budget, params.scratch_dir)
+    return _cache
+
+
+def spill(array, scratch_dir, name):
+    """Write array to a new scratch file, named after name but unique to
+    this call, and return a writeable memory map of it."""
+    if not (os.path.exists(scratch_dir)):
+        os.makedirs(scratch_dir)
+    fd, file = tempfile.mkstemp(suffix='.npy', prefix=name + '_',
+                                dir=scratch_dir)
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, array)
+    return np.load(file, mmap_mode='r+')
+
+
+def remove_spill(array):
+    """Delete the scratch file behind a spilled array."""
+    if isinstance(array, np.memmap) and array.filename and os.path.exists(
+            array.filename):
+        os.remove(array.filename)
+
+
+class SharedArray(object):
+    """Copy of an array in shared memory.  The object is a lightweight
+    handle that can be passed to Pool workers at start-up, and view()
+    returns a read-only array backed by the shared copy in any process."""
+
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self.dtype = array.dtype.str
+        self.shape = array.shape
+        self.buffer = RawArray('b', max(array.nbytes, 1))
+        self.view(writeable=True)[...] = array
+
+    def view(self, writeable=False):
+        array = np.frombuffer(self.buffer, dtype=self.dtype,
+                              count=int(np.prod(self.shape))).reshape(
+            self.shape)
+        array.flags.writeable = writeable
+        return array
@@ -1,6 +1,7 @@
 import sys
 import os
 import numpy as np
+from scipy.spatial import cKDTree
 from astropy.io import fits
 from pyraf import iraf
 
@@ -41,9 +42,7 @@ def compute_xy_shift(pos1, pos2, threshold, dx=0.0, dy=0.0, degree=0):
     yy = (y1 - np.mean(y1)) / np.mean(y1)
     print('Matching positions for', len(x1), 'stars')
 
-    match = np.zeros_like(x1, dtype=np.int32)
-    deltax = np.zeros_like(x1)
-    deltay = np.zeros_like(x1)
+    tree = cKDTree(np.column_stack((x2, y2)))
 
     for deg in range(degree + 1):
 
@@ -68,20 +67,13 @@ def compute_xy_shift(pos1, pos2, threshold, dx=0.0, dy=0.0, degree=0):
                     xoffset += a[m, n] * (xx ** m) * (yy ** n)
                     yoffset += b[m, n] * (xx ** m) * (yy ** n)
 
-            for j1 in range(len(x1)):
-                r2 = (x1[j1] - x2 - xoffset[j1]) ** 2 + (
-                            y1[j1] - y2 - yoffset[j1]) ** 2
-                mm = np.where(r2 == np.min(r2))
-                try:
-                    match[j1] = np.where(r2 == np.min(r2))[0][0]
-                except:
-                    print( r2)
-                    print( np.min(np.sqrt(r2)))
-                    print( mm)
-                    print( mm[0])
-                    sys.exit(0)
-                deltax[j1] = x1[j1] - x2[match[j1]] - xoffset[j1]
-                deltay[j1] = y1[j1] - y2[match[j1]] - yoffset[j1]
+            #
+            # Nearest star in pos2 to each offset star in pos1
+            #
+            _, match = tree.query(np.column_stack((x1 - xoffset,
+                                                   y1 - yoffset)))
+            deltax = x1 - x2[match] - xoffset
+            deltay = y1 - y2[match] - yoffset
 
             deltar = np.sqrt(deltax ** 2 + deltay ** 2)
             good = np.where(deltar < scale * threshold)[0]
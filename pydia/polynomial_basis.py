@@ -0,0 +1,64 @@
+from __future__ import print_function
+import threading
+from collections import OrderedDict
+import numpy as np
+
+#
+# Cached polynomial basis for smooth surfaces over an image.
+#
+# Coordinates along each axis of length n are normalised as
+# (k - 0.5*(n-1)) / (n-1).  A surface sum C[i, j] * row**i * col**j is
+# evaluated as P_row . C . P_col^T from the powers of the coordinates
+# along each axis, which are kept in a small least-recently-used cache
+# keyed by axis length, degree and window.  Evaluating a surface over a
+# window of a larger frame therefore costs only the window.
+#
+
+CACHE_SIZE = 32
+
+_powers = OrderedDict()
+_lock = threading.Lock()
+
+
+def powers(n, degree, start=0, length=None):
+    """(length, degree+1) read-only array of the powers 0..degree of the
+    normalised coordinate of an axis of length n, for the pixels
+    start:start+length."""
+    if length is None:
+        length = n - start
+    key = (n, degree, start, length)
+    with _lock:
+        p = _powers.pop(key, None)
+        if p is None:
+            k = np.arange(start, start + length, dtype=np.float64)
+            x = (k - 0.5 * (n - 1)) / max(n - 1, 1)
+            p = x[:, np.newaxis] ** np.arange(degree + 1)[np.newaxis, :]
+            p.flags.writeable = False
+            if len(_powers) >= CACHE_SIZE:
+                _powers.popitem(last=False)
+        _powers[key] = p
+    return p
+
+
+def surface(C, shape, window=None):
+    """Evaluate sum C[i, j] * row**i * col**j over an image of the given
+    shape, or over the window (row, col, nrows, ncols) of it."""
+    degree = C.shape[0] - 1
+    if window is None:
+        window = (0, 0, shape[0], shape[1])
+    i0, j0, ni, nj = window
+    return powers(shape[0], degree, i0, ni).dot(C).dot(
+        powers(shape[1], degree, j0, nj).T)
+
+
+def scale_matrix(c, pdeg):
+    """Coefficient matrix of a photometric scale polynomial, whose
+    coefficients c are ordered as col**l * row**m for l in 0..pdeg, m in
+    0..pdeg-l."""
+    C = np.zeros((pdeg + 1, pdeg + 1))
+    i = 0
+    for l in range(pdeg + 1):
+        for m in range(pdeg - l + 1):
+            C[m, l] = c[i]
+            i += 1
+    return C
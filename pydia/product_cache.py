@@ -0,0 +1,152 @@
+from __future__ import print_function
+import os
+import shutil
+
+#
+# Cache of intermediate products keyed by the work that made them.
+#
+# Products are filed under the signature of that work, as computed by
+# run_manifest.  A signature depends only on the input files, the
+# parameters of that stage and the signatures of the work upstream, and
+# not on loc_output, so runs of one field with different settings (or into
+# different output directories) share every product that a setting does
+# not affect.  The cache is not content-addressed: like the manifest, it
+# identifies an input file by its path, size and modification time, so a
+# file rewritten in place with the same size and time, or a different file
+# moved into its place with both preserved, is taken to be the same input.
+#
+# Each entry is a directory holding one file per named product.  Files are
+# hard-linked between the cache and loc_output where the file system
+# allows, and copied otherwise; since pyDIA replaces output files rather
+# than writing into them, a linked file is never modified.
+#
+# The cache is bounded in size: when it grows beyond max_bytes, the least
+# recently stored or fetched entries are removed.  Only the parent process
+# of a run uses it.
+#
+
+
+def _link(source, destination):
+    #
+    # Hard link or copy source to destination, replacing it atomically
+    #
+    tmp = destination + '.tmp' + str(os.getpid())
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.rename(tmp, destination)
+
+
+class ProductCache(object):
+    """Size-bounded store of product files keyed by work signature.  With
+    no directory the cache is disabled: it finds and keeps nothing."""
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        if directory is None:
+            return
+        if not (os.path.exists(directory)):
+            os.makedirs(directory)
+        self.nbytes = sum(size for _, _, size in self._entries())
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _entries(self):
+        #
+        # (last use, path, size) of every entry
+        #
+        entries = []
+        for prefix in os.listdir(self.directory):
+            folder = os.path.join(self.directory, prefix)
+            if not (os.path.isdir(folder)):
+                continue
+            for key in os.listdir(folder):
+                path = os.path.join(folder, key)
+                if '.tmp' in key:
+                    continue
+                size = sum(os.path.getsize(os.path.join(path, f)) for f in
+                           os.listdir(path))
+                entries.append((os.path.getmtime(path), path, size))
+        return entries
+
+    def fetch(self, key, files):
+        """Put the products cached under key into files, a dictionary of
+        destination paths by product name.  Returns False, and leaves the
+        destinations alone, unless every product is cached."""
+        if self.directory is None:
+            return False
+        entry = self._entry(key)
+        sources = dict((name, os.path.join(entry, name)) for name in files)
+        if not (all(os.path.exists(f) for f in sources.values())):
+            return False
+        try:
+            for name, destination in files.items():
+                _link(sources[name], destination)
+            os.utime(entry, None)
+        except (IOError, OSError):
+            #
+            # The entry was evicted by another run while we used it
+            #
+            return False
+        print('Using cached', ', '.join(sorted(files)), 'for', key[:12])
+        return True
+
+    def store(self, key, files):
+        """Cache the files, a dictionary of paths by product name, under
+        key.  Nothing is kept unless all of them exist."""
+        if self.directory is None or not files:
+            return
+        if not (all(os.path.exists(f) for f in files.values())):
+            return
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            os.utime(entry, None)
+            return
+        tmp = entry + '.tmp' + str(os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for name, source in files.items():
+            _link(source, os.path.join(tmp, name))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            #
+            # Another run stored the same products first
+            #
+            shutil.rmtree(tmp)
+            return
+        self.nbytes += sum(os.path.getsize(f) for f in files.values())
+        if self.max_bytes is not None and self.nbytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        max_bytes."""
+        entries = sorted(self._entries())
+        self.nbytes = sum(size for _, _, size in entries)
+        for used, path, size in entries:
+            if self.nbytes <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+            self.nbytes -= size
+        print('Product cache holds', self.nbytes // 2 ** 20, 'MB')
+
+
+def open_product_cache(params):
+    """The product cache configured by params.product_cache and
+    params.product_cache_size (megabytes)."""
+    max_bytes = None
+    if params.product_cache_size:
+        max_bytes = int(params.product_cache_size * 1024 ** 2)
+    return ProductCache(params.product_cache, max_bytes)
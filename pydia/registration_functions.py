@@ -0,0 +1,391 @@
+from __future__ import print_function
+import itertools
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+from scipy import ndimage
+from scipy.fftpack import next_fast_len
+from scipy.spatial import cKDTree
+
+#
+# Translational registration by normalised phase correlation.
+#
+# The registration template is transformed once per run, with real FFTs at
+# a fast size, and its spectrum is reused for every target, so that each
+# epoch costs one forward and one inverse transform.  Optionally a coarse
+# shift is first found from images binned by params.registration_bin and
+# then refined on a central section of params.registration_section pixels.
+#
+# For parallel registration the template spectra are placed in shared
+# memory once and installed in each Pool worker by an initializer.
+#
+# Shifts follow the convention of image_functions.register: the template
+# R and target T satisfy R[i, j] = T[i - xshift, j - yshift].
+#
+# With params.registration_mode = 'stars', images are instead registered by
+# matching the positions of their brightest stars.  An initial similarity
+# transform is found by matching triangles of bright stars, refined by
+# k-d tree matching of all detected stars to a polynomial transform of
+# degree params.registration_degree, and the target is resampled once onto
+# the template pixel grid.  This handles rotated and scaled frames.
+#
+
+TRIANGLE_STARS = 20
+
+
+def bin_image(im, factor):
+    """Sum im in factor x factor blocks, discarding incomplete blocks."""
+    n0 = im.shape[0] // factor
+    n1 = im.shape[1] // factor
+    return im[:n0 * factor, :n1 * factor].reshape(n0, factor, n1,
+                                                  factor).sum(axis=(1, 3))
+
+
+def central_section(im, size, offset=(0, 0)):
+    """Section of im of side up to size centred on the image centre
+    displaced by -offset, zero-filled where it falls outside im."""
+    h0 = min(size, im.shape[0]) // 2
+    h1 = min(size, im.shape[1]) // 2
+    c0 = im.shape[0] // 2 - int(offset[0])
+    c1 = im.shape[1] // 2 - int(offset[1])
+    section = np.zeros((2 * h0, 2 * h1))
+    i0, i1 = max(0, c0 - h0), min(im.shape[0], c0 + h0)
+    j0, j1 = max(0, c1 - h1), min(im.shape[1], c1 + h1)
+    if i1 > i0 and j1 > j0:
+        section[i0 - (c0 - h0):i1 - (c0 - h0),
+                j0 - (c1 - h1):j1 - (c1 - h1)] = im[i0:i1, j0:j1]
+    return section
+
+
+class PhaseCorrelator(object):
+    """Cached spectrum of one template image"""
+
+    def __init__(self, im, shape=None, spectrum=None):
+        if shape is None:
+            shape = im.shape
+        self.shape = shape
+        self.fft_shape = (next_fast_len(shape[0]), next_fast_len(shape[1]))
+        #
+        # The separable window is kept as its two 1-D factors, so that no
+        # full-frame array is held per template or pool worker
+        #
+        self.window_y = np.hanning(shape[0])[:, np.newaxis]
+        self.window_x = np.hanning(shape[1])[np.newaxis, :]
+        if spectrum is None:
+            spectrum = self.transform(im)
+        self.spectrum = spectrum.reshape(self.fft_shape[0], -1)
+
+    def share(self):
+        """The template shape and spectrum, the latter in shared memory."""
+        shared = RawArray('d', 2 * self.spectrum.size)
+        np.frombuffer(shared, dtype=np.complex128).reshape(
+            self.spectrum.shape)[...] = self.spectrum
+        return self.shape, shared
+
+    @classmethod
+    def from_shared(cls, state):
+        shape, shared = state
+        return cls(None, shape=shape,
+                   spectrum=np.frombuffer(shared, dtype=np.complex128))
+
+    def transform(self, im):
+        return np.fft.rfft2((im - np.mean(im)) * self.window_y * self.window_x,
+                            self.fft_shape)
+
+    def shift(self, im):
+        """Subpixel shift of im relative to the template."""
+        cross = self.spectrum * np.conj(self.transform(im))
+        amplitude = np.abs(cross)
+        cross /= np.where(amplitude > 0.0, amplitude, 1.0)
+        c = np.fft.irfft2(cross, self.fft_shape)
+        peak = np.unravel_index(np.argmax(c), c.shape)
+        shift = []
+        for axis, n in enumerate(self.fft_shape):
+            #
+            # Refine the peak with a parabola through its neighbours
+            #
+            index = list(peak)
+            index[axis] = (peak[axis] - 1) % n
+            cm = c[tuple(index)]
+            index[axis] = (peak[axis] + 1) % n
+            cp = c[tuple(index)]
+            c0 = c[peak]
+            denominator = cm - 2.0 * c0 + cp
+            delta = 0.0
+            if denominator < 0.0:
+                delta = 0.5 * (cm - cp) / denominator
+            s = peak[axis] + delta
+            if s > n // 2:
+                s -= n
+            shift.append(s)
+        return tuple(shift)
+
+
+def detect_bright_stars(data, nstars, params):
+    """Positions (row, column) of up to nstars of the brightest unsaturated
+    local maxima in data, brightest first."""
+    smooth = ndimage.gaussian_filter(data, 1.0)
+    background = np.median(smooth)
+    sigma = 1.4826 * np.median(np.abs(smooth - background))
+    peaks = (smooth == ndimage.maximum_filter(smooth, size=5)) & (
+            smooth > background + 5.0 * sigma)
+    peaks[:3, :] = False
+    peaks[-3:, :] = False
+    peaks[:, :3] = False
+    peaks[:, -3:] = False
+    saturated = ndimage.maximum_filter(data, size=5) > params.pixel_max
+    i, j = np.where(peaks & ~saturated)
+    height = smooth[i, j]
+    order = np.argsort(height)[::-1][:nstars]
+    i = i[order]
+    j = j[order]
+    #
+    # Refine the peaks with parabolas through their neighbours
+    #
+    c0 = smooth[i, j]
+    position = []
+    for k, (cm, cp) in enumerate(((smooth[i - 1, j], smooth[i + 1, j]),
+                                  (smooth[i, j - 1], smooth[i, j + 1]))):
+        denominator = cm - 2.0 * c0 + cp
+        delta = np.where(denominator < 0.0,
+                         0.5 * (cm - cp) / np.where(denominator < 0.0,
+                                                    denominator, -1.0), 0.0)
+        position.append((i, j)[k] + np.clip(delta, -0.5, 0.5))
+    return np.column_stack(position)
+
+
+def triangle_invariants(pos):
+    """Shape invariants (ratios of the two shorter sides to the longest) of
+    all triangles of the stars in pos, with the vertex indices of each
+    triangle ordered by the length of the opposite side."""
+    vertices = np.array(list(itertools.combinations(range(len(pos)), 3)))
+    p = pos[vertices]
+    sides = np.sqrt(((p[:, [1, 2, 0]] - p[:, [2, 0, 1]]) ** 2).sum(axis=2))
+    order = np.argsort(sides, axis=1)
+    rows = np.arange(len(vertices))[:, np.newaxis]
+    sides = sides[rows, order]
+    vertices = vertices[rows, order]
+    good = sides[:, 0] > 5.0
+    return sides[good, :2] / sides[good, 2:3], vertices[good]
+
+
+def similarity_transform(p1, p2):
+    """Least-squares rotation, scale and translation taking p1 to p2, as
+    complex numbers (a, b) with z2 = a * z1 + b."""
+    z1 = p1[:, 0] + 1j * p1[:, 1]
+    z2 = p2[:, 0] + 1j * p2[:, 1]
+    m1 = z1.mean()
+    m2 = z2.mean()
+    a = np.sum(np.conj(z1 - m1) * (z2 - m2)) / np.sum(np.abs(z1 - m1) ** 2)
+    return a, m2 - a * m1
+
+
+def apply_similarity(transform, p):
+    z = transform[0] * (p[:, 0] + 1j * p[:, 1]) + transform[1]
+    return np.column_stack((z.real, z.imag))
+
+
+def polynomial_terms(p, degree, shape):
+    u = (p[:, 0] - 0.5 * (shape[0] - 1)) / shape[0]
+    v = (p[:, 1] - 0.5 * (shape[1] - 1)) / shape[1]
+    return np.column_stack([u ** l * v ** m for l in range(degree + 1)
+                            for m in range(degree + 1 - l)])
+
+
+class StarMatcher(object):
+    """Bright-star positions of the registration image, for registering
+    targets by star matching"""
+
+    def __init__(self, data, params, stars=None):
+        if stars is None:
+            stars = detect_bright_stars(data, params.registration_stars,
+                                        params)
+        self.stars = stars
+        self.degree = params.registration_degree
+        self.invariants, self.vertices = triangle_invariants(
+            stars[:TRIANGLE_STARS])
+
+    def initial_transform(self, stars):
+        #
+        # Match similar triangles and keep the similarity transform on
+        # which most bright stars agree
+        #
+        invariants, vertices = triangle_invariants(stars[:TRIANGLE_STARS])
+        distance, index = cKDTree(invariants).query(self.invariants,
+                                                    distance_upper_bound=0.01)
+        candidates = np.where(np.isfinite(distance))[0]
+        candidates = candidates[np.argsort(distance[candidates])][:200]
+        bright = self.stars[:TRIANGLE_STARS]
+        tree = cKDTree(stars[:2 * TRIANGLE_STARS])
+        best = None
+        best_count = 0
+        for k in candidates:
+            transform = similarity_transform(self.stars[self.vertices[k]],
+                                             stars[vertices[index[k]]])
+            d, _ = tree.query(apply_similarity(transform, bright),
+                              distance_upper_bound=3.0)
+            count = np.sum(np.isfinite(d))
+            if count > best_count:
+                best = transform
+                best_count = count
+        return best
+
+    def transform(self, data, params):
+        """Polynomial coefficients mapping template (row, column) positions
+        to positions in data, or None if the stars cannot be matched."""
+        stars = detect_bright_stars(data, 2 * params.registration_stars,
+                                    params)
+        transform = self.initial_transform(stars)
+        if transform is None:
+            return None
+        predicted = apply_similarity(transform, self.stars)
+        tree = cKDTree(stars)
+        coeffs = None
+        for radius in (5.0, 3.0, 2.0):
+            d, match = tree.query(predicted, distance_upper_bound=radius)
+            good = np.isfinite(d)
+            degree = self.degree
+            while degree > 0 and np.sum(good) < 2 * (degree + 1) * (
+                    degree + 2) // 2:
+                degree -= 1
+            if np.sum(good) < 3:
+                break
+            A = polynomial_terms(self.stars[good], degree, data.shape)
+            coeffs = (degree, np.linalg.lstsq(A, stars[match[good]],
+                                              rcond=-1)[0])
+            predicted = polynomial_terms(self.stars, degree,
+                                         data.shape).dot(coeffs[1])
+        print('Matched', np.sum(good), 'stars')
+        return coeffs
+
+    def resample(self, T, coeffs, params, rows=256):
+        """Resample Observation T onto the template pixel grid.  Returns
+        the image, mask, inverse variance and the shift at the centre."""
+        degree, c = coeffs
+        shape = T.data.shape
+        filtered = ndimage.spline_filter(T.data, order=3)
+        mask = T.mask.astype(np.float64)
+        RT = np.zeros(shape)
+        RM = np.zeros(shape, dtype=bool)
+        outside = np.zeros(shape, dtype=bool)
+        j = np.arange(shape[1])
+        for i0 in range(0, shape[0], rows):
+            i = np.arange(i0, min(i0 + rows, shape[0]))
+            p = np.column_stack((np.repeat(i, shape[1]),
+                                 np.tile(j, len(i))))
+            q = polynomial_terms(p, degree, shape).dot(c).T
+            block = (len(i), shape[1])
+            RT[i0:i0 + len(i)] = ndimage.map_coordinates(
+                filtered, q, order=3, prefilter=False).reshape(block)
+            RM[i0:i0 + len(i)] = ndimage.map_coordinates(
+                mask, q, order=1).reshape(block) > 0.999
+            outside[i0:i0 + len(i)] = ((q[0] < 0) | (q[0] > shape[0] - 1) |
+                                       (q[1] < 0) | (q[1] > shape[1] - 1)
+                                       ).reshape(block)
+        RT[outside] = 0.0
+        RM[outside] = False
+        inv_variance = 1.0 / (RT / params.gain + (
+                params.readnoise / params.gain) ** 2) + outside * 1.0
+        centre = np.array([[0.5 * (shape[0] - 1), 0.5 * (shape[1] - 1)]])
+        shift = centre[0] - polynomial_terms(centre, degree, shape).dot(c)[0]
+        return RT, RM, inv_variance, shift
+
+
+class RegistrationTemplate(object):
+    """Phase-correlation spectra, or bright-star positions, of the
+    registration image"""
+
+    def __init__(self, data, params, shared=None):
+        self.bin = max(1, int(params.registration_bin or 1))
+        self.section = params.registration_section
+        self.coarse = None
+        self.stars = None
+        if params.registration_mode == 'stars':
+            if shared is not None:
+                self.stars = StarMatcher(None, params, stars=shared['stars'])
+            else:
+                self.stars = StarMatcher(data, params)
+            return
+        if shared is not None:
+            if shared['coarse'] is not None:
+                self.coarse = PhaseCorrelator.from_shared(shared['coarse'])
+            self.fine = PhaseCorrelator.from_shared(shared['fine'])
+            return
+        if self.bin > 1:
+            self.coarse = PhaseCorrelator(bin_image(data, self.bin))
+        if self.section:
+            self.fine = PhaseCorrelator(central_section(data, self.section))
+        else:
+            self.fine = PhaseCorrelator(data)
+
+    def share(self):
+        if self.stars is not None:
+            return {'stars': self.stars.stars}
+        coarse = None
+        if self.coarse is not None:
+            coarse = self.coarse.share()
+        return {'coarse': coarse, 'fine': self.fine.share()}
+
+    def shift(self, data):
+        """Subpixel (xshift, yshift) of data relative to the template."""
+        offset = (0, 0)
+        if self.coarse is not None:
+            s = self.coarse.shift(bin_image(data, self.bin))
+            offset = (int(round(s[0] * self.bin)), int(round(s[1] * self.bin)))
+        if self.section:
+            s = self.fine.shift(central_section(data, self.section, offset))
+            return offset[0] + s[0], offset[1] + s[1]
+        if self.coarse is not None:
+            #
+            # Refine on the full image, undoing the coarse shift first so
+            # that the residual is well inside the correlation range
+            #
+            s = self.fine.shift(np.roll(np.roll(data, offset[0], axis=0),
+                                        offset[1], axis=1))
+            return offset[0] + s[0], offset[1] + s[1]
+        return self.fine.shift(data)
+
+
+_template_key = None
+_template = None
+
+
+def _template_key_for(R, params):
+    section = None
+    if isinstance(params.fwhm_section, np.ndarray):
+        section = tuple(params.fwhm_section)
+    if params.registration_mode == 'stars':
+        section = None
+    return (R.fullname, R.shape, section, params.registration_mode,
+            params.registration_bin, params.registration_section,
+            params.registration_stars, params.registration_degree,
+            params.preconvolve_images)
+
+
+def get_template(R, params):
+    """Registration template for Observation R, computed only once per
+    process for a given image and set of registration parameters."""
+    global _template_key, _template
+    key = _template_key_for(R, params)
+    if key != _template_key:
+        data = R.data
+        if key[2] is not None:
+            w = key[2]
+            data = data[w[2]:w[3], w[0]:w[1]]
+        _template = RegistrationTemplate(data, params)
+        _template_key = key
+    return _template
+
+
+def share_template(R, params):
+    """Compute the template for R and return it in a form that can be passed
+    to install_shared_template without copying the spectra."""
+    template = get_template(R, params)
+    return _template_key_for(R, params), template.share(), params
+
+
+def install_shared_template(key, shared, params):
+    """Pool initializer making a shared template the cached template of a
+    worker process."""
+    global _template_key, _template
+    _template = RegistrationTemplate(None, params, shared=shared)
+    _template_key = key
@@ -0,0 +1,158 @@
+from __future__ import print_function
+import hashlib
+import json
+import os
+import time
+
+#
+# Manifest of the work done in an output directory.
+#
+# The driver runs in stages (ingest, register, reference, psf,
+# reference_photometry, kernel_basis, difference, photometry), some of them
+# once per epoch.  The photometry of an epoch is normally done in the same pass as
+# its difference image, but is recorded separately, so that it alone is
+# redone when only the photometry parameters or the PSF change.
+#
+# For each piece of work, manifest.json in loc_output records a signature
+# of its inputs: the values of the parameters the stage depends on, the
+# size and modification time of its input files, and the signatures of the
+# upstream work it used.  On a rerun a piece of work is redone only if its
+# signature has changed or one of its recorded outputs has gone, and
+# because signatures chain, a change invalidates everything downstream of
+# it.  Work is recorded only once its outputs have been written (atomically,
+# by io_functions), so after a crash only the unfinished work is redone.
+#
+# Given a product_cache, the products of work that is not current are
+# looked for there before the work is redone, and the products of recorded
+# work are stored there.
+#
+# Only the parent process reads and writes the manifest.  Records are
+# written out at most every SAVE_INTERVAL seconds, and by save().
+#
+
+MANIFEST_FILE = 'manifest.json'
+
+SAVE_INTERVAL = 10.0
+
+KERNEL_PARAMETERS = ('bdeg', 'fft_kernel_threshold', 'fwhm_mult', 'gain',
+                     'iterations', 'kernel_maximum_radius',
+                     'kernel_minimum_radius', 'kernel_tolerance', 'nstamps',
+                     'pdeg', 'pixel_rejection_threshold', 'readnoise', 'sdeg',
+                     'stamp_edge_distance', 'stamp_half_width',
+                     'use_fft_kernel_pixels', 'use_stamps')
+
+PHOTOMETRY_PARAMETERS = ('ccd_group_size', 'psf_fit_radius',
+                         'psf_profile_type')
+
+STAGE_PARAMETERS = {
+    'ingest': ('datekey', 'exptimekey', 'filterkey', 'fwhm_method',
+               'fwhm_section', 'fwhm_tiles', 'pixel_max', 'pixel_min',
+               'preconvolve_FWHM', 'preconvolve_images', 'sky_degree',
+               'sky_mesh', 'sky_subtract_mode', 'sky_subtract_percent',
+               'subtract_sky'),
+    'register': ('gain', 'readnoise', 'registration_bin',
+                 'registration_degree', 'registration_mode',
+                 'registration_section', 'registration_stars'),
+    'reference': KERNEL_PARAMETERS + (
+        'diff_std_threshold', 'min_ref_images', 'ref_image_list',
+        'reference_max_roundness', 'reference_min_seeing',
+        'reference_seeing_factor', 'reference_sky_factor'),
+    'psf': ('cluster_mask_radius', 'mask_cluster', 'psf_profile_type',
+            'star_detect_sigma', 'star_file', 'star_file_has_magnitudes',
+            'star_file_is_one_based', 'star_file_number_match',
+            'star_file_transform_degree', 'star_reference_image'),
+    'reference_photometry': KERNEL_PARAMETERS + PHOTOMETRY_PARAMETERS,
+    'kernel_basis': ('kernel_basis_size',),
+    'difference': KERNEL_PARAMETERS + ('cluster_mask_radius', 'do_photometry',
+                                       'kernel_basis_size',
+                                       'kernel_basis_tolerance',
+                                       'mask_cluster'),
+    'photometry': PHOTOMETRY_PARAMETERS}
+
+
+def file_state(file):
+    """Name, size and modification time of a file, or None for the
+    size and time if it does not exist."""
+    if not (os.path.exists(file)):
+        return [file, None, None]
+    st = os.stat(file)
+    return [file, st.st_size, st.st_mtime]
+
+
+class RunManifest(object):
+    """Record of the stages and epochs completed in one output directory"""
+
+    def __init__(self, folder, cache=None):
+        self.file = os.path.join(folder, MANIFEST_FILE)
+        self.cache = cache
+        self.stages = {}
+        self._saved = time.time()
+        if os.path.exists(self.file):
+            with open(self.file, 'r') as f:
+                self.stages = json.load(f)['stages']
+
+    def work(self, stage, key, params, inputs=(), upstream=(), outputs=(),
+             cached=True):
+        """Description of a piece of work of a stage, with its signature.
+        Inputs are files whose state it depends on, upstream the works it
+        uses and outputs the files it produces, which are kept in the
+        product cache if cached."""
+        work = {'stage': stage,
+                'key': key,
+                'parameters': dict((p, getattr(params, p, None)) for p in
+                                   STAGE_PARAMETERS[stage]),
+                'inputs': [file_state(f) for f in inputs if f],
+                'upstream': sorted(w['signature'] for w in upstream),
+                'outputs': list(outputs),
+                'cached': cached}
+        description = json.dumps([stage, key, work['parameters'],
+                                  work['inputs'], work['upstream']],
+                                 sort_keys=True)
+        work['signature'] = hashlib.sha1(description.encode()).hexdigest()
+        return work
+
+    def get(self, stage, key):
+        return self.stages.get(stage, {}).get(key)
+
+    def _products(self, work):
+        return dict((os.path.basename(f), f) for f in work['outputs'])
+
+    def is_current(self, work, adopt=False):
+        """Whether work has been done with the same signature and its
+        outputs are there, or have been fetched from the product cache.
+        With adopt, outputs found from a run without a manifest entry are
+        accepted and recorded."""
+        entry = self.get(work['stage'], work['key'])
+        if entry is None:
+            if adopt and all(os.path.exists(f) for f in work['outputs']):
+                if work['outputs']:
+                    print('Adopting existing', work['stage'], 'products for',
+                          work['key'])
+                self.record(work, store=False)
+                return True
+        elif (entry['signature'] == work['signature'] and
+              all(os.path.exists(f) for f in entry['outputs'])):
+            return True
+        if (self.cache is not None and work['cached'] and work['outputs'] and
+                self.cache.fetch(work['signature'], self._products(work))):
+            self.record(work, store=False)
+            return True
+        return False
+
+    def record(self, work, store=True):
+        """Record work as done, and unless store is False keep its
+        products in the product cache."""
+        entry = dict(work)
+        entry['time'] = time.time()
+        self.stages.setdefault(work['stage'], {})[work['key']] = entry
+        if store and self.cache is not None and work['cached']:
+            self.cache.store(work['signature'], self._products(work))
+        if time.time() - self._saved > SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        self._saved = time.time()
+        tmp = self.file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'stages': self.stages}, f, indent=1, sort_keys=True)
+        os.rename(tmp, self.file)
@@ -22,6 +22,7 @@ from astropy.wcs import WCS
 from reproject import reproject_interp
 from astropy.nddata.utils import Cutout2D
 import glob
+import numpy as np
 
 def set_default_parameters():
     from pydia import data_structures as DS
@@ -50,12 +51,84 @@ def set_default_parameters():
     parameters.verbose = False
     return(parameters)
 
+def trim_footprint(shape, wcs, trimfrac):
+    """ Position, size and WCS of the central 1 - trimfrac of an image of
+    the given shape, without touching any pixel data.
+    """
+    position = [shape[1]/2., shape[0]/2.]
+    size = [round(shape[1]*(1-trimfrac)), round(shape[0]*(1-trimfrac))]
+    cutout = Cutout2D(np.empty(shape, dtype=np.int8), position=position,
+                      size=size, wcs=wcs)
+    return position, size, cutout.wcs, cutout.shape
+
+
+def trim_is_current(imname, imname_trimmed, wcsrefimname, trimfrac):
+    """ True if the trimmed image is newer than its input and the WCS
+    reference image, and was made with the same WCS reference and trimfrac.
+    """
+    if not os.path.isfile(imname_trimmed):
+        return False
+    mtime = os.path.getmtime(imname_trimmed)
+    if (mtime < os.path.getmtime(imname) or
+            mtime < os.path.getmtime(wcsrefimname)):
+        return False
+    header = fits.getheader(imname_trimmed)
+    return (header.get('TRIMREF') == os.path.abspath(wcsrefimname) and
+            header.get('TRIMFRAC') == trimfrac)
+
+
+def spin_and_trim_image(imname, imname_trimmed, wcsrefimname, trimfrac=0.4,
+                        verbose=False):
+    """ Reproject one image onto the trimmed footprint of the WCS
+    reference image and write it to imname_trimmed.
+    """
+    if verbose:
+        print("Reprojecting %s to x,y frame of %s " % (
+            imname, wcsrefimname), file=sys.stderr)
+    hdr_imref = fits.getheader(wcsrefimname)
+    wcs_imref = WCS(hdr_imref)
+    shape = (hdr_imref['NAXIS2'], hdr_imref['NAXIS1'])
+    position, size, wcs_trim, shape_trim = trim_footprint(shape, wcs_imref,
+                                                          trimfrac)
+    im = fits.open(imname)
+    if imname != wcsrefimname:
+        # Only interpolate onto the pixels that are kept
+        array, footprint = reproject_interp(im[0], wcs_trim,
+                                            shape_out=shape_trim)
+    else:
+        # WCS Ref image does not need reprojection
+        array = Cutout2D(im[0].data, position=position, size=size,
+                         wcs=wcs_imref).data
+
+    # save reprojected-and-trimmed image, via a temporary file so that an
+    # interrupted run never leaves a partial image that looks up to date
+    im[0].data = array
+    im[0].header.update(wcs_trim.to_header())
+    im[0].header['TRIMREF'] = (os.path.abspath(wcsrefimname),
+                               'WCS reference image of the trim')
+    im[0].header['TRIMFRAC'] = (trimfrac, 'Fraction of the image trimmed')
+    tmpname = imname_trimmed + '.tmp'
+    im.writeto(tmpname, output_verify='fix+warn', overwrite=True)
+    im.close()
+    os.rename(tmpname, imname_trimmed)
+    return imname_trimmed
+
+
+def spin_and_trim_image_helper(args):
+    return spin_and_trim_image(*args)
+
+
 def spin_and_trim(imlist, wcsrefimname, trimfrac=0.4, trimdir='DIA_TRIM',
-                  verbose=False):
+                  verbose=False, n_parallel=1):
     """ Rotate images to match the WCS of the reference image (spin) and then
     cut off a fraction of the outer region of the image (trim).
-    Returns a list of the trimmed images.
+    Images are reprojected onto the trimmed footprint only, and images
+    whose trimmed version is newer than both inputs and was made with the
+    same reference and trimfrac are skipped.
+    Returns a list of the trimmed images, ending with the WCS reference.
     """
+    from multiprocessing import Pool
+
     if verbose:
         print('Spinning Input Images: ' + str(imlist))
         print("to match WCS Ref image: " + wcsrefimname)
@@ -64,39 +137,30 @@ def spin_and_trim(imlist, wcsrefimname, trimfrac=0.4, trimdir='DIA_TRIM',
     if not os.path.exists(trimdir):
         os.makedirs(trimdir)
     trimmed_image_list = []
-    hdr_imref = fits.getheader(wcsrefimname)
-    wcs_imref = WCS(hdr_imref)
+    tasks = []
     for imname in list(imlist) + [wcsrefimname]:
         imname_trimmed = os.path.join(
             trimdir, os.path.basename(imname).replace('.fits', '_trim.fits'))
-        if os.path.isfile(imname_trimmed):
+        seen = imname_trimmed in trimmed_image_list
+        trimmed_image_list.append(imname_trimmed)
+        if seen:
+            continue
+        if trim_is_current(imname, imname_trimmed, wcsrefimname, trimfrac):
             print("%s exists.  Skipping trimming."%imname_trimmed,
                   file=sys.stderr)
-        if verbose:
-            print("Reprojecting %s to x,y frame of %s " % (
-                imname, wcsrefimname), file=sys.stderr)
-        im = fits.open(imname)
-        if imname != wcsrefimname:
-            array, footprint = reproject_interp(im[0], hdr_imref)
-        else:
-            # WCS Ref image does not need reprojection
-            array = im[0].data
-
-        # Trim off the outer trimfrac to reduce chances of NaN errors due to
-        # empty array segments after rotation (also speeds up DIA processing)
-        arraysize = array.shape
-        cutout = Cutout2D(array, position=[arraysize[1]/2., arraysize[0]/2.],
-                          size=[round(arraysize[1]*(1-trimfrac)),
-                                round(arraysize[0]*(1-trimfrac))],
-                          wcs=wcs_imref)
-
-        # save reprojected-and-trimmed image:
-        im[0].data = cutout.data
-        im[0].header.update(cutout.wcs.to_header())
-        im.writeto(imname_trimmed, output_verify='fix+warn')
-        im.close()
+            continue
+        tasks.append((imname, imname_trimmed, wcsrefimname, trimfrac,
+                      verbose))
+
+    if n_parallel > 1 and len(tasks) > 1:
+        pool = Pool(n_parallel)
+        pool.map(spin_and_trim_image_helper, tasks)
+        pool.close()
+        pool.join()
+    else:
+        for task in tasks:
+            spin_and_trim_image(*task)
 
-        trimmed_image_list.append(imname_trimmed)
     return(trimmed_image_list)
 
 
@@ -145,7 +209,8 @@ def make_diff_images(params):
 
         trimmed_image_list = spin_and_trim(
             input_image_list, params.wcs_ref_image, trimfrac=params.trimfrac,
-            trimdir=params.loc_trim, verbose=params.verbose)
+            trimdir=params.loc_trim, verbose=params.verbose,
+            n_parallel=params.n_parallel)
         params.wcs_ref_image = trimmed_image_list[-1]
         params.loc_data = params.loc_trim
 
@@ -244,28 +309,40 @@ def viewHelp():
     print("--detect_threshold (4.0) Sigma threshold for variable object detection.")
     print("--diff_std_threshold (10.0) Threshold for good images to use for variable object detection")
     print("--do_photometry (True) Measure stellar fluxes from the difference images")
+    print("--exptimekey ('EXPTIME') Exposure time field in FITS headers")
     print("--fft_kernel_threshold (3.0)")
+    print("--filterkey ('FILTER') Filter name field in FITS headers")
+    print("--fwhm_method (tiles) tiles: estimate seeing from the autocorrelation of a bounded number of sampled tiles. full: use the autocorrelation of the whole image.")
     print("--fwhm_mult (6.5) Multiplier to determine kernel size")
     print("--fwhm_section (None) Array of 4 numbers describing the bottom-left and top-right corners of a rectangular section of each image to use for FWHM estimation")
+    print("--fwhm_tiles (16) Maximum number of 256x256 tiles used when fwhm_method = tiles.")
     print("--gain (1.0) Inverse-gain of the CCD (e-/ADU)")
     print("--image_list_file (images) Write image names and dates.")
     print("--iterations (1) Number of kernel iterations")
+    print("--kernel_basis_size (None) Solve the kernels of most epochs in a basis of at most this many eigen-kernels, learned from the kernels of a few training epochs solved in the full basis")
+    print("--kernel_basis_tolerance (1.2) An epoch whose first chi^2 per pixel in the eigen-kernel basis exceeds this multiple of the median for the training epochs is solved in the full basis")
+    print("--kernel_basis_training (16) Number of training epochs, spanning the range of seeing, for the eigen-kernel basis")
     print("--kernel_maximum_radius (20.0) Maximum radius for the convolution kernel")
     print("--kernel_minimum_radius (5.0) Minimum radius for the convolution kernel")
+    print("--kernel_tolerance (None) Stop the kernel iterations once the relative changes in the kernel coefficients and chi^2 are below this value and the rejected pixels no longer change")
     print("--loc_data (.) Absolute or relative path to the directory containing the input images.")
     print("--loc_output (.) Absolute or relative path to the directory to store the output files. Will be created if it doesnt exist.")
     print("--make_difference_images (True) ")
     print("--mask_cluster (False) If True, the attempt to detect and mask the highest concentration of stars in each image.")
+    print("--memory_budget (None) Approximate limit in megabytes on image arrays held in memory by each process. Least recently used arrays beyond it are written out or dropped.")
     print("--min_ref_images (3) Minimum number of images to combine for the reference.")
     print("--n_parallel (1) Number of parallel CPU parallel processes to run. Typically set this to equal the number of CPU cores available.")
     print("--name_pattern (*.fits) Pattern describing data file names")
     print("--nstamps (200) How many stamps to use")
+    print("--parallel_mode (process) Run the n_parallel difference-imaging workers as processes, or as threads of one process (thread) sharing the reference image and its caches")
     print("--pdeg (0) Degree of spatial variation of the kernel photmetric scale")
     print("--pixel_max (50000) Maximum valid pixel value")
     print("--pixel_min (0.0) Minumum valid pixel value")
     print("--pixel_rejection_threshold (3.0) Threshold for masking outlying pixels after each kernel iteration.")
     print("--preconvolve_images (False)")
     print("--preconvolve_FWHM (1.5)")
+    print("--product_cache (None) Directory of a cache of registered images, references, PSFs, difference images and photometry, shared by runs with different parameters or output directories.")
+    print("--product_cache_size (10000) Size limit in megabytes of the product cache. Least recently used products beyond it are removed.")
     print("--psf_fit_radius (3.0) Radius (in pixels) for PSF photometry.")
     print("--psf_profile_type (gaussian) The only option at present.")
     print("--readnoise (1.0) CCD readout noise (e)")
@@ -277,13 +354,21 @@ def viewHelp():
     print("--reference_max_roundness (1.3)")
     print("--reference_seeing_factor (1.01) Include images in the photometric reference that have FWHM less than this factor times the lowest FWHM.")
     print("--reference_sky_factor (1.3) Include images in the photometric reference that have backgrounds less than this factor times that of the image with the lowest FWHM.")
+    print("--registration_bin (1) If greater than 1, first find the registration shift from images binned by this factor.")
+    print("--registration_degree (1) Degree of the polynomial transform fitted when registration_mode = stars.")
     print("--registration_image (None)Use this FITS file as the astrometric reference. Otherwise use the best-seeing image.")
+    print("--registration_mode (fft) fft: shift images by whole pixels found by phase correlation. stars: match bright stars, fit a polynomial transform and resample (handles rotation).")
+    print("--registration_section (None) If set, measure (or refine) the registration shift on a central section of this many pixels on a side.")
+    print("--registration_stars (300) Number of bright stars used when registration_mode = stars.")
+    print("--scratch_dir (None) If set, arrays evicted under memory_budget are spilled to memory-mapped files in this directory.")
     print("--sdeg (0) Degree of spatial variation of the kernel shape variation")
     print("--sky_degree (0) Degree of spatial variation allowed for the sky background model")
+    print("--sky_mesh (5) Number of cells along each axis of the grid on which the sky is sampled when fitting a polynomial sky model")
     print("--sky_subtract_mode (percent) If this parameter is set to default, fit a 2D polynomial model for the sky. If this parameter is set to percent, then subtract a constant percentage value from each image.")
     print("--sky_subtract_percent (0.01) Sky percentage to subtract if sky_subtract_mode = percent")
     print("--stamp_edge_distance (40) Minimum distance in pixels from the centre of a stamp to the edge of the detector.")
     print("--stamp_half_width (20) Size of each stamp")
+    print("--storage_policy (spill) When to write registered images, masks and inverse variances: persist (on every update), spill (when released from memory) or memory (never).")
     print("--star_detect_sigma (12) Minimum signal-to-noise for star detection.")
     print("--star_file (None) If provided, use this catalogue of star positions for photometry. The first 3 columns must be star_number, x_position, y_position. Rows starting with # are ignored.")
     print("--star_file_has_magnitudes (False) If true, assume column 4 of star_file contains magnitudes.")
@@ -292,6 +377,8 @@ def viewHelp():
     print("--star_file_transform_degree 2")
     print("--star_reference_image None")
     print("--subtract_sky (False) Pre-subtract the sky background from each image")
+    print("--task_retries (1) Number of times an epoch that fails is retried with a simpler kernel configuration")
+    print("--task_timeout (None) Wall-clock limit in seconds for processing one epoch in parallel")
     print("--trimfrac (0.4) Fraction of the image to trim off after spinning to match ref image WCS and before pyDIA processing")
     print("--use_fft_kernel_pixels (False)")
     print("--use_GPU (True) Flag to indicate GPU or CPU use.")
@@ -346,22 +433,30 @@ def main(argv):
         opts, args = getopt.getopt(
             argv, "hvi:o:t:",
             ["bdeg=", "ccd_group_size=", "cluster_mask_radius=", "datekey=", "detect_threshold=",
-            "diff_std_threshold=", "do_photometry=", "fft_kernel_threshold=", "fwhm_mult=",
-            "fwhm_section=", "gain=", "image_list_file=", "iterations=",
-            "kernel_maximum_radius=", "kernel_minimum_radius=",
+            "diff_std_threshold=", "do_photometry=", "exptimekey=",
+            "fft_kernel_threshold=", "filterkey=", "fwhm_method=",
+            "fwhm_mult=", "fwhm_section=", "fwhm_tiles=", "gain=", "image_list_file=", "iterations=",
+            "kernel_basis_size=", "kernel_basis_tolerance=",
+            "kernel_basis_training=", "kernel_maximum_radius=",
+            "kernel_minimum_radius=", "kernel_tolerance=",
              "loc_data=", "loc_output=", "loc_trim=",
-            "make_difference_images=", "mask_cluster=", "min_ref_images=", "n_parallel=",
-            "name_pattern=", "nstamps=", "pdeg=", "pixel_max=", "pixel_min=",
+            "make_difference_images=", "mask_cluster=", "memory_budget=", "min_ref_images=", "n_parallel=",
+            "name_pattern=", "nstamps=", "parallel_mode=", "pdeg=", "pixel_max=", "pixel_min=",
             "pixel_rejection_threshold=", "preconvolve_images=", "preconvolve_FWHM=",
+            "product_cache=", "product_cache_size=",
             "psf_fit_radius=", "psf_profile_type=", "readnoise=",
             "wcs_ref_image=", "ref_image_list=",
             "ref_include_file=", "ref_exclude_file=", "reference_min_seeing=",
             "reference_max_roundness=", "reference_seeing_factor=", "reference_sky_factor=",
-            "registration_image=", "sdeg=", "sky_degree=", "sky_subtract_mode=",
-            "sky_subtract_percent=", "stamp_edge_distance=", "stamp_half_width=",
-            "star_detect_sigma=", "star_file=", "star_file_has_magnitudes=",
+            "registration_bin=", "registration_degree=", "registration_image=",
+            "registration_mode=", "registration_section=", "registration_stars=",
+            "scratch_dir=", "sdeg=", "sky_degree=", "sky_mesh=",
+            "sky_subtract_mode=", "sky_subtract_percent=",
+            "stamp_edge_distance=", "stamp_half_width=",
+            "storage_policy=", "star_detect_sigma=", "star_file=", "star_file_has_magnitudes=",
             "star_file_is_one_based=", "star_file_number_match=", "star_file_transform_degree=",
-            "star_reference_image=", "subtract_sky=", "trimfrac=",
+            "star_reference_image=", "subtract_sky=", "task_retries=",
+            "task_timeout=", "trimfrac=",
              "use_fft_kernel_pixels=", "use_GPU=",
             "use_stamps=", "verbose"])
     except getopt.GetoptError:
@@ -0,0 +1,147 @@
+from __future__ import print_function
+import sys
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+#
+# Dynamic scheduling of per-epoch tasks.
+#
+# Tasks are handed to the workers one at a time, most expensive first, so
+# that a few slow epochs do not end up queued behind each other at the end
+# of a run.  Each call is function(item, attempt); a task that raises, or
+# whose result is judged failed, is retried with attempt incremented, so
+# that the task function can fall back to a simpler configuration.  A task
+# that runs longer than the timeout is abandoned: its pool is terminated
+# and the other tasks that were running are resubmitted to a fresh pool.
+#
+# With threads=True the workers are threads of this process, which share
+# its memory; this pays off when the tasks spend their time in native code
+# that releases the GIL.  A thread that times out cannot be stopped, so it
+# is left to finish in the background and its result is ignored.  Its
+# task is not retried, since it may still be writing its outputs, and the
+# tasks running beside it are left to finish in the old pool while new
+# tasks go to a fresh one.
+#
+
+POLL_INTERVAL = 0.1
+
+
+def _progress(done, failed, total, start, name):
+    elapsed = time.time() - start
+    message = '%s: %d of %d done' % (name, done, total)
+    if failed:
+        message += ', %d failed' % failed
+    if done > 0 and done < total:
+        rate = done / elapsed
+        message += ', %.2f per minute, %.0f s remaining' % (
+            60.0 * rate, (total - done) / rate)
+    print(message)
+    sys.stdout.flush()
+
+
+def run_tasks(function, items, n_parallel=1, initializer=None, initargs=(),
+              cost=None, failed=None, retries=1, timeout=None, name='tasks',
+              threads=False, done=None):
+    """Apply function(item, attempt) to every item, on n_parallel worker
+    processes initialised by initializer(*initargs), in order of decreasing
+    cost(item).  A task is retried up to retries times if it raises or
+    failed(result) is true, and abandoned if it runs longer than timeout
+    seconds.  Returns the results in the order of items, with None for
+    tasks that never succeeded.  With one worker the tasks run in this
+    process, and the timeout is not enforced.  With threads, the workers
+    are threads of this process, and a task that times out is not retried.
+    done(item, result) is called in this process as each task succeeds."""
+    if not items:
+        return []
+    order = list(range(len(items)))
+    if cost is not None:
+        order.sort(key=lambda i: -cost(items[i]))
+    queue = [(i, 0) for i in order]
+    results = [None] * len(items)
+    counts = {'done': 0, 'failed': 0}
+    start = time.time()
+
+    def finish(index, attempt, result, error, retry=True):
+        label = getattr(items[index], 'name', index)
+        if error is None and not (failed and failed(result)):
+            results[index] = result
+            if done is not None:
+                done(items[index], result)
+        elif retry and attempt < retries:
+            print(name + ': retrying', label, 'after', error or 'failure')
+            queue.insert(0, (index, attempt + 1))
+            return
+        else:
+            print(name + ': giving up on', label, 'after', error or 'failure')
+            counts['failed'] += 1
+        counts['done'] += 1
+        _progress(counts['done'], counts['failed'], len(items), start, name)
+
+    if n_parallel <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        while queue:
+            index, attempt = queue.pop(0)
+            try:
+                result = function(items[index], attempt)
+            except Exception as e:
+                finish(index, attempt, None, repr(e))
+            else:
+                finish(index, attempt, result, None)
+        return results
+
+    make_pool = ThreadPool if threads else Pool
+    pool = make_pool(n_parallel, initializer, initargs)
+    running = {}
+    try:
+        while queue or running:
+            while queue and len(running) < n_parallel:
+                index, attempt = queue.pop(0)
+                running[index] = (pool.apply_async(function, (items[index],
+                                                              attempt)),
+                                  attempt, time.time())
+            time.sleep(POLL_INTERVAL)
+            stuck = False
+            for index, (task, attempt, started) in list(running.items()):
+                if task.ready():
+                    del running[index]
+                    try:
+                        result = task.get()
+                    except Exception as e:
+                        finish(index, attempt, None, repr(e))
+                    else:
+                        finish(index, attempt, result, None)
+                elif timeout and time.time() - started > timeout:
+                    del running[index]
+                    finish(index, attempt, None,
+                           'exceeding %g s' % timeout, retry=not threads)
+                    stuck = True
+            if stuck and threads:
+                #
+                # The stuck thread keeps its worker, so let the old pool
+                # wind down as its tasks finish and use a fresh one
+                #
+                pool.close()
+                pool = make_pool(n_parallel, initializer, initargs)
+            elif stuck:
+                #
+                # A stuck worker process cannot be stopped on its own, so
+                # replace the pool and resubmit the tasks that were still running
+                #
+                pool.terminate()
+                pool.join()
+                for index, (task, attempt, started) in running.items():
+                    queue.insert(0, (index, attempt))
+                running = {}
+                pool = make_pool(n_parallel, initializer, initargs)
+    finally:
+        if threads:
+            #
+            # Joining would wait for any abandoned thread
+            #
+            pool.close()
+        else:
+            pool.terminate()
+            pool.join()
+    return results
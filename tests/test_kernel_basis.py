@@ -0,0 +1,126 @@
+#
+# Kernels solved in a basis of eigen-kernels, learned from the kernel
+# tables of a few training epochs, must fit other epochs about as well as
+# the full delta basis.  The full basis is built here pixel by pixel as in
+# c_functions_dp.c, which is kept as the reference.
+#
+
+import os
+import sys
+
+import numpy as np
+from scipy import ndimage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'pydia'))
+
+import image_functions as IM
+import io_functions as IO
+
+
+class Parameters(object):
+    pdeg = 1
+    sdeg = 1
+    bdeg = 1
+    use_stamps = False
+
+
+def reference_image(n=128):
+    rs = np.random.RandomState(1)
+    R = np.zeros((n, n))
+    R[rs.randint(n, size=150), rs.randint(n, size=150)] = rs.uniform(
+        200, 20000, 150)
+    return ndimage.gaussian_filter(R, 1.2) + 100.0
+
+
+def epochs(R, n):
+    rs = np.random.RandomState(2)
+    for k in range(n):
+        sigma = rs.uniform(0.5, 2.0)
+        shift = rs.uniform(-0.2, 0.2, 2)
+        scale = rs.uniform(0.8, 1.2)
+        T = scale * ndimage.shift(ndimage.gaussian_filter(R - 100.0, sigma),
+                                  shift, order=3) + 100.0 * scale + 30.0
+        T += rs.normal(size=T.shape) * np.sqrt(T)
+        yield T, 1.0 / T
+
+
+def terms(shape, degree):
+    y, x = np.mgrid[0:shape[0], 0:shape[1]].astype(float)
+    x = (x - 0.5 * (shape[1] - 1)) / (shape[1] - 1)
+    y = (y - 0.5 * (shape[0] - 1)) / (shape[0] - 1)
+    return [x ** l * y ** m for l in range(degree + 1)
+            for m in range(degree - l + 1)]
+
+
+def full_basis(R, RB, kernelIndex, extendedBasis, params):
+    B = [R * p for p in terms(R.shape, params.pdeg)]
+    for (a, b), ext in zip(kernelIndex[1:], extendedBasis[1:]):
+        shifted = np.roll(np.roll(RB if ext else R, -b, 0), -a, 1)
+        B += [(shifted - R) * p for p in terms(R.shape, params.sdeg)]
+    return B + terms(R.shape, params.bdeg)
+
+
+def solve(B, T, weight, border):
+    inner = (slice(border, -border), slice(border, -border))
+    A = np.array([b[inner].ravel() for b in B])
+    w = weight[inner].ravel()
+    c = np.linalg.solve((A * w).dot(A.T), (A * w).dot(T[inner].ravel()))
+    return c, sum(ci * b for ci, b in zip(c, B))
+
+
+def chi2(T, model, weight, border):
+    inner = (slice(border, -border), slice(border, -border))
+    return np.mean(((T - model) ** 2 * weight)[inner])
+
+
+def test_eigen_kernel_basis(tmpdir):
+    params = Parameters()
+    R = reference_image()
+    RB = IM.boxcar_blur(R)
+    kernelIndex, extendedBasis = IM.define_kernel_pixels(4.5)
+    B = full_basis(R, RB, kernelIndex, extendedBasis, params)
+    border = 5
+    frames = list(epochs(R, 20))
+
+    kernels = []
+    for k, (T, weight) in enumerate(frames[:12]):
+        c, model = solve(B, T, weight, border)
+        kf = str(tmpdir.join('k_%d.fits' % k))
+        IO.write_kernel_table(kf, kernelIndex, extendedBasis, c, params,
+                              chi2=chi2(T, model, weight, border))
+        index, extended, coeffs, kernel_params = IO.read_kernel_table(
+            kf, Parameters())
+        kernels.append((index, extended, coeffs, kernel_params))
+    basis = IM.learn_kernel_basis(kernels, 12, 1.0)
+    bf = str(tmpdir.join('kernel_basis.fits'))
+    IO.write_kernel_basis(bf, basis.kernel_index, basis.extended_basis,
+                          basis.components, basis.chi2)
+    basis = IM.KernelBasis(*IO.read_kernel_basis(bf))
+    assert basis.components.shape[0] == 12
+    assert basis.radius <= border
+
+    Q = IM.eigen_kernel_images(R, RB, basis)
+    full_index = basis.kernel_index
+    B_basis = full_basis(R, RB, full_index, basis.extended_basis, params)
+    ratios = []
+    for T, weight in frames[12:]:
+        H, V = IM.compute_compact_matrix_and_vector(
+            R, Q, T, weight, np.ones(R.shape), border, params)
+        assert H.shape[0] <= len(B) / 5
+        d = np.linalg.solve(H, V)
+        model = IM.compute_compact_model(R, Q, d, params)
+        _, full_model = solve(B, T, weight, border)
+        ratios.append(chi2(T, model, weight, border) /
+                      chi2(T, full_model, weight, border))
+        #
+        # The expanded coefficients give the same model in the full basis
+        # over the kernel pixels of the eigen-kernels
+        #
+        c = IM.expand_compact_coefficients(d, basis, params)
+        expanded = sum(ci * b for ci, b in zip(c, B_basis))
+        inner = (slice(border, -border), slice(border, -border))
+        assert np.allclose(expanded[inner], model[inner], rtol=1.e-4,
+                           atol=1.e-2)
+    assert max(ratios) < 1.2
+    assert np.mean(ratios) < 1.1
@@ -0,0 +1,110 @@
+#
+# The saturation and bleed masks built by disk dilation must be identical
+# to those of the original per-pixel implementations, which are kept here
+# as the reference.
+#
+
+import os
+import sys
+
+import numpy as np
+from scipy.signal import convolve2d
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'pydia'))
+
+import image_functions as IM
+
+
+class Parameters(object):
+    pixel_max = 50000
+    pixel_min = 0
+
+
+def disk_offsets(radius):
+    rad2 = radius * radius
+    rad = int(np.ceil(radius))
+    z = np.arange(2 * rad + 1) - rad
+    x, y = np.meshgrid(z, z)
+    p = np.array(np.where(x ** 2 + y ** 2 < rad2))
+    return z[p[0]], z[p[1]]
+
+
+def mask_disks(shape, bad_pixels, radius):
+    mask = np.ones(shape, dtype=bool)
+    zp0, zp1 = disk_offsets(radius)
+    for k in range(bad_pixels[0].size):
+        q0 = zp0 + bad_pixels[0][k]
+        q1 = zp1 + bad_pixels[1][k]
+        s = (q0 >= 0) & (q0 < shape[0]) & (q1 >= 0) & (q1 < shape[1])
+        mask[q0[s], q1[s]] = 0
+    return mask
+
+
+def reference_saturated_pixel_mask(im, radius, params):
+    return mask_disks(im.shape, np.where(
+        (im > params.pixel_max) | (im <= params.pixel_min)), radius)
+
+
+def reference_saturated_pixel_mask_2(im1, im2, radius, params):
+    return mask_disks(im1.shape, np.where(
+        (im1 > params.pixel_max) | (im1 <= params.pixel_min) | (
+                im2 > params.pixel_max) | (im2 <= params.pixel_min)), radius)
+
+
+def reference_bleed_mask(d, radius, params):
+    kernel = np.array([[-1] * 10, [2] * 10, [-1] * 10])
+    dc = convolve2d(d, kernel.T, mode='same')
+    mask = mask_disks(d.shape, np.where(np.abs(dc) > 1.1 * params.pixel_max),
+                      radius)
+    for i in range(mask.shape[1]):
+        if np.sum(mask[:, i]) < 0.85 * mask.shape[0]:
+            mask[:, i] = 0
+    return mask
+
+
+def frames(n):
+    rs = np.random.RandomState(2)
+    for trial in range(n):
+        shape = (rs.randint(5, 200), rs.randint(5, 200))
+        im = rs.uniform(1, 40000, shape)
+        nb = rs.randint(0, 50)
+        im[rs.randint(0, shape[0], nb), rs.randint(0, shape[1], nb)] = 70000
+        if trial % 3 == 0:
+            im[:, rs.randint(0, shape[1])] = 90000
+        im[rs.randint(0, shape[0], 3), rs.randint(0, shape[1], 3)] = 0
+        im2 = rs.uniform(1, 40000, shape)
+        im2[rs.randint(0, shape[0], 5), rs.randint(0, shape[1], 5)] = 60000
+        yield im, im2
+
+
+RADII = (0, 0.5, 1, 1.5, 3, 5, 6.3, 20)
+
+
+def test_saturated_pixel_mask():
+    params = Parameters()
+    for im, _ in frames(30):
+        for radius in RADII:
+            mask = IM.compute_saturated_pixel_mask(im, radius, params)
+            expected = reference_saturated_pixel_mask(im, radius, params)
+            assert mask.dtype == expected.dtype
+            assert np.array_equal(mask, expected)
+
+
+def test_saturated_pixel_mask_2():
+    params = Parameters()
+    for im1, im2 in frames(30):
+        for radius in RADII:
+            assert np.array_equal(
+                IM.compute_saturated_pixel_mask_2(im1, im2, radius, params),
+                reference_saturated_pixel_mask_2(im1, im2, radius, params))
+
+
+def test_bleed_mask():
+    params = Parameters()
+    for im, _ in frames(30):
+        for radius in RADII:
+            mask = IM.compute_bleed_mask(im, radius, params)
+            expected = reference_bleed_mask(im, radius, params)
+            assert mask.dtype == expected.dtype
+            assert np.array_equal(mask, expected)